@@ -1,8 +1,24 @@
 #!/usr/bin/env python3
 
 import argparse
+import functools
+import itertools
 import operator
 import os.path
+import sys
+
+import exabin
+import exacache
+import exacow
+import exackpt
+import exaloop
+import exaout
+import exaparse
+import exaprof
+import exarec
+import exastore
+import exastream
+import exatrace
 
 
 class Statement:
@@ -26,6 +42,17 @@ class Statement:
         raise NotImplementedError('{}.do'.format(
             self.__class__.__name))
 
+    def compile(self, interp_state, stmt_num):
+        # Statements that do not know how to compile themselves fall
+        # back to running do() against the shared state.
+        do = self.do
+
+        def op():
+            interp_state.next_statement = stmt_num
+            do(interp_state)
+            return interp_state.next_statement
+        return op
+
 
 class MARK(Statement):
 
@@ -39,6 +66,10 @@ class MARK(Statement):
     def do(self, interp_state):
         interp_state.next_statement += 1
 
+    def compile(self, interp_state, stmt_num):
+        next_stmt = stmt_num + 1
+        return lambda: next_stmt
+
 
 class TJMP(Statement):
 
@@ -55,6 +86,17 @@ class TJMP(Statement):
         else:
             interp_state.next_statement += 1
 
+    def compile(self, interp_state, stmt_num):
+        registers = interp_state.compile_registers()
+        jump = interp_state.compile_label(self._label, self._line_num)
+        next_stmt = stmt_num + 1
+
+        def op():
+            if registers['T']:
+                return jump()
+            return next_stmt
+        return op
+
 
 class FJMP(Statement):
 
@@ -71,6 +113,17 @@ class FJMP(Statement):
             label_address = interp_state.get_label(self._label, self._line_num)
             interp_state.next_statement = label_address
 
+    def compile(self, interp_state, stmt_num):
+        registers = interp_state.compile_registers()
+        jump = interp_state.compile_label(self._label, self._line_num)
+        next_stmt = stmt_num + 1
+
+        def op():
+            if registers['T']:
+                return next_stmt
+            return jump()
+        return op
+
 
 class JUMP(Statement):
 
@@ -84,6 +137,9 @@ class JUMP(Statement):
         label_address = interp_state.get_label(self._label, self._line_num)
         interp_state.next_statement = label_address
 
+    def compile(self, interp_state, stmt_num):
+        return interp_state.compile_label(self._label, self._line_num)
+
 
 class COPY(Statement):
 
@@ -97,6 +153,16 @@ class COPY(Statement):
         interp_state.store(self._to, _from, self._line_num)
         interp_state.next_statement += 1
 
+    def compile(self, interp_state, stmt_num):
+        get_from = interp_state.compile_value(self._from, self._line_num)
+        store = interp_state.compile_store(self._to, self._line_num)
+        next_stmt = stmt_num + 1
+
+        def op():
+            store(get_from())
+            return next_stmt
+        return op
+
 
 class TEST(Statement):
 
@@ -146,6 +212,44 @@ class TEST(Statement):
         interp_state.store('T', result, self._line_num)
         interp_state.next_statement += 1
 
+    def compile(self, interp_state, stmt_num):
+        registers = interp_state.compile_registers()
+        next_stmt = stmt_num + 1
+        line_num = self._line_num
+
+        if self._op == 'EOF':
+            def op():
+                if interp_state.at_eof(line_num):
+                    registers['T'] = 1
+                else:
+                    registers['T'] = 0
+                return next_stmt
+            return op
+
+        get_a = interp_state.compile_value(self._a, line_num)
+        get_b = interp_state.compile_value(self._b, line_num)
+        op_func = self._op_funcs.get(self._op)
+
+        if op_func is None:
+            # Report the bad operator when the statement runs, the
+            # same as do().
+            bad_op = self._op
+
+            def op():
+                get_a()
+                get_b()
+                raise RuntimeError('Unknown operator {} on line {}'.format(
+                    bad_op, line_num))
+            return op
+
+        def op():
+            if op_func(get_a(), get_b()):
+                registers['T'] = 1
+            else:
+                registers['T'] = 0
+            return next_stmt
+        return op
+
 
 class MathStatement(Statement):
 
@@ -163,35 +267,45 @@ class MathStatement(Statement):
         interp_state.store(self._to, self.compute(a, b), self._line_num)
         interp_state.next_statement += 1
 
+    def compute(self, a, b):
+        return self._operator(a, b)
+
+    def compile(self, interp_state, stmt_num):
+        get_a = interp_state.compile_value(self._a, self._line_num)
+        get_b = interp_state.compile_value(self._b, self._line_num)
+        store = interp_state.compile_store(self._to, self._line_num)
+        compute = self._operator
+        next_stmt = stmt_num + 1
+
+        def op():
+            store(compute(get_a(), get_b()))
+            return next_stmt
+        return op
+
 
 class ADDI(MathStatement):
 
-    def compute(self, a, b):
-        return a + b
+    _operator = operator.add
 
 
 class MULI(MathStatement):
 
-    def compute(self, a, b):
-        return a * b
+    _operator = operator.mul
 
 
 class DIVI(MathStatement):
 
-    def compute(self, a, b):
-        return a // b
+    _operator = operator.floordiv
 
 
 class MODI(MathStatement):
 
-    def compute(self, a, b):
-        return a % b
+    _operator = operator.mod
 
 
 class SUBI(MathStatement):
 
-    def compute(self, a, b):
-        return a - b
+    _operator = operator.sub
 
 
 class GRAB(Statement):
@@ -207,6 +321,16 @@ class GRAB(Statement):
         interp_state.grab_file(file_id)
         interp_state.next_statement += 1
 
+    def compile(self, interp_state, stmt_num):
+        get_id = interp_state.compile_value(self._id, self._line_num)
+        grab_file = interp_state.grab_file
+        next_stmt = stmt_num + 1
+
+        def op():
+            grab_file(get_id())
+            return next_stmt
+        return op
+
 
 class DROP(Statement):
 
@@ -216,6 +340,16 @@ class DROP(Statement):
         interp_state.drop_file(self._line_num)
         interp_state.next_statement += 1
 
+    def compile(self, interp_state, stmt_num):
+        drop_file = interp_state.drop_file
+        line_num = self._line_num
+        next_stmt = stmt_num + 1
+
+        def op():
+            drop_file(line_num)
+            return next_stmt
+        return op
+
 
 class FILE(Statement):
 
@@ -226,9 +360,19 @@ class FILE(Statement):
         self._to = tokens[1]
 
     def do(self, interp_state):
-        interp_state.store(self._to, interp_state.current_file_id)
+        interp_state.store(self._to, interp_state.current_file_id,
+                           self._line_num)
         interp_state.next_statement += 1
 
+    def compile(self, interp_state, stmt_num):
+        store = interp_state.compile_store(self._to, self._line_num)
+        next_stmt = stmt_num + 1
+
+        def op():
+            store(interp_state.current_file_id)
+            return next_stmt
+        return op
+
 
 class SEEK(Statement):
 
@@ -243,6 +387,17 @@ class SEEK(Statement):
         interp_state.seek(offset, self._line_num)
         interp_state.next_statement += 1
 
+    def compile(self, interp_state, stmt_num):
+        get_offset = interp_state.compile_value(self._offset, self._line_num)
+        seek = interp_state.seek
+        line_num = self._line_num
+        next_stmt = stmt_num + 1
+
+        def op():
+            seek(get_offset(), line_num)
+            return next_stmt
+        return op
+
 
 class File:
 
@@ -251,6 +406,8 @@ class File:
         self._output = output
         self._cursor = 0
         self._content = initial_data or []
+        # Counts writes, so callers can tell whether the file changed.
+        self.version = 0
 
     def at_eof(self):
         return (self._cursor + 1) > len(self._content)
@@ -276,6 +433,7 @@ class File:
         return response
 
     def write(self, val, line_num):
+        self.version += 1
         try:
             self._content[self._cursor] = val
             self._cursor += 1
@@ -283,10 +441,18 @@ class File:
             self._content.append(val)
             self._cursor = len(self._content)
 
+    def tell(self):
+        return self._cursor
+
     def get_content(self):
         return self._content
 
 
+def format_step(stmt, X, T, next_statement):
+    return '{:30} X={:4} T={:4} next={:4}'.format(
+        str(stmt), X, T, next_statement)
+
+
 class InterpreterState:
 
     def __init__(self, output, files):
@@ -296,6 +462,7 @@ class InterpreterState:
             'X': 0,
         }
         self.next_statement = 0
+        self.cycles = 0
         self.labels = {}
         self._files = files
         self._current_file = None
@@ -351,7 +518,7 @@ class InterpreterState:
                 loc, line_num))
 
     def at_eof(self, line_num):
-        if not self._current_file:
+        if self._current_file is None:
             raise RuntimeError('Tested EOF no file was open on line {}'.format(
                 line_num))
         return self._current_file.at_eof()
@@ -364,14 +531,14 @@ class InterpreterState:
         self.current_file_id = file_id
 
     def drop_file(self, line_num):
-        if not self._current_file:
+        if self._current_file is None:
             raise RuntimeError('Dropped when no file was open on line {}'.format(
                 line_num))
         self._current_file = None
         self.current_file_id = None
 
     def seek(self, offset, line_num):
-        if not self._current_file:
+        if self._current_file is None:
             raise RuntimeError('Seeked when no file was open on line {}'.format(
                 line_num))
         self._current_file.seek(offset)
@@ -379,6 +546,60 @@ class InterpreterState:
     def get_files(self):
         return self._files
 
+    def restore(self, snapshot):
+        # Continue from an exackpt.Snapshot.
+        exackpt.restore_files(
+            snapshot, self._files,
+            lambda file_id, content: File(file_id, self._output, content),
+        )
+        self._registers['X'] = snapshot.X
+        self._registers['T'] = snapshot.T
+        self.next_statement = snapshot.next_statement
+        self.cycles = snapshot.cycle
+        if snapshot.file_id is not None:
+            self._current_file = self._files[snapshot.file_id]
+        self.current_file_id = snapshot.file_id
+
+    # The compile_* methods return closures used by the compiled
+    # execution mode. Anything that can be resolved before the program
+    # runs (literal values, register names, label addresses) is looked
+    # up once here instead of on every cycle. Operands that would fail
+    # are deferred so the error is raised when the statement runs, with
+    # the same message as the step-by-step mode.
+
+    def compile_registers(self):
+        return self._registers
+
+    def compile_label(self, label, line_num):
+        if label not in self.labels:
+            def jump():
+                return self.get_label(label, line_num)
+            return jump
+        address = self.labels[label]
+        return lambda: address
+
+    def compile_value(self, val, line_num):
+        if val in self._registers:
+            registers = self._registers
+            return lambda: registers[val]
+        if val != 'F':
+            try:
+                vali = int(val)
+            except (TypeError, ValueError):
+                pass
+            else:
+                if -9999 <= vali <= 9999:
+                    return lambda: vali
+        return lambda: self.get_value(val, line_num)
+
+    def compile_store(self, loc, line_num):
+        if loc in self._registers:
+            return functools.partial(operator.setitem, self._registers, loc)
+
+        def store(val):
+            self.store(loc, val, line_num)
+        return store
+
 
 class Interpreter:
 
@@ -404,9 +625,18 @@ class Interpreter:
         'SEEK': SEEK,
     }
 
-    def __init__(self, output):
+    def __init__(self, output, trace=None, files=None, cache=None):
         self._output = output
-        self._data_files = {}
+        # An exacache.ProgramCache for parsed programs, or None.
+        self._cache = cache
+        if trace is None:
+            trace = exatrace.StreamSink(output)
+        self._trace = trace
+        # files can be any mapping of ids to File-like objects, such as
+        # an exastore.FileStore.
+        if files is None:
+            files = {}
+        self._data_files = files
 
     def load_data_file(self, file_id, file_handle):
         content = []
@@ -416,33 +646,454 @@ class Interpreter:
             except TypeError:
                 raise RuntimeError('Invalid integer {} on line {} of {}'.format(
                     line.strip(), num, filename))
-        self._data_files[file_id] = File(file_id, self._output, content)
+        self.add_data_file(file_id, content)
 
-    def run(self, statements):
-        state = InterpreterState(self._output, self._data_files)
-        program = self.parse(statements, state)
+    def add_data_file(self, file_id, content):
+        self.add_file(file_id, File(file_id, self._output, content))
 
-        while True:
-            if state.next_statement >= len(program):
-                # End of program
-                break
+    def add_file(self, file_id, data_file):
+        # data_file can be any object with the same methods as File.
+        if isinstance(self._data_files, exastore.FileStore):
+            # Only files the program creates are always written back.
+            self._data_files.add_input(file_id, data_file)
+        else:
+            self._data_files[file_id] = data_file
+
+    def add_shared_file(self, file_id, content):
+        # Each run gets its own copy-on-write view of the content, so
+        # it can be run again with the same inputs.
+        self.add_file(file_id, exacow.BaseFile(file_id, content))
+
+    def run(self, statements, compiled=False, transpiled=False,
+            dump_source=None, max_cycles=None, optimize=False,
+            report=None, checkpoint=None, profile=None, record=None,
+            bulk=True, loops=None):
+        state = InterpreterState(
+            self._output, exacow.snapshot_files(self._data_files))
+        program = self.parse(statements, state, optimize, report)
+        trace = self._trace
+        if profile is not None:
+            if transpiled or checkpoint is not None:
+                raise RuntimeError(
+                    'Profiling needs the step by step or compiled modes')
+            state._files = profile.start(
+                [(stmt._line_num, stmt._tokens) for stmt in program],
+                state.labels,
+                state._files,
+            )
+        if record is not None:
+            if transpiled or checkpoint is not None or profile is not None:
+                raise RuntimeError(
+                    'Recording needs the step by step or compiled modes')
+            state._files = record.start(
+                [(stmt._line_num, stmt._tokens) for stmt in program],
+                state.labels,
+                state._files,
+            )
+        if loops is not None:
+            if (transpiled or checkpoint is not None or profile is not None or
+                    record is not None):
+                raise RuntimeError(
+                    'Loops can only be detected in the step by step or '
+                    'compiled modes')
+
+        # The run loops iterate over cycles, so a limit costs nothing
+        # extra per cycle.
+        if max_cycles is None:
+            cycles = itertools.count()
+        else:
+            cycles = range(max_cycles)
 
-            stmt = program[state.next_statement]
-            stmt.do(state)
-            self._output('{:30} {}'.format(str(stmt), state))
+        try:
+            if transpiled:
+                if max_cycles is not None:
+                    raise RuntimeError(
+                        'A cycle limit cannot be used with transpiled programs')
+                if checkpoint is not None:
+                    raise RuntimeError(
+                        'Checkpoints cannot be taken of transpiled programs')
+                self._run_transpiled(program, state, dump_source)
+            elif checkpoint is not None:
+                self._run_checkpointed(program, state, trace, compiled,
+                                       max_cycles, checkpoint)
+            elif profile is not None:
+                self._run_profiled(program, state, trace, compiled, cycles,
+                                   profile)
+            elif record is not None:
+                self._run_recorded(program, state, trace, compiled,
+                                   max_cycles, record)
+            elif loops is not None:
+                self._run_watched(program, state, trace, compiled,
+                                  max_cycles, loops)
+            elif compiled:
+                # Loops are only run in bulk when there is no cycle limit
+                # they could run past.
+                self._run_compiled(program, state, trace, cycles,
+                                   bulk=bulk and max_cycles is None)
+            else:
+                self._run_steps(program, state, trace, cycles)
+            if state.next_statement < len(program):
+                raise RuntimeError('Reached cycle limit {} before line {}'.format(
+                    max_cycles, program[state.next_statement]._line_num))
+        except Exception as exc:
+            trace.error(exc)
+            raise
+        finally:
+            trace.flush()
 
         return state
 
-    def parse(self, statements, state):
-        # clean up extra white space, eliminate blank lines, ignore
-        # comments, and parse each line into tokens
-        tokenized = [
-            (ln, stmt.strip().split())
-            for ln, stmt in enumerate(line.strip() for line in statements)
-            if stmt and not stmt.startswith('#')
+    def start(self, statements, compiled=False, max_cycles=None,
+              optimize=False, report=None):
+        # Parse the program and return an Execution to run it a few
+        # cycles at a time.
+        state = InterpreterState(
+            self._output, exacow.snapshot_files(self._data_files))
+        program = self.parse(statements, state, optimize, report)
+        return Execution(self, program, state, compiled, max_cycles)
+
+    async def run_async(self, statements, batch=1000, compiled=False,
+                        max_cycles=None, optimize=False, report=None):
+        # Like run(), but gives the event loop a turn every batch
+        # cycles. Cancelling the task stops the program there.
+        import asyncio
+        if batch < 1:
+            raise ValueError('Invalid batch size {}'.format(batch))
+        execution = self.start(statements, compiled, max_cycles, optimize,
+                               report)
+        while not execution.done:
+            execution.step(batch)
+            await asyncio.sleep(0)
+        return execution.state
+
+    def _run_steps(self, program, state, trace, cycles):
+        end = len(program)
+        cycle = state.cycles
+        try:
+            if trace.enabled:
+                for cycle in cycles:
+                    if state.next_statement >= end:
+                        # End of program
+                        break
+                    stmt = program[state.next_statement]
+                    stmt.do(state)
+                    trace.record(format_step, stmt, state.X, state.T,
+                                 state.next_statement)
+                else:
+                    cycle = cycles.stop
+            else:
+                for cycle in cycles:
+                    if state.next_statement >= end:
+                        break
+                    program[state.next_statement].do(state)
+                else:
+                    cycle = cycles.stop
+        finally:
+            state.cycles = cycle
+
+    def _compile(self, program, state):
+        # Each statement becomes a closure that performs its work and
+        # returns the index of the next statement, so the loop only has
+        # to index a list and make one call per cycle.
+        return [
+            stmt.compile(state, sn)
+            for sn, stmt in enumerate(program)
         ]
 
-        # build commands and collect marks
+    def _run_compiled(self, program, state, trace, cycles, ops=None,
+                      bulk=False):
+        if ops is None:
+            ops = self._compile(program, state)
+        # Cycles run by bulk loops beyond the one they are counted as.
+        saved = [0]
+        if bulk and not trace.enabled:
+            ops = self._bulk_ops(program, state, ops, saved)
+        end = len(ops)
+        pc = state.next_statement
+        cycle = state.cycles
+        try:
+            if trace.enabled:
+                registers = state.compile_registers()
+                for cycle in cycles:
+                    if pc >= end:
+                        break
+                    stmt = program[pc]
+                    pc = ops[pc]()
+                    trace.record(format_step, stmt, registers['X'],
+                                 registers['T'], pc)
+                else:
+                    cycle = cycles.stop
+            else:
+                for cycle in cycles:
+                    if pc >= end:
+                        break
+                    pc = ops[pc]()
+                else:
+                    cycle = cycles.stop
+        finally:
+            state.next_statement = pc
+            state.cycles = cycle + saved[0]
+
+    def _bulk_ops(self, program, state, ops, saved):
+        # Replace the first statement of each file-scan loop exaidiom
+        # recognizes with one that runs the whole loop at once, when the
+        # open file is an in-memory File.
+        import exaidiom
+        loops = exaidiom.find_loops(
+            [(stmt._line_num, stmt._tokens) for stmt in program],
+            state.labels,
+        )
+        if not loops:
+            return ops
+        registers = state.compile_registers()
+
+        def make_op(loop, op):
+            def bulk_op():
+                data_file = state._current_file
+                if type(data_file) is File:
+                    result = loop.run(data_file._content, data_file._cursor,
+                                      registers['X'])
+                    if result is not None:
+                        (cycles, pc, data_file._cursor, registers['X'],
+                         registers['T']) = result
+                        saved[0] += cycles - 1
+                        return pc
+                return op()
+            return bulk_op
+
+        ops = list(ops)
+        for start, loop in loops.items():
+            ops[start] = make_op(loop, ops[start])
+        return ops
+
+    def _step_ops(self, program, state, compiled):
+        # Closures that return the next statement, compiled or running
+        # do(), for the loops that need to see each statement's index.
+        if compiled:
+            return self._compile(program, state)
+
+        def make_op(stmt):
+            def op():
+                stmt.do(state)
+                return state.next_statement
+            return op
+        return [make_op(stmt) for stmt in program]
+
+    def _run_profiled(self, program, state, trace, compiled, cycles,
+                      profile):
+        # Counts the statements run and the jumps taken, for exaprof.
+        ops = self._step_ops(program, state, compiled)
+        counts = profile.counts
+        jumps = profile.jumps
+        registers = state.compile_registers()
+        end = len(ops)
+        pc = state.next_statement
+        cycle = state.cycles
+        try:
+            for cycle in cycles:
+                if pc >= end:
+                    break
+                next_pc = ops[pc]()
+                counts[pc] += 1
+                if next_pc != pc + 1:
+                    jumps[pc] += 1
+                if trace.enabled:
+                    trace.record(format_step, program[pc], registers['X'],
+                                 registers['T'], next_pc)
+                pc = next_pc
+            else:
+                cycle = cycles.stop
+        finally:
+            state.next_statement = pc
+            state.cycles = cycle
+
+    def _run_recorded(self, program, state, trace, compiled, max_cycles,
+                      record):
+        # Saves what exarec needs to replay the run: after a statement
+        # of one of the record's kinds, the new value of its register
+        # or the id of the file grabbed. The loop saves it itself
+        # instead of wrapping the op, so no statement pays for an extra
+        # Python call.
+        registers = state.compile_registers()
+        record_value = record.values.append
+        kinds = record.kinds
+        grab = exarec.GRAB
+        ops = self._step_ops(program, state, compiled)
+        end = len(ops)
+        pc = state.next_statement
+        cycle = state.cycles
+        error = None
+        try:
+            for cycles in record.segments(cycle, max_cycles):
+                if trace.enabled:
+                    for cycle in cycles:
+                        if pc >= end:
+                            break
+                        stmt = program[pc]
+                        kind = kinds[pc]
+                        pc = ops[pc]()
+                        if kind is not None:
+                            if kind == grab:
+                                record_value(state.current_file_id)
+                            else:
+                                record_value(registers[kind])
+                        trace.record(format_step, stmt, registers['X'],
+                                     registers['T'], pc)
+                    else:
+                        cycle = cycles.stop
+                else:
+                    for cycle in cycles:
+                        if pc >= end:
+                            break
+                        kind = kinds[pc]
+                        pc = ops[pc]()
+                        if kind is not None:
+                            if kind == grab:
+                                record_value(state.current_file_id)
+                            else:
+                                record_value(registers[kind])
+                    else:
+                        cycle = cycles.stop
+                if pc >= end:
+                    break
+                record.seal(cycle, pc, registers['X'], registers['T'],
+                            state.current_file_id)
+        except Exception as exc:
+            error = exc
+            raise
+        finally:
+            state.next_statement = pc
+            state.cycles = cycle
+            record.finish(cycle, pc, registers['X'], registers['T'],
+                          state.current_file_id, error)
+
+    def _run_checkpointed(self, program, state, trace, compiled, max_cycles,
+                          checkpoint):
+        files = state._files
+        state._files = checkpoint.track(files)
+        snapshot = checkpoint.begin(
+            [(stmt._line_num, stmt._tokens) for stmt in program])
+        if snapshot is not None:
+            state.restore(snapshot)
+        if compiled:
+            run = functools.partial(self._run_compiled,
+                                    ops=self._compile(program, state))
+        else:
+            run = self._run_steps
+        end = len(program)
+        try:
+            for cycles in checkpoint.segments(state.cycles, max_cycles):
+                run(program, state, trace, cycles)
+                if state.next_statement >= end:
+                    break
+                if checkpoint.due(state.cycles):
+                    checkpoint.save(state.cycles, state.X, state.T,
+                                    state.next_statement,
+                                    state.current_file_id, state.get_files())
+        finally:
+            checkpoint.finish(state.next_statement >= end)
+            state._files = files
+
+    def _run_watched(self, program, state, trace, compiled, max_cycles,
+                     loops):
+        # Stops between segments of cycles to let the exaloop detector
+        # look at the state.
+        if compiled:
+            run = functools.partial(self._run_compiled,
+                                    ops=self._compile(program, state))
+        else:
+            run = self._run_steps
+        end = len(program)
+
+        def get_state():
+            return exaloop.machine_state(
+                state.next_statement, state.X, state.T,
+                state.current_file_id, state.get_files())
+
+        for cycles in loops.segments(state.cycles, max_cycles):
+            run(program, state, trace, cycles)
+            if state.next_statement >= end:
+                break
+            repeated = loops.check(state.cycles, get_state())
+            if repeated is None:
+                continue
+
+            ops = self._step_ops(program, state, compiled)
+
+            def step():
+                stmt = program[state.next_statement]
+                state.next_statement = ops[state.next_statement]()
+                state.cycles += 1
+                if trace.enabled:
+                    trace.record(format_step, stmt, state.X, state.T,
+                                 state.next_statement)
+                return stmt._line_num
+
+            loops.find_loop(repeated, step, get_state,
+                            state.cycles - repeated)
+
+    def _run_transpiled(self, program, state, dump_source):
+        import exac
+
+        def new_file(file_id):
+            self._output('Creating file {}'.format(file_id))
+            return File(file_id, self._output)
+
+        X, T, file_id, cycles = exac.run_transpiled(
+            [(stmt._line_num, stmt._tokens) for stmt in program],
+            state.labels,
+            state.get_files(),
+            new_file,
+            pass_line_num=True,
+            dump_source=dump_source,
+        )
+        state.store('X', X, None)
+        state.store('T', T, None)
+        if file_id is not None:
+            state.grab_file(file_id)
+        state.next_statement = len(program)
+        state.cycles = cycles
+
+    def parse(self, statements, state, optimize=False, report=None):
+        # With a program cache, a program parsed before is loaded from
+        # it instead. The cache is not used when the optimizer is
+        # reporting.
+        key = None
+        if self._cache is not None and report is None:
+            # The key is a hash of the whole source, which is then parsed.
+            if not isinstance(statements, list):
+                statements = list(statements)
+            modules = [__file__, exaparse.__file__]
+            if optimize:
+                import exaopt
+                modules.append(exaopt.__file__)
+            key = self._cache.key(exacache.module_version(*modules),
+                                  statements, 'exa', optimize)
+            cached = self._cache.get(key)
+            if cached is not None:
+                tokenized, labels = cached
+                with exaparse.no_gc():
+                    program = self._build(tokenized, state)
+                state.labels = labels
+                return program
+
+        # Operands are checked when their statement runs.
+        tokenized, _ = exaparse.parse(statements, check_operands=False)
+        with exaparse.no_gc():
+            program = self._build(tokenized, state)
+
+        if optimize:
+            program = self._optimize(program, state, report)
+
+        if key is not None:
+            self._cache.put(
+                key,
+                [(stmt._line_num, stmt._tokens) for stmt in program],
+                state.labels,
+            )
+        return program
+
+    def _build(self, tokenized, state):
         program = []
         for sn, (ln, tokens) in enumerate(tokenized):
             try:
@@ -450,26 +1101,138 @@ class Interpreter:
             except KeyError:
                 raise RuntimeError('Unknown statement on line {}: {}'.format(tokens, ln))
             program.append(factory(ln, sn, tokens, self, state))
-
         return program
 
+    def _optimize(self, program, state, report):
+        import exaopt
+        optimized, state.labels = exaopt.optimize(
+            [(stmt._line_num, stmt._tokens) for stmt in program],
+            state.labels,
+            report,
+        )
+        # The optimized program has no MARK statements, so building it
+        # does not add labels to the state again.
+        return self._build(optimized, state)
+
+
+class Execution:
+    # A program started by Interpreter.start(). Each call to step() runs
+    # up to n more cycles, with the same results as Interpreter.run().
+
+    def __init__(self, interp, program, state, compiled, max_cycles):
+        self._interp = interp
+        self._program = program
+        self.state = state
+        self._max_cycles = max_cycles
+        self._trace = interp._trace
+        if compiled:
+            ops = interp._compile(program, state)
+            self._run = functools.partial(interp._run_compiled, ops=ops)
+        else:
+            self._run = interp._run_steps
+
+    @property
+    def done(self):
+        return self.state.next_statement >= len(self._program)
+
+    def step(self, n):
+        if n < 1:
+            raise ValueError('Cannot step {} cycles'.format(n))
+        state = self.state
+        if self.done:
+            return state
+        stop = state.cycles + n
+        if self._max_cycles is not None:
+            stop = min(stop, self._max_cycles)
+        try:
+            self._run(self._program, state, self._trace,
+                      range(state.cycles, stop))
+            if (not self.done and self._max_cycles is not None and
+                    state.cycles >= self._max_cycles):
+                raise RuntimeError('Reached cycle limit {} before line {}'.format(
+                    self._max_cycles,
+                    self._program[state.next_statement]._line_num))
+        except Exception as exc:
+            self._trace.error(exc)
+            self._trace.flush()
+            raise
+        if self.done:
+            self._trace.flush()
+        return state
+
+    def batches(self, n):
+        # Yield the state after every n cycles until the program ends.
+        while not self.done:
+            yield self.step(n)
+
 
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['serve']:
+        # "exa.py serve ..." runs programs sent over a socket instead.
+        import exaserve
+        exaserve.main(sys.argv[2:])
+        sys.exit(0)
+
     p = argparse.ArgumentParser()
     p.add_argument('program')
     p.add_argument('-f', dest='files', action='append', default=[])
     p.add_argument('-v', dest='verbose', action='store_true', default=True)
     p.add_argument('-q', dest='verbose', action='store_false')
+    p.add_argument('-c', '--compiled', action='store_true', default=False,
+                   help='run the program as pre-resolved closures')
+    p.add_argument('-t', '--transpile', action='store_true', default=False,
+                   help='translate the program to Python and run that, '
+                   'without tracing each cycle')
+    exatrace.add_arguments(p)
+    p.add_argument('--dump-source', action='store_true', default=False,
+                   help='print the Python source generated by --transpile')
+    p.add_argument('-d', '--data-dir', default=None,
+                   help='load numbered data files from this directory when '
+                   'the program grabs them, and save the ones it changes')
+    p.add_argument('--max-resident', type=int, default=None,
+                   help='number of values from --data-dir to keep in memory')
+    p.add_argument('--flush-binary', action='store_true', default=False,
+                   help='write changes to binary data files back to disk')
+    p.add_argument('-O', '--optimize', action='store_true', default=False,
+                   help='optimize the program before running it')
+    p.add_argument('--report-opt', action='store_true', default=False,
+                   help='print the changes made by --optimize')
+    p.add_argument('--no-bulk', dest='bulk', action='store_false',
+                   default=True,
+                   help='run file-scan loops one statement at a time in '
+                   'the compiled mode')
+    exackpt.add_arguments(p)
+    exaprof.add_arguments(p)
+    exarec.add_arguments(p)
+    exaloop.add_arguments(p)
+    exastream.add_arguments(p)
+    exacache.add_arguments(p)
+    exaout.add_arguments(p)
     args = p.parse_args()
 
-    with open(args.program, 'r') as f:
-        statements = f.readlines()
+    # The program is parsed as it is read, unless the whole source is
+    # needed to look it up in a cache or to list it with --profile.
+    program_file = open(args.program, 'r')
+    if args.use_cache or args.memo or args.profile:
+        with program_file:
+            statements = program_file.readlines()
+    else:
+        statements = program_file
 
     def output(message):
         if args.verbose:
             print(message)
 
-    interp = Interpreter(output)
+    trace = exatrace.from_args(args, output, args.verbose)
+    profile = exaprof.from_args(args)
+    store = None
+    if args.data_dir:
+        store = exastore.FileStore(
+            args.data_dir,
+            lambda file_id, content: File(file_id, output, content),
+            args.max_resident,
+        )
+    interp = Interpreter(output, trace, store, exacache.from_args(args))
 
     for filename in args.files:
         try:
@@ -477,17 +1240,81 @@ if __name__ == '__main__':
         except TypeError:
             raise RuntimeError('Invalid filename {}, must be an integer'.format(
                 filename))
+        if exabin.is_binary(filename):
+            interp.add_file(file_id, exabin.MappedFile(file_id, filename))
+            continue
         with open(filename, 'r') as f:
             interp.load_data_file(file_id, f)
-
-    result = interp.run(statements)
+    streams = exastream.from_args(args)
+    for file_id, data_file in streams.items():
+        interp.add_file(file_id, data_file)
+
+    memo = exacache.memo_from_args(args, __file__)
+    cached = None
+    if memo is not None:
+        # The next statement printed depends on the optimizer.
+        memo_key = memo.key(statements, args.files, 'exa', args.optimize)
+        cached = memo.get(memo_key)
+
+    try:
+        if cached is not None:
+            result = InterpreterState(output, {
+                file_id: File(file_id, output, content)
+                for file_id, content in cached['files']
+            })
+            result.store('X', cached['X'], None)
+            result.store('T', cached['T'], None)
+            result.next_statement = cached['next_statement']
+        else:
+            result = interp.run(
+                statements,
+                compiled=args.compiled,
+                transpiled=args.transpile,
+                dump_source=print if args.dump_source else None,
+                optimize=args.optimize,
+                report=print if args.report_opt else None,
+                checkpoint=exackpt.from_args(args),
+                profile=profile,
+                record=exarec.from_args(args),
+                bulk=args.bulk,
+                loops=exaloop.from_args(args),
+            )
+            if memo is not None:
+                memo.put(memo_key, {
+                    'X': result.X,
+                    'T': result.T,
+                    'next_statement': result.next_statement,
+                    'files': [
+                        (file_id, list(data_file.get_content()))
+                        for file_id, data_file in sorted(
+                            result.get_files().items())
+                    ],
+                })
+    finally:
+        program_file.close()
+        trace.close()
+        exastream.close(streams)
+
+    exaprof.report(profile, args, statements)
 
     if args.verbose:
         print('FINAL:', result)
     else:
         print('X={:4} T={:4}'.format(result.X, result.T))
 
-    for file_id, file_content in sorted(result.get_files().items()):
-        print('\nFile: {}'.format(file_id))
-        for i in file_content.get_content():
-            print('  {}'.format(i))
+    if store is not None:
+        store.write_back()
+        files = store.loaded_items()
+    else:
+        files = sorted(result.get_files().items())
+
+    if args.flush_binary:
+        for file_id, data_file in files:
+            if isinstance(data_file, exabin.MappedFile):
+                data_file.flush()
+
+    exaout.report(args, {'X': result.X, 'T': result.T},
+                  exastream.without_streams(files, streams))
+
+    if args.memo_stats and memo is not None:
+        print('\nMemo: {hits} hits, {misses} misses'.format(**memo.stats()))
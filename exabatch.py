@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+# Run many program/data-file jobs across a pool of worker processes.
+#
+# The manifest is a JSON list of jobs, each a mapping like:
+#
+#   {
+#     "name": "sum-100",
+#     "program": "challenge4_example1.exa",
+#     "files": ["100"],
+#     "expected": {"X": 6, "T": 1, "files": {"200": [6]}},
+#     "max_cycles": 10000,
+#     "timeout": 5,
+#     "detect_loops": true
+#   }
+#
+# Only "program" is required. With "detect_loops", a job caught
+# repeating itself forever stops with the status "loop" instead of
+# running until its timeout or cycle limit. Paths are relative to the directory
+# holding the manifest. Workers keep the programs and data files they
+# have read, so jobs that share inputs do not read them again.
+
+import argparse
+import concurrent.futures
+import csv
+import json
+import os.path
+import signal
+import sys
+import time
+
+import exa
+import exacow
+import exaloop
+import exatrace
+
+
+class JobTimeout(Exception):
+    pass
+
+
+# Per-worker caches of program source and data files, keyed by path.
+# The data files are exacow.BaseFile objects, so every job that uses
+# one gets its own copy-on-write view of it.
+_programs = {}
+_data_files = {}
+
+
+def _read_program(path):
+    if path not in _programs:
+        with open(path, 'r') as f:
+            _programs[path] = f.readlines()
+    return _programs[path]
+
+
+def _read_data_file(path):
+    if path not in _data_files:
+        with open(path, 'r') as f:
+            _data_files[path] = exacow.BaseFile(
+                int(os.path.basename(path)),
+                [int(line.strip()) for line in f])
+    return _data_files[path]
+
+
+def _on_alarm(signum, frame):
+    raise JobTimeout()
+
+
+def run_job(job):
+    # Run one job in the current process and return its result as a
+    # dict. This is the function the worker processes call.
+    name = job.get('name', job['program'])
+    result = {
+        'name': name,
+        'program': job['program'],
+        'status': 'ok',
+        'X': None,
+        'T': None,
+        'cycles': None,
+        'files': {},
+        'error': None,
+    }
+    start = time.perf_counter()
+
+    timeout = job.get('timeout')
+    if timeout:
+        signal.signal(signal.SIGALRM, _on_alarm)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        interp = exa.Interpreter(lambda msg: None, exatrace.NullSink())
+        for filename in job.get('files', []):
+            file_id = int(os.path.basename(filename))
+            interp.add_file(file_id, _read_data_file(filename))
+        state = interp.run(
+            _read_program(job['program']),
+            compiled=job.get('compiled', True),
+            max_cycles=job.get('max_cycles'),
+            loops=exaloop.LoopDetector() if job.get('detect_loops') else None,
+        )
+    except JobTimeout:
+        result['status'] = 'timeout'
+        result['error'] = 'Timed out after {} seconds'.format(timeout)
+    except exaloop.InfiniteLoop as err:
+        result['status'] = 'loop'
+        result['error'] = str(err)
+    except Exception as err:
+        result['status'] = 'error'
+        result['error'] = '{}: {}'.format(err.__class__.__name__, err)
+    else:
+        result['X'] = state.X
+        result['T'] = state.T
+        result['cycles'] = state.cycles
+        result['files'] = {
+            str(file_id): f.get_content()
+            for file_id, f in sorted(state.get_files().items())
+        }
+        mismatches = check_expected(job.get('expected'), result)
+        if mismatches:
+            result['status'] = 'mismatch'
+            result['error'] = '; '.join(mismatches)
+    finally:
+        if timeout:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+    result['elapsed'] = time.perf_counter() - start
+    return result
+
+
+def check_expected(expected, result):
+    mismatches = []
+    if not expected:
+        return mismatches
+    for reg in ('X', 'T'):
+        if reg in expected and expected[reg] != result[reg]:
+            mismatches.append('{}={} expected {}'.format(
+                reg, result[reg], expected[reg]))
+    for file_id, content in sorted(expected.get('files', {}).items()):
+        actual = result['files'].get(str(file_id))
+        if actual != content:
+            mismatches.append('file {}={} expected {}'.format(
+                file_id, actual, content))
+    return mismatches
+
+
+def load_manifest(filename, defaults=None):
+    with open(filename, 'r') as f:
+        jobs = json.load(f)
+    base = os.path.dirname(os.path.abspath(filename))
+    loaded = []
+    for job in jobs:
+        job = dict(defaults or {}, **job)
+        job['program'] = os.path.join(base, job['program'])
+        job['files'] = [os.path.join(base, name) for name in job.get('files', [])]
+        loaded.append(job)
+    return loaded
+
+
+def run_jobs(jobs, workers=None):
+    # Returns the results in the same order as jobs.
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(run_job, jobs, chunksize=4))
+
+
+def write_json(results, output):
+    json.dump(results, output, indent=2)
+    output.write('\n')
+
+
+def write_csv(results, output):
+    fields = ['name', 'program', 'status', 'X', 'T', 'cycles', 'elapsed',
+              'files', 'error']
+    writer = csv.DictWriter(output, fields, extrasaction='ignore')
+    writer.writeheader()
+    for result in results:
+        row = dict(result)
+        row['files'] = json.dumps(result['files'], sort_keys=True)
+        writer.writerow(row)
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('manifest')
+    p.add_argument('-j', '--workers', type=int, default=None,
+                   help='number of worker processes (default: one per CPU)')
+    p.add_argument('--max-cycles', type=int, default=None,
+                   help='cycle limit for jobs that do not set their own')
+    p.add_argument('--timeout', type=float, default=None,
+                   help='timeout in seconds for jobs that do not set their own')
+    p.add_argument('--detect-loops', action='store_true', default=False,
+                   help='stop jobs caught repeating themselves forever')
+    p.add_argument('--format', choices=['json', 'csv'], default='json')
+    p.add_argument('-o', '--output', default=None,
+                   help='write the summary to a file instead of stdout')
+    args = p.parse_args()
+
+    defaults = {}
+    if args.max_cycles is not None:
+        defaults['max_cycles'] = args.max_cycles
+    if args.timeout is not None:
+        defaults['timeout'] = args.timeout
+    if args.detect_loops:
+        defaults['detect_loops'] = True
+
+    jobs = load_manifest(args.manifest, defaults)
+    results = run_jobs(jobs, args.workers)
+
+    writer = write_json if args.format == 'json' else write_csv
+    if args.output:
+        with open(args.output, 'w', newline='') as f:
+            writer(results, f)
+    else:
+        writer(results, sys.stdout)
+
+    failed = [r for r in results if r['status'] != 'ok']
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+
+# Benchmark the implementations against each other.
+#
+# Each implementation (exa.py and exaf.py in their different modes, and
+# exa.go when a Go toolchain is available) runs a fixed set of
+# workloads as a separate process:
+#
+#   math       challenge1.exa, straight-line statements
+#   factorial  challenge3_example1.exa, a short loop
+#   loop       a loop of about 60,000 cycles
+#   scan-N     challenge4_example1.exa summing a file of N values
+#
+# For each run we report the wall time (the best of --repeat runs), the
+# startup time of the implementation on a one-statement program, cycles
+# per second after taking out the startup time, and the peak RSS, which
+# is sampled from /proc while the process runs. The cycle counts come
+# from running the workloads with exa.Interpreter.
+#
+# The results can be written as JSON with -o and compared against an
+# earlier results file with --baseline. Runs that got slower by more
+# than --threshold are reported as regressions and make the exit
+# status 1.
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import exa
+import exatrace
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+GO_PACKAGE = 'github.com/dhellmann/pyatl_exa_challenge'
+
+# Each run parses its program, so the repeats measure the same work and
+# nothing is written to the program cache.
+PYTHON_IMPLEMENTATIONS = {
+    'exa': ('exa.py', ['-q', '--no-cache']),
+    'exa-compiled': ('exa.py', ['-q', '-c', '--no-cache']),
+    'exaf': ('exaf.py', ['-q', '--no-cache']),
+    'exaf-encoded': ('exaf.py', ['-q', '-e', '--no-cache']),
+}
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+LOOP_PROGRAM = '''\
+COPY 9999 T
+MARK LOOP
+MULI X 3 X
+MODI X 1000 X
+ADDI X T X
+SUBI T 1 T
+TJMP LOOP
+'''
+
+STARTUP_PROGRAM = 'COPY 1 X\n'
+
+
+def build_go(workdir):
+    # Build exa.go into workdir and return the path to the binary, or
+    # None if there is no Go toolchain or the build fails. exa.go
+    # imports the package by its GOPATH import path, so the build uses
+    # a GOPATH with a link back to this directory.
+    go = shutil.which('go')
+    if go is None:
+        return None
+    gopath = os.path.join(workdir, 'gopath')
+    link = os.path.join(gopath, 'src', GO_PACKAGE)
+    os.makedirs(os.path.dirname(link))
+    os.symlink(HERE, link)
+    binary = os.path.join(workdir, 'exa-go')
+    env = dict(os.environ, GOPATH=gopath, GO111MODULE='off', GOFLAGS='')
+    try:
+        subprocess.run(
+            [go, 'build', '-o', binary, './exa.go'],
+            cwd=link, env=env, check=True,
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        )
+    except subprocess.CalledProcessError as err:
+        print('Could not build exa.go, skipping it: {}'.format(
+            err.stderr.decode('utf-8', 'replace').strip()), file=sys.stderr)
+        return None
+    return binary
+
+
+def commands(implementations, go_binary):
+    # Return a mapping of implementation names to functions that build
+    # the command line for a program and its data files.
+    def python_command(script, flags):
+        def command(program, files):
+            cmd = [sys.executable, os.path.join(HERE, script)] + flags
+            cmd.append(program)
+            for filename in files:
+                cmd.extend(['-f', filename])
+            return cmd
+        return command
+
+    def go_command(program, files):
+        return [go_binary, program] + files
+
+    result = {}
+    for name in implementations:
+        if name == 'go':
+            if go_binary is not None:
+                result[name] = go_command
+        else:
+            result[name] = python_command(*PYTHON_IMPLEMENTATIONS[name])
+    return result
+
+
+def _write(filename, text):
+    with open(filename, 'w') as f:
+        f.write(text)
+    return filename
+
+
+def build_workloads(workdir, sizes):
+    # Return a list of (name, program, data files) for the workloads,
+    # writing the generated ones into workdir.
+    workloads = [
+        ('math', os.path.join(HERE, 'challenge1.exa'), []),
+        ('factorial', os.path.join(HERE, 'challenge3_example1.exa'), []),
+        ('loop', _write(os.path.join(workdir, 'loop.exa'), LOOP_PROGRAM), []),
+    ]
+    for size in sizes:
+        data_dir = os.path.join(workdir, 'scan-{}'.format(size))
+        os.mkdir(data_dir)
+        data_file = _write(
+            os.path.join(data_dir, '100'),
+            ''.join('{}\n'.format(i % 10) for i in range(size)),
+        )
+        workloads.append((
+            'scan-{}'.format(size),
+            os.path.join(HERE, 'challenge4_example1.exa'),
+            [data_file],
+        ))
+    return workloads
+
+
+def count_cycles(program, files):
+    interp = exa.Interpreter(lambda message: None, exatrace.NullSink())
+    for filename in files:
+        with open(filename, 'r') as f:
+            interp.load_data_file(int(os.path.basename(filename)), f)
+    with open(program, 'r') as f:
+        statements = f.readlines()
+    return interp.run(statements, compiled=True).cycles
+
+
+def _peak_rss(pid):
+    # The high-water mark of the process's memory, in KiB. ru_maxrss
+    # from wait4() cannot be used alone because a child starts with the
+    # high-water mark of the process that forked it.
+    try:
+        with open('/proc/{}/status'.format(pid), 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def measure(cmd, timeout):
+    # Run cmd and return its wall time and peak RSS in KiB, or None for
+    # the time if it did not finish.
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    deadline = start + timeout
+    peak = None
+    while True:
+        pid, status, usage = os.wait4(proc.pid, os.WNOHANG)
+        if pid:
+            break
+        if time.perf_counter() > deadline:
+            proc.kill()
+            os.wait4(proc.pid, 0)
+            return None, peak
+        peak = _peak_rss(proc.pid) or peak
+        time.sleep(0.001)
+    wall = time.perf_counter() - start
+    if peak is None:
+        # Gone before it could be sampled.
+        peak = usage.ru_maxrss
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        raise RuntimeError('{} exited with {}'.format(
+            ' '.join(cmd), proc.returncode))
+    return wall, peak
+
+
+def run_benchmarks(implementations, workloads, repeat=3, timeout=300):
+    results = []
+    cycles = {
+        name: count_cycles(program, files)
+        for name, program, files in workloads
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        startup_program = _write(os.path.join(tmp, 'startup.exa'),
+                                 STARTUP_PROGRAM)
+        for impl, command in implementations.items():
+            startups = []
+            for _ in range(repeat):
+                wall = measure(command(startup_program, []), timeout)[0]
+                if wall is None:
+                    break
+                startups.append(wall)
+            startup = min(startups) if len(startups) == repeat else None
+            for name, program, files in workloads:
+                walls = []
+                max_rss = 0
+                for _ in range(repeat):
+                    wall, rss = measure(command(program, files), timeout)
+                    max_rss = max(max_rss, rss or 0)
+                    if wall is None:
+                        break
+                    walls.append(wall)
+                wall = min(walls) if len(walls) == repeat else None
+                run_time = None
+                if wall is not None and startup is not None:
+                    run_time = wall - startup
+                results.append({
+                    'implementation': impl,
+                    'workload': name,
+                    'cycles': cycles[name],
+                    'wall': wall,
+                    'startup': startup,
+                    'cycles_per_sec': (
+                        cycles[name] / run_time
+                        if run_time is not None and run_time > 0 else None
+                    ),
+                    'max_rss_kb': max_rss,
+                })
+                print(format_result(results[-1]), file=sys.stderr)
+    return results
+
+
+def _format_time(seconds, width):
+    if seconds is None:
+        return '{:>{}}'.format('timeout', width + 1)
+    return '{:{}.3f}s'.format(seconds, width)
+
+
+def format_result(result):
+    wall = _format_time(result['wall'], 9)
+    startup = _format_time(result['startup'], 8)
+    if result['cycles_per_sec'] is None:
+        rate = '{:>14}'.format('-')
+    else:
+        rate = '{:14,.0f}'.format(result['cycles_per_sec'])
+    return '{:14} {:14} {:>11,} {} {} {} {:9,} KiB'.format(
+        result['implementation'], result['workload'], result['cycles'],
+        wall, startup, rate, result['max_rss_kb'])
+
+
+def find_regressions(results, baseline, threshold):
+    # Return (result, baseline result, ratio) for each run that is
+    # slower than in the baseline by more than threshold.
+    previous = {
+        (old['implementation'], old['workload']): old
+        for old in baseline['results']
+    }
+    regressions = []
+    for result in results:
+        old = previous.get((result['implementation'], result['workload']))
+        if old is None or old['wall'] is None:
+            continue
+        if result['wall'] is None:
+            regressions.append((result, old, None))
+            continue
+        ratio = result['wall'] / old['wall']
+        if ratio > 1 + threshold:
+            regressions.append((result, old, ratio))
+    return regressions
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('--impl', dest='implementations', action='append',
+                   choices=sorted(PYTHON_IMPLEMENTATIONS) + ['go'],
+                   help='implementation to run, may be repeated '
+                   '(default: all)')
+    p.add_argument('--no-go', action='store_true', default=False,
+                   help='do not build and run exa.go')
+    p.add_argument('--sizes', default=','.join(str(s) for s in DEFAULT_SIZES),
+                   help='comma-separated sizes of the data file to scan, '
+                   'up to 10000000')
+    p.add_argument('--repeat', type=int, default=3,
+                   help='runs of each workload, the fastest one counts')
+    p.add_argument('--timeout', type=float, default=300,
+                   help='seconds to let each run go before giving up')
+    p.add_argument('-o', dest='output', default=None,
+                   help='write the results to this JSON file')
+    p.add_argument('--baseline', default=None,
+                   help='results file to check for regressions against')
+    p.add_argument('--threshold', type=float, default=0.1,
+                   help='slowdown relative to the baseline that counts as '
+                   'a regression (default: 0.1)')
+    args = p.parse_args()
+
+    names = args.implementations or sorted(PYTHON_IMPLEMENTATIONS) + ['go']
+    if args.no_go and 'go' in names:
+        names.remove('go')
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+
+    with tempfile.TemporaryDirectory() as workdir:
+        go_binary = build_go(workdir) if 'go' in names else None
+        implementations = commands(names, go_binary)
+        workloads = build_workloads(workdir, sizes)
+        print('{:14} {:14} {:>11} {:>10} {:>9} {:>14} {:>13}'.format(
+            'implementation', 'workload', 'cycles', 'wall', 'startup',
+            'cycles/sec', 'max RSS'), file=sys.stderr)
+        results = run_benchmarks(implementations, workloads, args.repeat,
+                                 args.timeout)
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = find_regressions(results, baseline, args.threshold)
+        for result, old, ratio in regressions:
+            if ratio is None:
+                change = 'timed out'
+            else:
+                change = '{:.0%} slower'.format(ratio - 1)
+            print('REGRESSION {} {}: {} than the baseline ({:.3f}s)'.format(
+                result['implementation'], result['workload'], change,
+                old['wall']))
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+# Binary data files.
+#
+# A binary data file is the 4 byte MAGIC header followed by the values
+# as signed 16-bit little-endian integers, 2 bytes per value. Values
+# are kept to the range of EXA integers, [-9999, 9999], like the values
+# of text data files. The
+# interpreters recognize binary files by their header, so they are
+# named with the file id like text data files.
+#
+# MappedFile memory-maps a binary file instead of reading it, so only
+# the parts a program touches are loaded, and each value is checked as
+# it is read. Writes go to an in-memory overlay, and flush() copies
+# them back to the file.
+
+import argparse
+import array
+import mmap
+import os
+import sys
+
+
+MAGIC = b'EXA\x10'
+HEADER_SIZE = len(MAGIC)
+VALUE_SIZE = 2
+MIN_VALUE = -9999
+MAX_VALUE = 9999
+
+
+def is_binary(filename):
+    with open(filename, 'rb') as f:
+        return f.read(HEADER_SIZE) == MAGIC
+
+
+def _check_value(val, where):
+    if not (MIN_VALUE <= val <= MAX_VALUE):
+        raise RuntimeError(
+            'Integer {} {} out of range [{}, {}]'.format(
+                val, where, MIN_VALUE, MAX_VALUE))
+
+
+def _check_values(values, where):
+    if values and not (MIN_VALUE <= min(values) and
+                       max(values) <= MAX_VALUE):
+        # Find the value that is out of range, for the message.
+        for num, val in enumerate(values):
+            _check_value(val, 'at position {} {}'.format(num, where))
+
+
+def write_values(filename, values):
+    _check_values(values, 'for {}'.format(filename))
+    data = array.array('h', values)
+    with open(filename, 'wb') as f:
+        f.write(MAGIC)
+        data.tofile(f)
+
+
+def read_values(filename):
+    data = array.array('h')
+    with open(filename, 'rb') as f:
+        if f.read(HEADER_SIZE) != MAGIC:
+            raise RuntimeError('{} is not a binary data file'.format(filename))
+        data.frombytes(f.read())
+    values = data.tolist()
+    _check_values(values, 'of {}'.format(filename))
+    return values
+
+
+def text_to_binary(src, dest):
+    with open(src, 'r') as f:
+        values = []
+        for num, line in enumerate(f):
+            try:
+                values.append(int(line.strip()))
+            except ValueError:
+                raise RuntimeError('Invalid integer {} on line {} of {}'.format(
+                    line.strip(), num, src))
+    write_values(dest, values)
+
+
+def binary_to_text(src, dest):
+    values = read_values(src)
+    with open(dest, 'w') as f:
+        f.write(''.join('{}\n'.format(val) for val in values))
+
+
+class MappedFile:
+
+    def __init__(self, file_id, filename):
+        if sys.byteorder != 'little':
+            raise RuntimeError(
+                'Binary data files can only be mapped on little-endian hosts')
+        self._id = file_id
+        self._filename = filename
+        self._cursor = 0
+        self._map = None
+        self.version = 0
+        self._open()
+
+    def _open(self):
+        with open(self._filename, 'rb') as f:
+            if f.read(HEADER_SIZE) != MAGIC:
+                raise RuntimeError('{} is not a binary data file'.format(
+                    self._filename))
+            size = os.fstat(f.fileno()).st_size
+            if size > HEADER_SIZE:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._values = memoryview(self._map)[HEADER_SIZE:].cast('h')
+            else:
+                # Empty files cannot be mapped.
+                self._map = None
+                self._values = []
+        self._mapped_length = len(self._values)
+        # Values written over the mapped part of the file, by position,
+        # and values written past its end.
+        self._overlay = {}
+        self._appended = []
+
+    def __len__(self):
+        return self._mapped_length + len(self._appended)
+
+    def _get(self, pos):
+        if pos >= self._mapped_length:
+            return self._appended[pos - self._mapped_length]
+        if pos in self._overlay:
+            return self._overlay[pos]
+        return self._values[pos]
+
+    def at_eof(self):
+        return (self._cursor + 1) > len(self)
+
+    def seek(self, offset):
+        dest = self._cursor + offset
+        if dest < 0:
+            dest = 0
+        if (dest + 1) > len(self):
+            dest = len(self)
+        self._cursor = dest
+
+    def read(self, line_num=None):
+        if self._cursor >= len(self):
+            message = 'Read past the end of file {} at position {}'.format(
+                self._id, self._cursor)
+            if line_num is not None:
+                message += ' on line {}'.format(line_num)
+            raise RuntimeError(message)
+        response = self._get(self._cursor)
+        if not (MIN_VALUE <= response <= MAX_VALUE):
+            _check_value(response, 'at position {} of {}'.format(
+                self._cursor, self._filename))
+        self._cursor += 1
+        return response
+
+    def write(self, val, line_num=None):
+        _check_value(val, 'written to file {}'.format(self._id))
+        self.version += 1
+        pos = self._cursor
+        if pos < self._mapped_length:
+            self._overlay[pos] = val
+        elif pos - self._mapped_length < len(self._appended):
+            self._appended[pos - self._mapped_length] = val
+        else:
+            self._appended.append(val)
+        self._cursor += 1
+
+    def tell(self):
+        return self._cursor
+
+    def get_content(self):
+        content = list(self._values)
+        _check_values(content, 'of {}'.format(self._filename))
+        for pos, val in self._overlay.items():
+            content[pos] = val
+        content.extend(self._appended)
+        return content
+
+    def is_modified(self):
+        return bool(self._overlay or self._appended)
+
+    def flush(self):
+        # Write the overlay back to the file, then map it again so the
+        # new values are read from there. The cursor stays where it is.
+        if not self.is_modified():
+            return
+        with open(self._filename, 'r+b') as f:
+            for pos, val in sorted(self._overlay.items()):
+                f.seek(HEADER_SIZE + pos * VALUE_SIZE)
+                f.write(array.array('h', [val]).tobytes())
+            f.seek(HEADER_SIZE + self._mapped_length * VALUE_SIZE)
+            array.array('h', self._appended).tofile(f)
+        self.close()
+        self._open()
+
+    def close(self):
+        if self._map is not None:
+            self._values.release()
+            self._map.close()
+            self._map = None
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(
+        description='Convert data files between the text and binary formats.')
+    p.add_argument('direction', choices=['to-binary', 'to-text'])
+    p.add_argument('src')
+    p.add_argument('dest')
+    args = p.parse_args()
+
+    if args.direction == 'to-binary':
+        text_to_binary(args.src, args.dest)
+    else:
+        binary_to_text(args.src, args.dest)
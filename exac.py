@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+
+# Translate a parsed EXA program to Python source code.
+#
+# The program is split into basic blocks, each starting at a label (or
+# after a jump) and running until the next jump. The registers and the
+# open file become local variables of one generated function, and the
+# blocks become branches of a loop that dispatches on the number of the
+# block to run next. A block that only jumps back to itself is emitted
+# as an inner while loop, so tight loops run as plain Python. Every
+# statement takes a cycle, so each block adds its length to the cycle
+# count as it starts.
+
+JUMP_CMDS = set(['JUMP', 'TJMP', 'FJMP'])
+
+MATH_OPERATORS = {
+    'ADDI': '+',
+    'SUBI': '-',
+    'MULI': '*',
+    'DIVI': '//',
+    'MODI': '%',
+}
+
+TEST_OPERATORS = {
+    '>': '>',
+    '<': '<',
+    '=': '==',
+}
+
+REGISTERS = set(['X', 'T'])
+
+FUNCTION_NAME = 'exa_program'
+
+
+class _Block:
+
+    def __init__(self, num, start):
+        self.num = num
+        self.start = start
+        self.statements = []
+
+
+class _Translator:
+
+    def __init__(self, program, labels, pass_line_num):
+        self._program = program
+        self._labels = labels
+        self._pass_line_num = pass_line_num
+        self._lines = []
+        self._blocks = self._find_blocks()
+        self._block_at = {b.start: b.num for b in self._blocks}
+
+    def _find_blocks(self):
+        # Blocks start at every label, which is usually a MARK but may
+        # be any statement in an optimized program.
+        leaders = set([0])
+        leaders.update(self._labels.values())
+        for i, (line_num, tokens) in enumerate(self._program):
+            if tokens[0] in JUMP_CMDS:
+                leaders.add(i + 1)
+        blocks = []
+        for i, stmt in enumerate(self._program):
+            if i in leaders:
+                blocks.append(_Block(len(blocks), i))
+            blocks[-1].statements.append(stmt)
+        return blocks
+
+    def _emit(self, indent, line):
+        self._lines.append('    ' * indent + line)
+
+    def _line_arg(self, line_num):
+        if self._pass_line_num:
+            return str(line_num)
+        return ''
+
+    def _require_file(self, indent, line_num):
+        self._emit(indent, 'if f is None:')
+        self._emit(indent + 1,
+                   'raise RuntimeError({!r})'.format(
+                       'No open file on line {}'.format(line_num)))
+
+    def _value(self, indent, tok, line_num):
+        # Return an expression for an operand, emitting any checks it
+        # needs first.
+        if tok in REGISTERS:
+            return tok
+        if tok == 'F':
+            self._require_file(indent, line_num)
+            return 'f.read({})'.format(self._line_arg(line_num))
+        try:
+            val = int(tok)
+        except ValueError:
+            raise RuntimeError('Invalid input value {} on line {}'.format(
+                tok, line_num))
+        if not (-9999 <= val <= 9999):
+            raise RuntimeError(
+                'Integer {} out of range [-9999, 9999] on line {}'.format(
+                    val, line_num))
+        return str(val)
+
+    def _store(self, indent, tok, expr, line_num):
+        if tok in REGISTERS:
+            self._emit(indent, '{} = {}'.format(tok, expr))
+        elif tok == 'F':
+            self._require_file(indent, line_num)
+            line_arg = self._line_arg(line_num)
+            if line_arg:
+                line_arg = ', ' + line_arg
+            self._emit(indent, 'f.write({}{})'.format(expr, line_arg))
+        else:
+            raise RuntimeError('Invalid storage address {} on line {}'.format(
+                tok, line_num))
+
+    def _target(self, label, line_num):
+        if label not in self._labels:
+            raise RuntimeError('Invalid label {} in jump on line {}'.format(
+                label, line_num))
+        # A label at the end of the program has no block, and jumping
+        # to it ends the program.
+        return self._block_at.get(self._labels[label], len(self._blocks))
+
+    def _statement(self, indent, line_num, tokens):
+        self._emit(indent, '# {:3} {}'.format(line_num, ' '.join(tokens)))
+        cmd = tokens[0]
+
+        if cmd == 'MARK':
+            pass
+
+        elif cmd == 'COPY':
+            expr = self._value(indent, tokens[1], line_num)
+            self._store(indent, tokens[2], expr, line_num)
+
+        elif cmd in MATH_OPERATORS:
+            a = self._value(indent, tokens[1], line_num)
+            b = self._value(indent, tokens[2], line_num)
+            expr = '{} {} {}'.format(a, MATH_OPERATORS[cmd], b)
+            self._store(indent, tokens[3], expr, line_num)
+
+        elif cmd == 'TEST':
+            if tokens[1] == 'EOF':
+                self._require_file(indent, line_num)
+                self._emit(indent, 'T = 1 if f.at_eof() else 0')
+            else:
+                a = self._value(indent, tokens[1], line_num)
+                b = self._value(indent, tokens[3], line_num)
+                try:
+                    op = TEST_OPERATORS[tokens[2]]
+                except KeyError:
+                    raise RuntimeError('Unknown operator {} on line {}'.format(
+                        tokens[2], line_num))
+                self._emit(indent, 'T = 1 if {} {} {} else 0'.format(a, op, b))
+
+        elif cmd == 'GRAB':
+            expr = self._value(indent, tokens[1], line_num)
+            self._emit(indent, 'file_id = {}'.format(expr))
+            self._emit(indent, 'f = files.get(file_id)')
+            self._emit(indent, 'if f is None:')
+            self._emit(indent + 1, 'f = files[file_id] = new_file(file_id)')
+
+        elif cmd == 'DROP':
+            self._emit(indent, 'if f is None:')
+            self._emit(indent + 1,
+                       'raise RuntimeError({!r})'.format(
+                           'Dropped when no file was open on line {}'.format(
+                               line_num)))
+            self._emit(indent, 'f = None')
+            self._emit(indent, 'file_id = None')
+
+        elif cmd == 'FILE':
+            self._store(indent, tokens[1], 'file_id', line_num)
+
+        elif cmd == 'SEEK':
+            expr = self._value(indent, tokens[1], line_num)
+            self._require_file(indent, line_num)
+            self._emit(indent, 'f.seek({})'.format(expr))
+
+        else:
+            raise RuntimeError('Unknown statement on line {}: {}'.format(
+                line_num, tokens))
+
+    def _block(self, block):
+        self._emit(2, 'if block == {}:'.format(block.num))
+        body = block.statements
+        last_line_num, last = body[-1]
+        cmd = last[0]
+
+        if cmd in JUMP_CMDS:
+            body = body[:-1]
+            target = self._target(last[1], last_line_num)
+        else:
+            target = None
+
+        if cmd in ('TJMP', 'FJMP') and target == block.num:
+            # A block that branches back to its own start is a loop
+            # that can run without going through the dispatcher.
+            cond = 'not T' if cmd == 'TJMP' else 'T'
+            self._emit(3, 'while True:')
+            self._emit(4, 'cycles += {}'.format(len(block.statements)))
+            for line_num, tokens in body:
+                self._statement(4, line_num, tokens)
+            self._emit(4, '# {:3} {}'.format(last_line_num, ' '.join(last)))
+            self._emit(4, 'if {}:'.format(cond))
+            self._emit(5, 'break')
+            self._emit(3, 'block = {}'.format(block.num + 1))
+            return
+
+        self._emit(3, 'cycles += {}'.format(len(block.statements)))
+        for line_num, tokens in body:
+            self._statement(3, line_num, tokens)
+
+        if target is None:
+            self._emit(3, 'block = {}'.format(block.num + 1))
+            return
+
+        self._emit(3, '# {:3} {}'.format(last_line_num, ' '.join(last)))
+        if cmd == 'JUMP':
+            self._emit(3, 'block = {}'.format(target))
+            self._emit(3, 'continue')
+            return
+
+        cond = 'T' if cmd == 'TJMP' else 'not T'
+        self._emit(3, 'if {}:'.format(cond))
+        self._emit(4, 'block = {}'.format(target))
+        self._emit(4, 'continue')
+        self._emit(3, 'block = {}'.format(block.num + 1))
+
+    def translate(self):
+        self._emit(0, 'def {}(files, new_file):'.format(FUNCTION_NAME))
+        self._emit(1, 'X = 0')
+        self._emit(1, 'T = 0')
+        self._emit(1, 'f = None')
+        self._emit(1, 'file_id = None')
+        self._emit(1, 'cycles = 0')
+        self._emit(1, 'block = 0')
+        self._emit(1, 'while True:')
+        for block in self._blocks:
+            self._block(block)
+        # Falling out of the last block ends the program.
+        self._emit(2, 'break')
+        self._emit(1, 'return X, T, file_id, cycles')
+        return '\n'.join(self._lines) + '\n'
+
+
+def transpile(program, labels, pass_line_num=False):
+    # program is a list of (line_num, tokens) pairs and labels maps
+    # each MARK label to its statement index, as returned by
+    # exaf.parse_program(). Set pass_line_num when the File objects
+    # expect a line number in their read() and write() calls, like
+    # the ones in exa.py.
+    return _Translator(program, labels, pass_line_num).translate()
+
+
+def compile_source(source, filename='<exa>'):
+    namespace = {}
+    exec(compile(source, filename, 'exec'), namespace)
+    return namespace[FUNCTION_NAME]
+
+
+def run_transpiled(program, labels, files, new_file, pass_line_num=False,
+                   dump_source=None):
+    # Run the program against files, a dict mapping ids to File
+    # objects, calling new_file(file_id) to create a file that does not
+    # exist when it is grabbed. Returns the final X and T values, the
+    # id of the file that was open at the end and the number of cycles
+    # run.
+    source = transpile(program, labels, pass_line_num)
+    if dump_source is not None:
+        dump_source(source)
+    func = compile_source(source)
+    return func(files, new_file)
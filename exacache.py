@@ -0,0 +1,268 @@
+# Caches of parsed programs and of program results, kept between runs.
+#
+# Parsing a large program, and optimizing it, can take much longer than
+# running it. The interpreters store the validated program, as its list
+# of (line_num, tokens) pairs and its dict of labels, in a file named
+# for a hash of the program source, the parse options and the source of
+# the modules that did the parsing, so changing the interpreter makes
+# the old entries unused. Entries are marshaled and compressed.
+#
+# ResultCache is an opt-in cache of the final registers and files of a
+# run, keyed by the program source and the content of its data files.
+# Its entries are kept in versions/<hash>, a directory for the version
+# of the interpreter modules, and the directories of other versions
+# there are removed when it is opened. Nothing else in the directory is
+# touched. The hits and misses are counted in stats.json.
+#
+# The caches live in $XDG_CACHE_HOME/exa, or ~/.cache/exa. Reading an
+# entry marks it as recently used, and when the entries take up more
+# than max_bytes the least recently used ones are removed.
+
+import fcntl
+import gc
+import glob
+import hashlib
+import json
+import marshal
+import os
+import shutil
+import zlib
+
+
+FORMAT = 1
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+_versions = {}
+
+
+def default_directory():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'exa')
+
+
+def default_results_directory():
+    return os.path.join(default_directory(), 'results')
+
+
+def module_version(*filenames):
+    # A hash of the source of the modules that parse programs.
+    key = tuple(filenames)
+    if key not in _versions:
+        h = hashlib.sha256()
+        for filename in filenames:
+            with open(filename, 'rb') as f:
+                h.update(f.read())
+        _versions[key] = h.hexdigest()
+    return _versions[key]
+
+
+def engine_version(entry_point):
+    # The version of the interpreter started from entry_point: a hash of
+    # every exa module next to it, since any of them can change a result.
+    here = os.path.dirname(os.path.abspath(entry_point))
+    modules = set(glob.glob(os.path.join(here, 'exa*.py')))
+    modules.add(os.path.abspath(entry_point))
+    return module_version(*sorted(modules))
+
+
+def _is_key(name):
+    # Whether name is one of the hashes the caches name things with.
+    return len(name) == 64 and all(c in '0123456789abcdef' for c in name)
+
+
+def _read_entry(path):
+    # Return the object marshaled into the entry at path, or None.
+    try:
+        with open(path, 'rb') as f:
+            data = zlib.decompress(f.read())
+        os.utime(path)
+    except (OSError, zlib.error):
+        return None
+    # Building the many small lists of a large program triggers the
+    # cycle collector over and over, and none of them are garbage.
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return marshal.loads(data)
+    except (EOFError, ValueError, TypeError):
+        return None
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _write_entry(path, value):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    data = zlib.compress(marshal.dumps(value), 1)
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _evict(directory, max_bytes):
+    # Only entries are removed, so other files in the directory are safe.
+    entries = []
+    total = 0
+    for name in os.listdir(directory):
+        if not _is_key(name):
+            continue
+        try:
+            st = os.stat(os.path.join(directory, name))
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, name))
+        total += st.st_size
+    entries.sort()
+    for mtime, size, name in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.unlink(os.path.join(directory, name))
+        except OSError:
+            pass
+        total -= size
+
+
+class ProgramCache:
+
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES):
+        self._directory = directory or default_directory()
+        self._max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, version, statements, *options):
+        h = hashlib.sha256()
+        h.update('{} {} {!r}\n'.format(FORMAT, version, options).encode('utf-8'))
+        for line in statements:
+            h.update(line.encode('utf-8'))
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self._directory, key)
+
+    def get(self, key):
+        # Return the (program, labels) stored for key, or None.
+        entry = _read_entry(self._path(key))
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        program, labels = entry
+        return program, labels
+
+    def put(self, key, program, labels):
+        _write_entry(
+            self._path(key),
+            ([(ln, list(tokens)) for ln, tokens in program], dict(labels)),
+        )
+        _evict(self._directory, self._max_bytes)
+
+
+class ResultCache:
+
+    def __init__(self, version, directory=None, max_bytes=DEFAULT_MAX_BYTES):
+        base = directory or default_results_directory()
+        versions = os.path.join(base, 'versions')
+        self._directory = os.path.join(versions, version)
+        self._max_bytes = max_bytes
+        self._stats_file = os.path.join(base, 'stats.json')
+        os.makedirs(self._directory, exist_ok=True)
+        # Results from other versions of the interpreter are stale.
+        for name in os.listdir(versions):
+            path = os.path.join(versions, name)
+            if name != version and _is_key(name) and os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+
+    def key(self, statements, filenames, *options):
+        h = hashlib.sha256()
+        h.update('{} {!r}\n'.format(FORMAT, options).encode('utf-8'))
+        for line in statements:
+            h.update(line.encode('utf-8'))
+        for filename in filenames:
+            # The file id comes from the name, so it is part of the key.
+            h.update('\0{}\0'.format(os.path.basename(filename)).encode('utf-8'))
+            with open(filename, 'rb') as f:
+                h.update(hashlib.sha256(f.read()).digest())
+        return h.hexdigest()
+
+    def get(self, key):
+        # Return the result stored for key, or None.
+        result = _read_entry(os.path.join(self._directory, key))
+        self._count('hits' if result is not None else 'misses')
+        return result
+
+    def put(self, key, result):
+        # result is a dict of plain values, with the files as a list of
+        # (file_id, content) pairs.
+        _write_entry(os.path.join(self._directory, key), result)
+        _evict(self._directory, self._max_bytes)
+
+    def _count(self, name):
+        with open(self._stats_file, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                stats = json.loads(f.read() or '{}')
+            except ValueError:
+                stats = {}
+            stats[name] = stats.get(name, 0) + 1
+            f.seek(0)
+            f.truncate()
+            json.dump(stats, f)
+
+    def stats(self):
+        try:
+            with open(self._stats_file, 'r') as f:
+                stats = json.load(f)
+        except (OSError, ValueError):
+            stats = {}
+        return {'hits': stats.get('hits', 0), 'misses': stats.get('misses', 0)}
+
+
+def add_arguments(parser):
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false',
+                        default=True,
+                        help='parse the program without the program cache')
+    parser.add_argument('--cache-dir', default=None,
+                        help='directory for the program cache '
+                        '(default: {})'.format(default_directory()))
+    parser.add_argument('--memo', action='store_true', default=False,
+                        help='reuse the results of an earlier run of the same '
+                        'program and data files')
+    parser.add_argument('--memo-dir', default=None,
+                        help='directory for saved results (default: {})'.format(
+                            default_results_directory()))
+    parser.add_argument('--memo-stats', action='store_true', default=False,
+                        help='print how often saved results were reused')
+
+
+def from_args(args):
+    if not args.use_cache:
+        return None
+    return ProgramCache(args.cache_dir)
+
+
+def memo_from_args(args, entry_point):
+    if not args.memo:
+        return None
+    # A saved result has no trace or other output of the run to print.
+    if getattr(args, 'verbose', False):
+        raise RuntimeError('--memo can only be used with -q')
+    # These need the program to really run.
+    for option, name in [('data_dir', '--data-dir'),
+                         ('trace_file', '--trace-file'),
+                         ('dump_source', '--dump-source'),
+                         ('report_opt', '--report-opt'),
+                         ('flush_binary', '--flush-binary'),
+                         ('profile', '--profile'),
+                         ('profile_json', '--profile-json'),
+                         ('record', '--record'),
+                         ('stream', '--stream'),
+                         ('stream_out', '--stream-out')]:
+        if getattr(args, option, None):
+            raise RuntimeError('--memo cannot be used with {}'.format(name))
+    return ResultCache(engine_version(entry_point), args.memo_dir)
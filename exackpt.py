@@ -0,0 +1,379 @@
+# Checkpoints of a running program.
+#
+# A Checkpointer saves the registers, the next statement, the cycle
+# count, the open file and every file's content and cursor to a
+# directory, so a run that is stopped can be resumed from where the
+# last checkpoint was taken instead of from the start. The interpreters
+# run the program in segments of cycles and offer to take a checkpoint
+# between them, every N cycles or when the process receives a signal.
+#
+# Each program gets its own subdirectory, named for a hash of the parsed
+# program, holding state.json and the file contents split into
+# compressed chunks named for their hash. While checkpointing, the
+# interpreters see the files through track(), which notes the chunks
+# each write lands in, so taking a checkpoint only encodes the chunks
+# written since the last one, and files that have not been written are
+# not read at all. Files that have never been written are not saved,
+# only their cursor, length and a hash of their content, so a run has
+# to be resumed with the same data files it started with.
+#
+# The checkpoint is removed when the program finishes.
+
+import array
+import collections
+import collections.abc
+import hashlib
+import json
+import os
+import shutil
+import signal
+import sys
+import zlib
+
+
+FORMAT = 2
+
+# Values in each chunk of a saved file.
+CHUNK_SIZE = 4096
+
+# Without a checkpoint interval, how often to look for a signal.
+POLL_CYCLES = 10000
+
+Snapshot = collections.namedtuple(
+    'Snapshot',
+    ['cycle', 'X', 'T', 'next_statement', 'file_id', 'files'],
+)
+
+# A saved file. content is None for a file that has never been written,
+# and digest is the hash of its content.
+SavedFile = collections.namedtuple(
+    'SavedFile',
+    ['file_id', 'content', 'cursor', 'length', 'version', 'digest'],
+)
+
+
+def program_hash(program):
+    # program is a list of (line_num, tokens) pairs.
+    text = json.dumps([FORMAT, [[ln, tokens] for ln, tokens in program]])
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def _encode_chunk(values):
+    data = array.array('q', values)
+    if sys.byteorder != 'little':
+        data.byteswap()
+    return zlib.compress(data.tobytes(), 1)
+
+
+def _decode_chunk(raw):
+    data = array.array('q')
+    data.frombytes(zlib.decompress(raw))
+    if sys.byteorder != 'little':
+        data.byteswap()
+    return data.tolist()
+
+
+def _content_hash(content):
+    h = hashlib.sha256()
+    for start in range(0, len(content), CHUNK_SIZE):
+        data = array.array('q', content[start:start + CHUNK_SIZE])
+        if sys.byteorder != 'little':
+            data.byteswap()
+        h.update(data.tobytes())
+    return h.hexdigest()
+
+
+def _file_items(files):
+    # A FileStore would load every file in its directory if iterated.
+    if hasattr(files, 'loaded_items'):
+        return files.loaded_items()
+    return sorted(files.items())
+
+
+def restore_files(snapshot, files, new_file):
+    # Put the saved files back into files, using new_file(file_id,
+    # content) to build the ones that had been written. The others must
+    # already be there, as they were when the checkpoint was taken.
+    for saved in snapshot.files:
+        if saved.content is None:
+            try:
+                data_file = files[saved.file_id]
+            except KeyError:
+                raise RuntimeError(
+                    'Cannot resume without data file {}'.format(saved.file_id))
+            content = data_file.get_content()
+            if (len(content) != saved.length or
+                    _content_hash(content) != saved.digest):
+                raise RuntimeError(
+                    'Data file {} has changed since the checkpoint was taken'.format(
+                        saved.file_id))
+        else:
+            data_file = new_file(saved.file_id, saved.content)
+            data_file.version = saved.version
+            files[saved.file_id] = data_file
+        data_file.seek(saved.cursor)
+
+
+class _TrackingFile:
+
+    def __init__(self, data_file, dirty):
+        self._file = data_file
+        self._dirty = dirty
+        # Only writes need noting, so the rest go straight to the file.
+        self.read = data_file.read
+        self.tell = data_file.tell
+        self.at_eof = data_file.at_eof
+        self.seek = data_file.seek
+
+    def write(self, val, *args):
+        self._dirty.add(self._file.tell() // CHUNK_SIZE)
+        return self._file.write(val, *args)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+class _TrackingFiles(collections.abc.MutableMapping):
+    # The files mapping seen by the interpreter while checkpointing.
+
+    def __init__(self, files, dirty):
+        self._files = files
+        self._dirty = dirty
+        self._wrapped = {}
+
+    def __contains__(self, file_id):
+        return file_id in self._files
+
+    def __len__(self):
+        return len(self._files)
+
+    def __iter__(self):
+        return iter(self._files)
+
+    def __getitem__(self, file_id):
+        data_file = self._files[file_id]
+        wrapped = self._wrapped.get(file_id)
+        if wrapped is None or wrapped._file is not data_file:
+            wrapped = self._wrapped[file_id] = _TrackingFile(
+                data_file, self._dirty.setdefault(file_id, set()))
+        return wrapped
+
+    def get(self, file_id, default=None):
+        # exaf looks up the open file for every operand, so the file
+        # wrapped before is returned without going through __getitem__.
+        wrapped = self._wrapped.get(file_id)
+        if wrapped is not None and wrapped._file is self._files.get(file_id):
+            return wrapped
+        if file_id not in self._files:
+            return default
+        return self[file_id]
+
+    def __setitem__(self, file_id, data_file):
+        self._files[file_id] = data_file
+
+    def __delitem__(self, file_id):
+        del self._files[file_id]
+        self._wrapped.pop(file_id, None)
+
+    def loaded_items(self):
+        return _file_items(self._files)
+
+
+class Checkpointer:
+
+    def __init__(self, directory, every=None, signum=None, resume=False):
+        self._directory = directory
+        self.every = every
+        self._signum = signum
+        self._resume = resume
+        self._requested = False
+        self._old_handler = None
+        self._path = None
+        self._last_cycle = 0
+        # file_id -> (file, version, saved entry) as of the last
+        # checkpoint, so unchanged files are not read again.
+        self._saved = {}
+        # file_id -> indexes of the chunks written since then.
+        self._dirty = {}
+        self._chunks = set()
+        self.saves = 0
+
+    def _request(self, signum, frame):
+        self._requested = True
+
+    def track(self, files):
+        # Return the files mapping the interpreter should use.
+        return _TrackingFiles(files, self._dirty)
+
+    def begin(self, program):
+        # Start checkpointing program, and return the snapshot to resume
+        # from or None.
+        self._path = os.path.join(self._directory, program_hash(program))
+        chunk_dir = os.path.join(self._path, 'chunks')
+        os.makedirs(chunk_dir, exist_ok=True)
+        self._chunks = set(os.listdir(chunk_dir))
+        if self._signum is not None:
+            self._old_handler = signal.signal(self._signum, self._request)
+        snapshot = self.load() if self._resume else None
+        if snapshot is not None:
+            self._last_cycle = snapshot.cycle
+        return snapshot
+
+    def finish(self, completed):
+        if self._signum is not None and self._old_handler is not None:
+            signal.signal(self._signum, self._old_handler)
+            self._old_handler = None
+        if completed and self._path is not None:
+            shutil.rmtree(self._path)
+            self._chunks = set()
+
+    def segments(self, start, stop=None):
+        # Yield ranges of cycles to run between chances to take a
+        # checkpoint.
+        step = self.every or POLL_CYCLES
+        while stop is None or start < stop:
+            end = start + step
+            if stop is not None:
+                end = min(end, stop)
+            yield range(start, end)
+            start = end
+
+    def due(self, cycle):
+        if self._requested:
+            return True
+        return (self.every is not None and
+                cycle - self._last_cycle >= self.every)
+
+    def _save_chunk(self, values):
+        raw = _encode_chunk(values)
+        name = hashlib.sha1(raw).hexdigest()
+        if name not in self._chunks:
+            with open(os.path.join(self._path, 'chunks', name), 'wb') as f:
+                f.write(raw)
+            self._chunks.add(name)
+        return name
+
+    def _save_file(self, file_id, data_file):
+        cached = self._saved.get(file_id)
+        dirty = self._dirty.get(file_id, set())
+        if cached is not None and cached[0] is not data_file:
+            cached = None
+        if cached is not None and cached[1] == data_file.version:
+            entry = dict(cached[2])
+            entry['cursor'] = data_file.tell()
+            return entry
+
+        content = data_file.get_content()
+        entry = {
+            'id': file_id,
+            'cursor': data_file.tell(),
+            'length': len(content),
+            'version': data_file.version,
+        }
+        count = (len(content) + CHUNK_SIZE - 1) // CHUNK_SIZE
+        if cached is not None and 'chunks' in cached[2] and dirty:
+            # Only the chunks written since the last checkpoint change.
+            names = cached[2]['chunks'][:count]
+            for index in sorted(dirty):
+                start = index * CHUNK_SIZE
+                name = self._save_chunk(content[start:start + CHUNK_SIZE])
+                if index < len(names):
+                    names[index] = name
+                elif index == len(names):
+                    names.append(name)
+                else:
+                    break
+            else:
+                if len(names) == count:
+                    entry['chunks'] = names
+        if 'chunks' not in entry and (data_file.version or not content):
+            entry['chunks'] = [
+                self._save_chunk(content[start:start + CHUNK_SIZE])
+                for start in range(0, len(content), CHUNK_SIZE)
+            ]
+        if 'chunks' not in entry:
+            entry['digest'] = _content_hash(content)
+        dirty.clear()
+        self._saved[file_id] = (data_file, data_file.version, entry)
+        return entry
+
+    def save(self, cycle, X, T, next_statement, file_id, files):
+        state = {
+            'format': FORMAT,
+            'cycle': cycle,
+            'X': X,
+            'T': T,
+            'next_statement': next_statement,
+            'file_id': file_id,
+            'files': [
+                self._save_file(fid, data_file)
+                for fid, data_file in _file_items(files)
+            ],
+        }
+        filename = os.path.join(self._path, 'state.json')
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(filename + '.tmp', filename)
+
+        # Remove chunks the new state does not use.
+        used = set()
+        for entry in state['files']:
+            used.update(entry.get('chunks', ()))
+        for name in self._chunks - used:
+            os.unlink(os.path.join(self._path, 'chunks', name))
+        self._chunks = used
+
+        self._requested = False
+        self._last_cycle = cycle
+        self.saves += 1
+
+    def load(self):
+        filename = os.path.join(self._path, 'state.json')
+        try:
+            with open(filename, 'r') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return None
+        if state.get('format') != FORMAT:
+            return None
+        files = []
+        for entry in state['files']:
+            content = None
+            if 'chunks' in entry:
+                content = []
+                for name in entry['chunks']:
+                    with open(os.path.join(self._path, 'chunks', name), 'rb') as f:
+                        content.extend(_decode_chunk(f.read()))
+            files.append(SavedFile(
+                entry['id'], content, entry['cursor'], entry['length'],
+                entry['version'], entry.get('digest'),
+            ))
+        return Snapshot(
+            state['cycle'], state['X'], state['T'], state['next_statement'],
+            state['file_id'], files,
+        )
+
+
+def add_arguments(parser):
+    parser.add_argument('--checkpoint-dir', default=None,
+                        help='save checkpoints of the run in this directory')
+    parser.add_argument('--checkpoint-every', type=int, default=None,
+                        help='cycles between checkpoints')
+    parser.add_argument('--checkpoint-signal', action='store_true',
+                        default=False,
+                        help='take a checkpoint when sent SIGUSR1')
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help='resume from the checkpoint for this program')
+
+
+def from_args(args):
+    if args.checkpoint_dir is None:
+        if args.checkpoint_every or args.checkpoint_signal or args.resume:
+            raise RuntimeError('Checkpoint options need --checkpoint-dir')
+        return None
+    return Checkpointer(
+        args.checkpoint_dir,
+        every=args.checkpoint_every,
+        signum=signal.SIGUSR1 if args.checkpoint_signal else None,
+        resume=args.resume,
+    )
@@ -0,0 +1,132 @@
+# Copy-on-write data files.
+#
+# A BaseFile holds the content of a data file split into chunks of
+# CHUNK_SIZE values, as tuples, so it never changes once it is built.
+# snapshot() returns a CowFile, a view of the content with its own
+# cursor that can be used like a File. Views share the chunks, and a
+# write copies only the chunk it lands in, so many runs can start from
+# the same inputs without reading them again or copying them first.
+#
+# Interpreter.run() and exaf.run_program() give each run a new view of
+# every BaseFile in their files, so what one run writes is not seen by
+# the next.
+
+import itertools
+
+
+CHUNK_BITS = 10
+CHUNK_SIZE = 1 << CHUNK_BITS
+CHUNK_MASK = CHUNK_SIZE - 1
+
+
+class BaseFile:
+
+    def __init__(self, file_id, content):
+        self._id = file_id
+        self._chunks = tuple(
+            tuple(content[start:start + CHUNK_SIZE])
+            for start in range(0, len(content), CHUNK_SIZE)
+        )
+        self._length = len(content)
+
+    def __len__(self):
+        return self._length
+
+    def get_content(self):
+        return list(itertools.chain.from_iterable(self._chunks))
+
+    def snapshot(self):
+        return CowFile(self._id, self._chunks, self._length)
+
+
+class CowFile:
+
+    def __init__(self, file_id, chunks, length):
+        self._id = file_id
+        self._chunks = chunks
+        self._length = length
+        self._cursor = 0
+        # Indexes of the chunks this view has copied, or None while it
+        # shares the sequence of chunks itself.
+        self._owned = None
+        # Counts writes, so callers can tell whether the file changed.
+        self.version = 0
+
+    def __len__(self):
+        return self._length
+
+    def at_eof(self):
+        return (self._cursor + 1) > self._length
+
+    def seek(self, offset):
+        dest = self._cursor + offset
+        if dest < 0:
+            dest = 0
+        if (dest + 1) > self._length:
+            dest = self._length
+        self._cursor = dest
+
+    def read(self, line_num=None):
+        # Only the last chunk can be short, so a position past the end
+        # is past the end of the chunks or of the last chunk.
+        pos = self._cursor
+        try:
+            val = self._chunks[pos >> CHUNK_BITS][pos & CHUNK_MASK]
+        except IndexError:
+            message = 'Read past the end of file {} at position {}'.format(
+                self._id, pos)
+            if line_num is not None:
+                message += ' on line {}'.format(line_num)
+            raise RuntimeError(message)
+        self._cursor = pos + 1
+        return val
+
+    def write(self, val, line_num=None):
+        self.version += 1
+        pos = self._cursor
+        index = pos >> CHUNK_BITS
+        if self._owned is None:
+            self._chunks = list(self._chunks)
+            self._owned = set()
+        if index not in self._owned:
+            if index < len(self._chunks):
+                self._chunks[index] = list(self._chunks[index])
+            else:
+                self._chunks.append([])
+            self._owned.add(index)
+        chunk = self._chunks[index]
+        offset = pos & CHUNK_MASK
+        if offset < len(chunk):
+            chunk[offset] = val
+        else:
+            # The cursor is at the end of the file.
+            chunk.append(val)
+            self._length += 1
+        self._cursor = pos + 1
+
+    def tell(self):
+        return self._cursor
+
+    def get_content(self):
+        return list(itertools.chain.from_iterable(self._chunks))
+
+    def snapshot(self):
+        # A new view of the content as it is now. From here on both
+        # views copy a chunk before writing to it.
+        self._owned = None
+        return CowFile(self._id, self._chunks, self._length)
+
+
+def snapshot_files(files):
+    # The files for one run: a new view of each BaseFile, and the other
+    # files as they are. When there is no BaseFile, or files is not a
+    # dict, such as an exastore.FileStore, files is returned unchanged.
+    if not isinstance(files, dict):
+        return files
+    if not any(isinstance(data_file, BaseFile) for data_file in files.values()):
+        return files
+    return {
+        file_id: (data_file.snapshot() if isinstance(data_file, BaseFile)
+                  else data_file)
+        for file_id, data_file in files.items()
+    }
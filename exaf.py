@@ -1,13 +1,26 @@
 #!/usr/bin/env python3
 
 import argparse
+import array
+import collections
 import operator
 import os.path
 
+import exabin
+import exacache
+import exacow
+import exackpt
+import exaloop
+import exaout
+import exaparse
+import exaprof
+import exarec
+import exastore
+import exastream
+import exatrace
+
 
 MATH_CMDS = set(['ADDI', 'SUBI', 'MULI', 'DIVI', 'MODI'])
-JUMP_CMDS = set(['MARK', 'JUMP', 'TJMP', 'FJMP'])
-REGISTER_NAMES = 'FTX'
 
 OPERATORS = {
     'ADDI': operator.add,
@@ -27,6 +40,8 @@ class File:
         self._id = file_id
         self._cursor = 0
         self._content = initial_data or []
+        # Counts writes, so callers can tell whether the file changed.
+        self.version = 0
 
     def at_eof(self):
         return (self._cursor + 1) > len(self._content)
@@ -52,6 +67,7 @@ class File:
         return response
 
     def write(self, val):
+        self.version += 1
         try:
             self._content[self._cursor] = val
             self._cursor += 1
@@ -59,104 +75,164 @@ class File:
             self._content.append(val)
             self._cursor = len(self._content)
 
+    def tell(self):
+        return self._cursor
+
     def get_content(self):
         return self._content
 
 
-def check_syntax(syntax, line_num, tokens):
-    if len(syntax) != len(tokens) - 1:
-        raise RuntimeError(
-            'Expected {} arguments to {} got {} on line {}: {}',
-            len(syntax), tokens[0], line_num, ' '.join(tokens))
-    for i, (syn, tok) in enumerate(zip(syntax, tokens[1:])):
-        if syn == 'R':
-            if tok not in REGISTER_NAMES:
-                raise RuntimeError(
-                    'Expected register name, found {} at position {} on line {}'.format(
-                        tok, i, line_num))
-        elif syn == 'R/N':
-            try:
-                int(tok)
-            except ValueError:
-                if tok not in REGISTER_NAMES:
-                    raise RuntimeError(
-                        'Expected register name or integer, found {} at position {} on line {}'.format(
-                            tok, i, line_num))
-        elif syn == 'OP':
-            if tok not in OPERATORS:
-                raise RuntimeError(
-                    'Unrecognized operator {} at position {} on line {}, must be one of {}'.format(
-                        tok, i, line_num, list(OPERATORS.keys())))
-        elif syn == 'L':
-            # A label can be anything.
-            pass
-        else:
-            raise RuntimeError('Unknown syntax instruction {}'.format(syn))
+# Opcodes and operand kinds for the encoded form of a program.
+(OP_COPY, OP_ADDI, OP_SUBI, OP_MULI, OP_DIVI, OP_MODI, OP_TEST, OP_TEST_EOF,
+ OP_JUMP, OP_TJMP, OP_FJMP, OP_MARK, OP_GRAB, OP_DROP, OP_SEEK,
+ OP_FILE) = range(16)
+
+OPCODES = {
+    'COPY': OP_COPY,
+    'ADDI': OP_ADDI,
+    'SUBI': OP_SUBI,
+    'MULI': OP_MULI,
+    'DIVI': OP_DIVI,
+    'MODI': OP_MODI,
+    'TEST': OP_TEST,
+    'JUMP': OP_JUMP,
+    'TJMP': OP_TJMP,
+    'FJMP': OP_FJMP,
+    'MARK': OP_MARK,
+    'GRAB': OP_GRAB,
+    'DROP': OP_DROP,
+    'SEEK': OP_SEEK,
+    'FILE': OP_FILE,
+}
 
+KIND_NONE, KIND_NUM, KIND_REG, KIND_FILE = range(4)
+
+# Register slots used by the encoded program.
+REG_T, REG_X = range(2)
+REGISTER_SLOTS = {'T': REG_T, 'X': REG_X}
+
+# The comparison operators used by TEST, stored in the operand slot
+# of the encoded statement.
+TEST_OPERATORS = ['>', '<', '=']
+
+EncodedProgram = collections.namedtuple(
+    'EncodedProgram',
+    ['program', 'opcodes', 'a_kinds', 'a_vals', 'b_kinds', 'b_vals',
+     'd_kinds', 'd_vals', 'extras'],
+)
+
+
+def parse_program(statements, encoded=False, optimize=False, report=None,
+                  cache=None):
+    # cache is an exacache.ProgramCache to load the parsed program from,
+    # or save it to. It is not used when the optimizer is reporting.
+    if cache is not None and report is None:
+        # The key is a hash of the whole source, which is then parsed.
+        if not isinstance(statements, list):
+            statements = list(statements)
+        modules = [__file__, exaparse.__file__]
+        if optimize:
+            import exaopt
+            modules.append(exaopt.__file__)
+        key = cache.key(exacache.module_version(*modules), statements,
+                        'exaf', optimize)
+        cached = cache.get(key)
+        if cached is None:
+            cached = _parse(statements, optimize, report)
+            cache.put(key, *cached)
+        tokenized, labels = cached
+    else:
+        tokenized, labels = _parse(statements, optimize, report)
+
+    if encoded:
+        return encode_program(tokenized, labels), labels
+    return tokenized, labels
+
+
+def _parse(statements, optimize, report):
+    tokenized, labels = exaparse.parse(statements)
+
+    if optimize:
+        import exaopt
+        tokenized, labels = exaopt.optimize(tokenized, labels, report)
+
+    return tokenized, labels
 
-def parse_program(statements):
-    # clean up extra white space, eliminate blank lines, ignore
-    # comments, and parse each line into tokens
-    tokenized = [
-        (ln, stmt.strip().split())
-        for ln, stmt in enumerate(line.strip() for line in statements)
-        if stmt and not stmt.startswith('#')
-    ]
 
-    # check the syntax of all the statements, and record the locations
-    # of the labels
-    labels = {}
-    for i, (ln, tokens) in enumerate(tokenized):
-        cmd = tokens[0]
+def encode_operand(tok):
+    if tok in REGISTER_SLOTS:
+        return KIND_REG, REGISTER_SLOTS[tok]
+    if tok == 'F':
+        return KIND_FILE, 0
+    return KIND_NUM, int(tok)
+
+
+def encode_program(program, labels):
+    # Convert a parsed program to parallel arrays of integers. Each
+    # statement becomes an opcode, up to two source operands and a
+    # destination operand (a kind and a value each), and an extra
+    # value holding the TEST operator or the index of a jump target
+    # (-1 when the label is unknown).
+    opcodes = array.array('b')
+    a_kinds = array.array('b')
+    a_vals = array.array('l')
+    b_kinds = array.array('b')
+    b_vals = array.array('l')
+    d_kinds = array.array('b')
+    d_vals = array.array('l')
+    extras = array.array('l')
+
+    for line_num, statement in program:
+        cmd = statement[0]
+        opcode = OPCODES[cmd]
+        a = b = dest = (KIND_NONE, 0)
+        extra = 0
 
         if cmd == 'COPY':
-            check_syntax(('R/N', 'R'), ln, tokens)
+            a = encode_operand(statement[1])
+            dest = encode_operand(statement[2])
 
         elif cmd in MATH_CMDS:
-            check_syntax(('R/N', 'R/N', 'R'), ln, tokens)
+            a = encode_operand(statement[1])
+            b = encode_operand(statement[2])
+            dest = encode_operand(statement[3])
 
         elif cmd == 'TEST':
-            if len(tokens) == 2:
-                if tokens[1] != 'EOF':
-                    raise RuntimeError(
-                        'Unrecognized test {} on line {}'.format(
-                            tokens[1], line_num))
+            if statement[1] == 'EOF':
+                opcode = OP_TEST_EOF
             else:
-                check_syntax(('R/N', 'OP', 'R/N'), ln, tokens)
+                a = encode_operand(statement[1])
+                extra = TEST_OPERATORS.index(statement[2])
+                b = encode_operand(statement[3])
 
-        elif cmd in JUMP_CMDS:
-            check_syntax(('L',), ln, tokens)
-            if cmd == 'MARK':
-                label = tokens[1]
-                if label in labels:
-                    raise RuntimeError(
-                        'Duplicate label {} on line {}'.format(label, line_num))
-                labels[label] = i
+        elif cmd in ('JUMP', 'TJMP', 'FJMP'):
+            extra = labels.get(statement[1], -1)
 
-        elif cmd == 'GRAB':
-            check_syntax(('R/N',), ln, tokens)
+        elif cmd in ('GRAB', 'SEEK'):
+            a = encode_operand(statement[1])
 
         elif cmd == 'FILE':
-            check_syntax(('R',), ln, tokens)
+            dest = encode_operand(statement[1])
 
-        elif cmd == 'SEEK':
-            check_syntax(('R/N',), ln, tokens)
+        opcodes.append(opcode)
+        a_kinds.append(a[0])
+        a_vals.append(a[1])
+        b_kinds.append(b[0])
+        b_vals.append(b[1])
+        d_kinds.append(dest[0])
+        d_vals.append(dest[1])
+        extras.append(extra)
 
-        elif cmd == 'DROP':
-            check_syntax((), ln, tokens)
-
-        else:
-            raise RuntimeError('Unrecognized command {} on line {}'.format(
-                cmd, ln))
-
-    return tokenized, labels
+    return EncodedProgram(
+        program, opcodes, a_kinds, a_vals, b_kinds, b_vals, d_kinds, d_vals,
+        extras)
 
 
 def get_rn(val, registers, current_file):
     if val in registers:
         return registers[val]
     if val == 'F':
-        if not current_file:
+        if current_file is None:
             raise RuntimeError('No open file')
         return current_file.read()
     return int(val)
@@ -177,7 +253,7 @@ def run_statement(line_num, statement, program_counter, registers, labels, file_
         dest = statement[2]
         if dest == 'F':
             current_file = files.get(file_id)
-            if not current_file:
+            if current_file is None:
                 raise RuntimeError('Writing to file before opening on line {}'.format(line_num))
             current_file.write(src)
         else:
@@ -189,12 +265,18 @@ def run_statement(line_num, statement, program_counter, registers, labels, file_
         b = get_rn(statement[2], registers, files.get(file_id))
         dest = statement[3]
         op = OPERATORS[cmd]
-        registers[dest] = op(a, b)
+        if dest == 'F':
+            current_file = files.get(file_id)
+            if current_file is None:
+                raise RuntimeError('Writing to file before opening on line {}'.format(line_num))
+            current_file.write(op(a, b))
+        else:
+            registers[dest] = op(a, b)
         program_counter += 1
 
     elif cmd == 'TEST':
         if statement[1] == 'EOF':
-            if not file_id:
+            if file_id is None:
                 raise RuntimeError('Testing EOF without an open file on line {}'.format(
                     line_num))
             if files[file_id].at_eof():
@@ -244,18 +326,94 @@ def run_statement(line_num, statement, program_counter, registers, labels, file_
 
     elif cmd == 'SEEK':
         current_file = files.get(file_id)
-        if not current_file:
+        if current_file is None:
             raise RuntimeError('No open file')
         offset = get_rn(statement[1], registers, current_file)
         current_file.seek(offset)
         program_counter += 1
 
+    elif cmd == 'FILE':
+        current_file = files.get(file_id)
+        if current_file is None:
+            raise RuntimeError('No open file on line {}'.format(line_num))
+        dest = statement[1]
+        if dest == 'F':
+            current_file.write(file_id)
+        else:
+            registers[dest] = file_id
+        program_counter += 1
+
     else:
         raise NotImplementedError(cmd)
     return program_counter, registers, file_id
 
 
-def run_program(program, labels, files):
+def format_step(line_num, statement, T, X):
+    return '{:3} {:20} T={:4} X={:4}'.format(
+        line_num, ' '.join(statement), T, X)
+
+
+def run_program(program, labels, files, encoded=False, transpiled=False,
+                dump_source=None, trace=None, checkpoint=None, profile=None,
+                record=None, bulk=True, loops=None):
+    # Every step is printed unless another trace sink is given. The
+    # transpiled path does not trace.
+    if trace is None:
+        trace = exatrace.StreamSink()
+    # Runs write to their own views of any exacow.BaseFile.
+    files = exacow.snapshot_files(files)
+
+    try:
+        if profile is not None:
+            if (transpiled or encoded or isinstance(program, EncodedProgram) or
+                    checkpoint is not None):
+                raise RuntimeError(
+                    'Profiling can only be done of programs run step by step')
+            registers, _ = run_profiled(
+                program, labels, profile.start(program, labels, files),
+                trace, profile)
+            return registers, files
+        if record is not None:
+            if (transpiled or encoded or isinstance(program, EncodedProgram) or
+                    checkpoint is not None):
+                raise RuntimeError(
+                    'Recording can only be done of programs run step by step')
+            registers, _ = run_recorded(
+                program, labels, record.start(program, labels, files),
+                trace, record)
+            return registers, files
+        if loops is not None:
+            if (transpiled or encoded or isinstance(program, EncodedProgram) or
+                    checkpoint is not None):
+                raise RuntimeError(
+                    'Loops can only be detected in programs run step by step')
+            return run_watched(program, labels, files, trace, loops)
+        if checkpoint is not None:
+            if transpiled or encoded or isinstance(program, EncodedProgram):
+                raise RuntimeError(
+                    'Checkpoints can only be taken of programs run step by step')
+            return run_checkpointed(program, labels, files, trace, checkpoint)
+        if transpiled:
+            import exac
+            if isinstance(program, EncodedProgram):
+                program = program.program
+            X, T, file_id, _ = exac.run_transpiled(
+                program, labels, files, File, dump_source=dump_source)
+            return {'T': T, 'X': X}, files
+        if isinstance(program, EncodedProgram):
+            return run_encoded(program, files, trace, bulk)
+        if encoded:
+            return run_encoded(encode_program(program, labels), files, trace,
+                               bulk)
+        return run_steps(program, labels, files, trace)
+    except Exception as exc:
+        trace.error(exc)
+        raise
+    finally:
+        trace.flush()
+
+
+def run_steps(program, labels, files, trace):
     program_counter = 0
     registers = {
         'T': 0,
@@ -263,16 +421,370 @@ def run_program(program, labels, files):
     }
     file_id = None
 
+    if not trace.enabled:
+        while program_counter < len(program):
+            line_num, statement = program[program_counter]
+            program_counter, registers, file_id = run_statement(
+                line_num, statement, program_counter, registers, labels, file_id, files)
+        return registers, files
+
     while program_counter < len(program):
         line_num, statement = program[program_counter]
         program_counter, registers, file_id = run_statement(
             line_num, statement, program_counter, registers, labels, file_id, files)
-        print('{:3} {:20} T={:4} X={:4}'.format(
-            line_num, ' '.join(statement), registers['T'], registers['X']))
+        trace.record(format_step, line_num, statement, registers['T'],
+                     registers['X'])
 
     return registers, files
 
 
+def run_profiled(program, labels, files, trace, profile):
+    # Like run_steps, but counts the statements run and the jumps
+    # taken, for exaprof.
+    program_counter = 0
+    registers = {
+        'T': 0,
+        'X': 0,
+    }
+    file_id = None
+    counts = profile.counts
+    jumps = profile.jumps
+
+    while program_counter < len(program):
+        pc = program_counter
+        line_num, statement = program[pc]
+        program_counter, registers, file_id = run_statement(
+            line_num, statement, pc, registers, labels, file_id, files)
+        counts[pc] += 1
+        if program_counter != pc + 1:
+            jumps[pc] += 1
+        if trace.enabled:
+            trace.record(format_step, line_num, statement, registers['T'],
+                         registers['X'])
+
+    return registers, files
+
+
+def run_recorded(program, labels, files, trace, record):
+    # Like run_steps, but saves what exarec needs to replay the run.
+    program_counter = 0
+    registers = {
+        'T': 0,
+        'X': 0,
+    }
+    file_id = None
+    cycle = 0
+    kinds = record.kinds
+    record_value = record.values.append
+
+    end = len(program)
+    error = None
+    try:
+        for cycles in record.segments(cycle):
+            for cycle in cycles:
+                if program_counter >= end:
+                    break
+                pc = program_counter
+                line_num, statement = program[pc]
+                program_counter, registers, file_id = run_statement(
+                    line_num, statement, pc, registers, labels, file_id,
+                    files)
+                kind = kinds[pc]
+                if kind is not None:
+                    if kind == exarec.GRAB:
+                        record_value(file_id)
+                    else:
+                        record_value(registers[kind])
+                if trace.enabled:
+                    trace.record(format_step, line_num, statement,
+                                 registers['T'], registers['X'])
+            else:
+                cycle = cycles.stop
+            if program_counter >= end:
+                break
+            record.seal(cycle, program_counter, registers['X'],
+                        registers['T'], file_id)
+    except Exception as exc:
+        error = exc
+        raise
+    finally:
+        record.finish(cycle, program_counter, registers['X'], registers['T'],
+                      file_id, error)
+
+    return registers, files
+
+
+def run_checkpointed(program, labels, files, trace, checkpoint):
+    # Like run_steps, but stops between segments of cycles to let
+    # checkpoint save the state.
+    program_counter = 0
+    registers = {
+        'T': 0,
+        'X': 0,
+    }
+    file_id = None
+    cycle = 0
+
+    tracked = checkpoint.track(files)
+    snapshot = checkpoint.begin(program)
+    if snapshot is not None:
+        exackpt.restore_files(snapshot, tracked, File)
+        program_counter = snapshot.next_statement
+        registers = {'T': snapshot.T, 'X': snapshot.X}
+        file_id = snapshot.file_id
+        cycle = snapshot.cycle
+
+    end = len(program)
+    try:
+        for cycles in checkpoint.segments(cycle):
+            for cycle in cycles:
+                if program_counter >= end:
+                    break
+                line_num, statement = program[program_counter]
+                program_counter, registers, file_id = run_statement(
+                    line_num, statement, program_counter, registers, labels,
+                    file_id, tracked)
+                if trace.enabled:
+                    trace.record(format_step, line_num, statement,
+                                 registers['T'], registers['X'])
+            else:
+                cycle = cycles.stop
+            if program_counter >= end:
+                break
+            if checkpoint.due(cycle):
+                checkpoint.save(cycle, registers['X'], registers['T'],
+                                program_counter, file_id, tracked)
+    finally:
+        checkpoint.finish(program_counter >= end)
+
+    return registers, files
+
+
+def run_watched(program, labels, files, trace, loops):
+    # Like run_steps, but stops between segments of cycles to let the
+    # exaloop detector look at the state.
+    program_counter = 0
+    registers = {
+        'T': 0,
+        'X': 0,
+    }
+    file_id = None
+    cycle = 0
+
+    def step():
+        nonlocal program_counter, registers, file_id
+        line_num, statement = program[program_counter]
+        program_counter, registers, file_id = run_statement(
+            line_num, statement, program_counter, registers, labels,
+            file_id, files)
+        if trace.enabled:
+            trace.record(format_step, line_num, statement, registers['T'],
+                         registers['X'])
+        return line_num
+
+    def get_state():
+        return exaloop.machine_state(program_counter, registers['X'],
+                                     registers['T'], file_id, files)
+
+    end = len(program)
+    for cycles in loops.segments(cycle):
+        for cycle in cycles:
+            if program_counter >= end:
+                break
+            step()
+        else:
+            cycle = cycles.stop
+        if program_counter >= end:
+            break
+        repeated = loops.check(cycle, get_state())
+        if repeated is not None:
+            loops.find_loop(repeated, step, get_state, cycle - repeated)
+
+    return registers, files
+
+
+def run_encoded(encoded, files, trace=None, bulk=False):
+    program = encoded.program
+    opcodes = encoded.opcodes
+    a_kinds = encoded.a_kinds
+    a_vals = encoded.a_vals
+    b_kinds = encoded.b_kinds
+    b_vals = encoded.b_vals
+    d_kinds = encoded.d_kinds
+    d_vals = encoded.d_vals
+    extras = encoded.extras
+
+    # Registers are updated in place, indexed by their slot number.
+    registers = [0, 0]
+    # The id and File object of the currently open file.
+    current = [None, None]
+
+    def value(kind, val):
+        if kind == KIND_NUM:
+            return val
+        if kind == KIND_REG:
+            return registers[val]
+        if current[1] is None:
+            raise RuntimeError('No open file')
+        return current[1].read()
+
+    def store(pc, val):
+        if d_kinds[pc] == KIND_REG:
+            registers[d_vals[pc]] = val
+            return
+        if current[1] is None:
+            raise RuntimeError('Writing to file before opening on line {}'.format(
+                program[pc][0]))
+        current[1].write(val)
+
+    def jump_target(pc):
+        target = extras[pc]
+        if target < 0:
+            raise KeyError(program[pc][1][1])
+        return target
+
+    def do_copy(pc):
+        store(pc, value(a_kinds[pc], a_vals[pc]))
+        return pc + 1
+
+    def make_math(op):
+        def do_math(pc):
+            a = value(a_kinds[pc], a_vals[pc])
+            b = value(b_kinds[pc], b_vals[pc])
+            store(pc, op(a, b))
+            return pc + 1
+        return do_math
+
+    test_funcs = [OPERATORS[name] for name in TEST_OPERATORS]
+
+    def do_test(pc):
+        a = value(a_kinds[pc], a_vals[pc])
+        b = value(b_kinds[pc], b_vals[pc])
+        if test_funcs[extras[pc]](a, b):
+            registers[REG_T] = 1
+        else:
+            registers[REG_T] = 0
+        return pc + 1
+
+    def do_test_eof(pc):
+        if current[1] is None:
+            raise RuntimeError('Testing EOF without an open file on line {}'.format(
+                program[pc][0]))
+        if current[1].at_eof():
+            registers[REG_T] = 1
+        else:
+            registers[REG_T] = 0
+        return pc + 1
+
+    def do_jump(pc):
+        return jump_target(pc)
+
+    def do_tjmp(pc):
+        if registers[REG_T]:
+            return jump_target(pc)
+        return pc + 1
+
+    def do_fjmp(pc):
+        if not registers[REG_T]:
+            return jump_target(pc)
+        return pc + 1
+
+    def do_mark(pc):
+        return pc + 1
+
+    def do_grab(pc):
+        file_id = value(a_kinds[pc], a_vals[pc])
+        if file_id not in files:
+            files[file_id] = File(file_id)
+        current[0] = file_id
+        current[1] = files[file_id]
+        return pc + 1
+
+    def do_drop(pc):
+        current[0] = None
+        current[1] = None
+        return pc + 1
+
+    def do_seek(pc):
+        if current[1] is None:
+            raise RuntimeError('No open file')
+        current[1].seek(value(a_kinds[pc], a_vals[pc]))
+        return pc + 1
+
+    def do_file(pc):
+        if current[1] is None:
+            raise RuntimeError('No open file on line {}'.format(program[pc][0]))
+        store(pc, current[0])
+        return pc + 1
+
+    # Indexed by opcode.
+    dispatch = [
+        do_copy,
+        make_math(operator.add),
+        make_math(operator.sub),
+        make_math(operator.mul),
+        make_math(operator.floordiv),
+        make_math(operator.mod),
+        do_test,
+        do_test_eof,
+        do_jump,
+        do_tjmp,
+        do_fjmp,
+        do_mark,
+        do_grab,
+        do_drop,
+        do_seek,
+        do_file,
+    ]
+
+    handlers = [dispatch[opcode] for opcode in opcodes]
+    tracing = trace is not None and trace.enabled
+    if bulk and not tracing:
+        _add_bulk_handlers(encoded, handlers, registers, current)
+    end = len(handlers)
+    program_counter = 0
+    if tracing:
+        while program_counter < end:
+            line_num, statement = program[program_counter]
+            program_counter = handlers[program_counter](program_counter)
+            trace.record(format_step, line_num, statement, registers[REG_T],
+                         registers[REG_X])
+    else:
+        while program_counter < end:
+            program_counter = handlers[program_counter](program_counter)
+
+    return {'T': registers[REG_T], 'X': registers[REG_X]}, files
+
+
+def _add_bulk_handlers(encoded, handlers, registers, current):
+    # Replace the handler of the first statement of each file-scan loop
+    # exaidiom recognizes with one that runs the whole loop at once,
+    # when the open file is an in-memory File.
+    import exaidiom
+    labels = {
+        statement[1]: target
+        for (_, statement), opcode, target in zip(
+            encoded.program, encoded.opcodes, encoded.extras)
+        if opcode in (OP_JUMP, OP_TJMP, OP_FJMP) and target >= 0
+    }
+
+    def make_handler(loop, handler):
+        def do_bulk(pc):
+            data_file = current[1]
+            if current[0] is not None and type(data_file) is File:
+                result = loop.run(data_file._content, data_file._cursor,
+                                  registers[REG_X])
+                if result is not None:
+                    (_, pc, data_file._cursor, registers[REG_X],
+                     registers[REG_T]) = result
+                    return pc
+            return handler(pc)
+        return do_bulk
+
+    for start, loop in exaidiom.find_loops(encoded.program, labels).items():
+        handlers[start] = make_handler(loop, handlers[start])
+
+
 def load_data_file(file_id, file_handle):
     content = []
     for num, line in enumerate(file_handle):
@@ -288,26 +800,136 @@ if __name__ == '__main__':
     p = argparse.ArgumentParser()
     p.add_argument('program')
     p.add_argument('-f', dest='files', action='append', default=[])
+    p.add_argument('-q', dest='verbose', action='store_false', default=True,
+                   help='do not print each step')
+    p.add_argument('-e', '--encoded', action='store_true', default=False,
+                   help='run the array-encoded program')
+    p.add_argument('-t', '--transpile', action='store_true', default=False,
+                   help='translate the program to Python and run that, '
+                   'without printing each step')
+    p.add_argument('--dump-source', action='store_true', default=False,
+                   help='print the Python source generated by --transpile')
+    p.add_argument('-d', '--data-dir', default=None,
+                   help='load numbered data files from this directory when '
+                   'the program grabs them, and save the ones it changes')
+    p.add_argument('--max-resident', type=int, default=None,
+                   help='number of values from --data-dir to keep in memory')
+    p.add_argument('--flush-binary', action='store_true', default=False,
+                   help='write changes to binary data files back to disk')
+    p.add_argument('-O', '--optimize', action='store_true', default=False,
+                   help='optimize the program before running it')
+    p.add_argument('--report-opt', action='store_true', default=False,
+                   help='print the changes made by --optimize')
+    p.add_argument('--no-bulk', dest='bulk', action='store_false',
+                   default=True,
+                   help='run file-scan loops one statement at a time in '
+                   'the encoded mode')
+    exatrace.add_arguments(p)
+    exackpt.add_arguments(p)
+    exaprof.add_arguments(p)
+    exarec.add_arguments(p)
+    exaloop.add_arguments(p)
+    exastream.add_arguments(p)
+    exacache.add_arguments(p)
+    exaout.add_arguments(p)
     args = p.parse_args()
 
-    with open(args.program, 'r') as f:
-        statements = f.readlines()
+    # The program is parsed as it is read, unless the whole source is
+    # needed to look it up in a cache or to list it with --profile.
+    program_file = open(args.program, 'r')
+    if args.use_cache or args.memo or args.profile:
+        with program_file:
+            statements = program_file.readlines()
+    else:
+        statements = program_file
 
-    files = {}
+    store = None
+    if args.data_dir:
+        files = store = exastore.FileStore(args.data_dir, File, args.max_resident)
+    else:
+        files = {}
     for filename in args.files:
         try:
             file_id = int(os.path.basename(filename))
         except TypeError:
             raise RuntimeError('Invalid filename {}, must be an integer'.format(
                 filename))
-        with open(filename, 'r') as f:
-            files[file_id] = load_data_file(file_id, f)
-
-    program, labels = parse_program(statements)
-    results, files = run_program(program, labels, files)
+        if exabin.is_binary(filename):
+            data_file = exabin.MappedFile(file_id, filename)
+        else:
+            with open(filename, 'r') as f:
+                data_file = load_data_file(file_id, f)
+        if store is not None:
+            # Only files the program creates are always written back.
+            store.add_input(file_id, data_file)
+        else:
+            files[file_id] = data_file
+    streams = exastream.from_args(args)
+    files.update(streams)
+
+    trace = exatrace.from_args(args, print, args.verbose)
+    profile = exaprof.from_args(args)
+    memo = exacache.memo_from_args(args, __file__)
+    cached = None
+    if memo is not None:
+        memo_key = memo.key(statements, args.files, 'exaf')
+        cached = memo.get(memo_key)
+
+    try:
+        if cached is not None:
+            results = {'T': cached['T'], 'X': cached['X']}
+            files = {
+                file_id: File(file_id, content)
+                for file_id, content in cached['files']
+            }
+        else:
+            program, labels = parse_program(
+                statements,
+                encoded=args.encoded,
+                optimize=args.optimize,
+                report=print if args.report_opt else None,
+                cache=exacache.from_args(args),
+            )
+            results, files = run_program(
+                program, labels, files,
+                transpiled=args.transpile,
+                dump_source=print if args.dump_source else None,
+                trace=trace,
+                checkpoint=exackpt.from_args(args),
+                profile=profile,
+                record=exarec.from_args(args),
+                bulk=args.bulk,
+                loops=exaloop.from_args(args),
+            )
+            if memo is not None:
+                memo.put(memo_key, {
+                    'X': results['X'],
+                    'T': results['T'],
+                    'files': [
+                        (file_id, list(data_file.get_content()))
+                        for file_id, data_file in sorted(files.items())
+                    ],
+                })
+    finally:
+        program_file.close()
+        trace.close()
+        exastream.close(streams)
+    exaprof.report(profile, args, statements)
     print('\nT={T:4} X={X:4}'.format(**results))
 
-    for file_id, file_content in sorted(files.items()):
-        print('\nFile: {}'.format(file_id))
-        for i in file_content.get_content():
-            print('  {}'.format(i))
+    if store is not None:
+        store.write_back()
+        files = store.loaded_items()
+    else:
+        files = sorted(files.items())
+
+    if args.flush_binary:
+        for file_id, data_file in files:
+            if isinstance(data_file, exabin.MappedFile):
+                data_file.flush()
+
+    exaout.report(args, {'X': results['X'], 'T': results['T']},
+                  exastream.without_streams(files, streams))
+
+    if args.memo_stats and memo is not None:
+        print('\nMemo: {hits} hits, {misses} misses'.format(**memo.stats()))
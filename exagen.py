@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+
+# Generate programs and data files for scaling tests.
+#
+# The generated programs are valid and always finish. They are made of
+# these constructs, picked at random by the weights given with --mix:
+#
+#   math   an ADDI, SUBI, MULI, DIVI or MODI on X or T
+#   copy   a COPY between registers or from a literal
+#   test   a TEST of X against a literal
+#   file   GRAB a file, SEEK to a position every data file has, then
+#          read or write it, and DROP it
+#   skip   a TJMP or FJMP, or a JUMP, forward over a block
+#   loop   a block run a fixed number of times
+#
+# Loops keep their counter in a file of their own (900 plus their
+# nesting depth) instead of a register, so the block inside can use X,
+# T and the other files freely. Divisors are never zero, and products
+# are reduced with MODI so values stay small.
+#
+# The output directory gets the data files, named for their ids,
+# prog-N.exa for each program, and manifest.json, which records the
+# final registers, cycle count and the content of each file the program
+# wrote, found by running the program with exa.Interpreter. The
+# manifest can be run with exabatch.py.
+
+import argparse
+import json
+import os
+import random
+
+import exa
+import exatrace
+
+
+FIRST_DATA_FILE = 100
+FIRST_OUTPUT_FILE = 400
+OUTPUT_FILES = 5
+FIRST_COUNTER_FILE = 900
+
+MIN_VALUE = -9999
+MAX_VALUE = 9999
+
+DEFAULT_MIX = 'math=4,copy=2,test=1,file=2,skip=1,loop=1'
+
+DISTRIBUTIONS = ['uniform', 'small', 'normal', 'sorted']
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        if name not in _Generator.constructs:
+            raise RuntimeError('Unknown construct {} in mix'.format(name))
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def generate_values(rng, size, distribution):
+    if distribution == 'small':
+        return [rng.randint(0, 9) for _ in range(size)]
+    if distribution == 'normal':
+        return [max(MIN_VALUE, min(MAX_VALUE, int(rng.gauss(0, 1000))))
+                for _ in range(size)]
+    values = [rng.randint(MIN_VALUE, MAX_VALUE) for _ in range(size)]
+    if distribution == 'sorted':
+        values.sort()
+    return values
+
+
+class _Generator:
+
+    constructs = ('math', 'copy', 'test', 'file', 'skip', 'loop')
+
+    def __init__(self, rng, mix, depth, labels, data_files, min_size, trips):
+        self._rng = rng
+        self._mix = mix
+        self._max_depth = depth
+        self._labels_left = labels
+        self._data_files = data_files
+        self._min_size = min_size
+        self._trips = trips
+        self._next_label = 0
+        self.lines = []
+
+    def _emit(self, *tokens):
+        self.lines.append(' '.join(str(tok) for tok in tokens))
+
+    def _label(self, prefix):
+        self._labels_left -= 1
+        self._next_label += 1
+        return '{}{}'.format(prefix, self._next_label)
+
+    def _literal(self, low=-99, high=99):
+        return self._rng.randint(low, high)
+
+    def _operand(self):
+        return self._rng.choice(['X', 'T', self._literal()])
+
+    def block(self, budget, depth):
+        # Emit about budget statements.
+        end = len(self.lines) + budget
+        while len(self.lines) < end:
+            remaining = end - len(self.lines)
+            choices = []
+            weights = []
+            for name, weight in self._mix.items():
+                if name == 'loop' and (depth >= self._max_depth or
+                                       self._labels_left < 1 or
+                                       remaining < 12):
+                    continue
+                if name == 'skip' and (self._labels_left < 1 or
+                                       remaining < 4):
+                    continue
+                if name == 'file' and remaining < 4:
+                    continue
+                choices.append(name)
+                weights.append(weight)
+            if not choices:
+                choices = ['copy']
+                weights = [1]
+            name = self._rng.choices(choices, weights)[0]
+            getattr(self, '_' + name)(remaining, depth)
+
+    def _math(self, remaining, depth):
+        cmd = self._rng.choice(['ADDI', 'SUBI', 'MULI', 'DIVI', 'MODI'])
+        dest = self._rng.choice(['X', 'T'])
+        if cmd in ('DIVI', 'MODI'):
+            divisor = self._literal(1, 99) * self._rng.choice([1, -1])
+            self._emit(cmd, self._operand(), divisor, dest)
+        else:
+            self._emit(cmd, self._operand(), self._operand(), dest)
+        if cmd == 'MULI':
+            self._emit('MODI', dest, 9973, dest)
+
+    def _copy(self, remaining, depth):
+        src, dest = self._rng.choice([
+            (self._literal(MIN_VALUE, MAX_VALUE), 'X'),
+            (self._literal(), 'T'),
+            ('X', 'T'),
+            ('T', 'X'),
+        ])
+        self._emit('COPY', src, dest)
+
+    def _test(self, remaining, depth):
+        self._emit('TEST', 'X', self._rng.choice(['<', '>', '=']),
+                   self._literal())
+
+    def _file(self, remaining, depth):
+        rng = self._rng
+        if rng.random() < 0.7:
+            file_id = rng.choice(self._data_files)
+            size = self._min_size
+        else:
+            file_id = FIRST_OUTPUT_FILE + rng.randrange(OUTPUT_FILES)
+            size = 0
+        self._emit('GRAB', file_id)
+        self._emit('SEEK', -9999)
+        if size:
+            offset = rng.randrange(size)
+            self._emit('SEEK', offset)
+            size -= offset
+        for _ in range(rng.randint(1, max(1, min(4, remaining - 3)))):
+            if size and rng.random() < 0.6:
+                # size counts the values left before the end of the
+                # shortest data file.
+                size -= 1
+                self._emit(rng.choice(['ADDI', 'SUBI']), 'F', 'X', 'X')
+            else:
+                if size:
+                    size -= 1
+                self._emit('COPY', 'X', 'F')
+        self._emit('DROP')
+
+    def _skip(self, remaining, depth):
+        rng = self._rng
+        label = self._label('S')
+        if rng.random() < 0.2:
+            self._emit('JUMP', label)
+        else:
+            self._emit('TEST', 'X', rng.choice(['<', '>', '=']),
+                       self._literal())
+            self._emit(rng.choice(['TJMP', 'FJMP']), label)
+        self.block(rng.randint(1, max(1, min(20, remaining - 3))), depth)
+        self._emit('MARK', label)
+
+    def _loop(self, remaining, depth):
+        rng = self._rng
+        label = self._label('L')
+        counter = FIRST_COUNTER_FILE + depth
+        self._emit('GRAB', counter)
+        self._emit('SEEK', -9999)
+        self._emit('COPY', rng.randint(*self._trips), 'F')
+        self._emit('MARK', label)
+        self.block(rng.randint(1, remaining - 10), depth + 1)
+        self._emit('GRAB', counter)
+        self._emit('SEEK', -9999)
+        self._emit('SUBI', 'F', 1, 'T')
+        self._emit('SEEK', -1)
+        self._emit('COPY', 'T', 'F')
+        self._emit('TJMP', label)
+
+
+def generate_program(rng, length, mix, depth, labels, data_files, min_size,
+                     trips):
+    gen = _Generator(rng, mix, depth, labels, data_files, min_size, trips)
+    gen.block(length, 0)
+    return gen.lines
+
+
+def expected_state(lines, data, max_cycles=None):
+    # Run the program with the reference interpreter and return the
+    # registers, cycles and the files it wrote.
+    interp = exa.Interpreter(lambda message: None, exatrace.NullSink())
+    for file_id, values in data.items():
+        interp.add_data_file(file_id, list(values))
+    state = interp.run(lines, max_cycles=max_cycles)
+    return {
+        'X': state.X,
+        'T': state.T,
+        'cycles': state.cycles,
+        'files': {
+            str(file_id): data_file.get_content()
+            for file_id, data_file in sorted(state.get_files().items())
+            if file_id not in data or data_file.version
+        },
+    }
+
+
+def write_lines(filename, lines):
+    with open(filename, 'w') as f:
+        f.write(''.join('{}\n'.format(line) for line in lines))
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('directory')
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--programs', type=int, default=1,
+                   help='number of programs to generate')
+    p.add_argument('--length', type=int, default=100,
+                   help='statements in each program, up to 1000000')
+    p.add_argument('--mix', default=DEFAULT_MIX,
+                   help='weights of the constructs (default: {})'.format(
+                       DEFAULT_MIX))
+    p.add_argument('--depth', type=int, default=2,
+                   help='deepest loop nesting')
+    p.add_argument('--labels', type=int, default=100,
+                   help='most labels in a program')
+    p.add_argument('--trips', default='2:3',
+                   help='range of times a loop runs, as MIN:MAX')
+    p.add_argument('--files', type=int, default=3,
+                   help='number of data files')
+    p.add_argument('--file-size', type=int, default=1000,
+                   help='values in each data file')
+    p.add_argument('--distribution', choices=DISTRIBUTIONS,
+                   default='uniform')
+    p.add_argument('--max-cycles', type=int, default=None,
+                   help='cycle limit when finding the expected state')
+    p.add_argument('--no-expected', action='store_true', default=False,
+                   help='do not run the programs to find the expected state')
+    args = p.parse_args()
+
+    if not 1 <= args.files <= FIRST_OUTPUT_FILE - FIRST_DATA_FILE:
+        raise RuntimeError('--files must be between 1 and {}'.format(
+            FIRST_OUTPUT_FILE - FIRST_DATA_FILE))
+    if args.file_size < 1:
+        raise RuntimeError('--file-size must be at least 1')
+    low, _, high = args.trips.partition(':')
+    trips = (int(low), int(high or low))
+    mix = parse_mix(args.mix)
+
+    rng = random.Random(args.seed)
+    os.makedirs(args.directory, exist_ok=True)
+
+    data = {}
+    for file_id in range(FIRST_DATA_FILE, FIRST_DATA_FILE + args.files):
+        data[file_id] = generate_values(rng, args.file_size, args.distribution)
+        write_lines(os.path.join(args.directory, str(file_id)), data[file_id])
+
+    manifest = []
+    for num in range(args.programs):
+        name = 'prog-{}'.format(num)
+        lines = generate_program(
+            rng, args.length, mix, args.depth, args.labels, sorted(data),
+            args.file_size, trips,
+        )
+        write_lines(os.path.join(args.directory, name + '.exa'), lines)
+        job = {
+            'name': name,
+            'program': name + '.exa',
+            'files': [str(file_id) for file_id in sorted(data)],
+        }
+        if not args.no_expected:
+            job['expected'] = expected_state(lines, data, args.max_cycles)
+        manifest.append(job)
+        print('{}: {} statements'.format(name, len(lines)))
+
+    with open(os.path.join(args.directory, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
@@ -0,0 +1,245 @@
+# Recognizing file-scan loops and running them in bulk.
+#
+# find_loops() takes a program as a list of (line_num, tokens) pairs and
+# a dict mapping labels to statement indexes, and returns the loops it
+# recognizes, keyed by the index of their first statement. Two shapes
+# are recognized, with MARKs allowed anywhere inside:
+#
+#   scan      a body that reads one value from the open file, with a
+#             TEST EOF and FJMP back to the start at the bottom, or a
+#             TEST EOF and TJMP out at the top and a JUMP back at the
+#             bottom. The body may only change X, as a sum, a count or
+#             the last value read, and T, which TEST EOF overwrites.
+#
+#               MARK READ            MARK READ
+#               ADDI F X X           TEST EOF
+#               TEST EOF             TJMP DONE
+#               FJMP READ            ADDI X 1 X
+#                                    COPY F T
+#                                    JUMP READ
+#
+#   search    TEST F against X or a literal, a TJMP or FJMP out of the
+#             loop, then TEST EOF and FJMP back to the start.
+#
+# Each loop's run() takes the content and cursor of the open file and
+# X, and returns the cycles the loop would have taken, the next
+# statement, and the new cursor, X and T, so the interpreters can run
+# the whole loop in one step. It returns None when the loop would not
+# behave the way it does in bulk, such as when it would read past the
+# end of the file, and the interpreter runs the loop as usual.
+
+import itertools
+import operator
+
+
+TEST_OPERATORS = {
+    '>': operator.gt,
+    '<': operator.lt,
+    '=': operator.eq,
+}
+
+# The comparison to use when the operands are swapped.
+SWAPPED = {'>': '<', '<': '>', '=': '='}
+
+# Longest loop looked at, in statements.
+MAX_LOOP = 32
+
+
+def _literal(tok):
+    try:
+        val = int(tok)
+    except ValueError:
+        return None
+    if -9999 <= val <= 9999:
+        return val
+    return None
+
+
+def _operand(tok):
+    # X as a linear function of the starting X and the value read,
+    # (x, v, constant), or None.
+    if tok == 'X':
+        return (1, 0, 0)
+    if tok == 'F':
+        return (0, 1, 0)
+    val = _literal(tok)
+    if val is None:
+        return None
+    return (0, 0, val)
+
+
+def _body_effect(body):
+    # Work out what one pass through the body does to X, as
+    # X = x * X + v * value + constant. Returns (x, v, constant), or
+    # None if the body does something the bulk loop cannot.
+    x, v, const = 1, 0, 0
+    reads = 0
+    for tokens in body:
+        cmd = tokens[0]
+        if cmd == 'COPY' and len(tokens) == 3:
+            operands = [_operand(tokens[1])]
+        elif cmd in ('ADDI', 'SUBI') and len(tokens) == 4:
+            operands = [_operand(tokens[1]), _operand(tokens[2])]
+        else:
+            return None
+        if None in operands:
+            return None
+        reads += tokens[1:-1].count('F')
+        if cmd == 'SUBI':
+            a, b = operands
+            operands = [a, (-b[0], -b[1], -b[2])]
+        # The value stored, in terms of X before this statement.
+        sx = sum(op[0] for op in operands)
+        sv = sum(op[1] for op in operands)
+        sc = sum(op[2] for op in operands)
+        dest = tokens[-1]
+        if dest == 'X':
+            x, v, const = sx * x, sx * v + sv, sx * const + sc
+        elif dest != 'T':
+            # T is overwritten by TEST EOF before anything reads it.
+            return None
+    if reads != 1 or x not in (0, 1):
+        return None
+    return x, v, const
+
+
+class ScanLoop:
+
+    def __init__(self, start, length, effect, exit_pc, exit_cycles):
+        # length is the cycles one pass takes, exit_cycles the cycles
+        # after the last pass until the loop is left.
+        self.start = start
+        self._length = length
+        self._x, self._v, self._const = effect
+        self._exit_pc = exit_pc
+        self._exit_cycles = exit_cycles
+        # With the test at the bottom, the body runs before EOF is
+        # tested, so an empty file would be read past its end.
+        self._min_passes = 1 if exit_cycles == 0 else 0
+
+    def run(self, content, cursor, X):
+        passes = len(content) - cursor
+        if passes < self._min_passes:
+            return None
+        if passes:
+            if self._x:
+                total = sum(itertools.islice(content, cursor, None))
+                X = X + self._v * total + passes * self._const
+            else:
+                X = self._v * content[-1] + self._const
+        return (passes * self._length + self._exit_cycles, self._exit_pc,
+                len(content), X, 1)
+
+
+class SearchLoop:
+
+    def __init__(self, start, length, test, compare_to, exit_when, exit_pc,
+                 exit_cycles, end_pc):
+        self.start = start
+        self._length = length
+        self._test = test
+        self._op = TEST_OPERATORS[test]
+        self._compare_to = compare_to
+        # The loop is left when the test gives exit_when, exit_cycles
+        # into the pass.
+        self._exit_when = exit_when
+        self._exit_pc = exit_pc
+        self._exit_cycles = exit_cycles
+        self._end_pc = end_pc
+
+    def _find(self, content, cursor, val):
+        # The index of the first value that ends the loop, or None.
+        if self._test == '=' and self._exit_when:
+            try:
+                return content.index(val, cursor)
+            except ValueError:
+                return None
+        op = self._op
+        exit_when = self._exit_when
+        for pos in range(cursor, len(content)):
+            if bool(op(content[pos], val)) == exit_when:
+                return pos
+        return None
+
+    def run(self, content, cursor, X):
+        if cursor >= len(content):
+            return None
+        val = X if self._compare_to == 'X' else self._compare_to
+        pos = self._find(content, cursor, val)
+        if pos is None:
+            passes = len(content) - cursor
+            return (passes * self._length, self._end_pc, len(content), X, 1)
+        return ((pos - cursor) * self._length + self._exit_cycles,
+                self._exit_pc, pos + 1, X, int(self._exit_when))
+
+
+def _statements(program, start):
+    # The statements from start, up to MAX_LOOP of them, leaving out
+    # MARKs, as (index, tokens) pairs.
+    found = []
+    for index in range(start, min(len(program), start + MAX_LOOP)):
+        tokens = program[index][1]
+        if tokens[0] != 'MARK':
+            found.append((index, tokens))
+    return found
+
+
+def _match(program, labels, label, start):
+    stmts = _statements(program, start)
+    for pos, (index, tokens) in enumerate(stmts):
+        if tokens[0] in ('JUMP', 'TJMP', 'FJMP') and tokens[1] == label:
+            break
+    else:
+        return None
+    end = index
+    length = end - start + 1
+    loop = stmts[:pos + 1]
+    cmds = [tokens for _, tokens in loop]
+
+    # Test at the top: TEST EOF, TJMP out, body, JUMP back.
+    if (cmds[-1][0] == 'JUMP' and len(cmds) >= 4 and
+            cmds[0] == ['TEST', 'EOF'] and cmds[1][0] == 'TJMP'):
+        exit_pc = labels.get(cmds[1][1])
+        effect = _body_effect(cmds[2:-1])
+        if exit_pc is None or effect is None:
+            return None
+        return ScanLoop(start, length, effect, exit_pc,
+                        loop[1][0] - start + 1)
+
+    if cmds[-1][0] != 'FJMP' or len(cmds) < 3 or cmds[-2] != ['TEST', 'EOF']:
+        return None
+    body = cmds[:-2]
+
+    # Search: TEST F against something, jump out, test for EOF.
+    if (len(body) == 2 and body[0][0] == 'TEST' and len(body[0]) == 4 and
+            body[1][0] in ('TJMP', 'FJMP')):
+        a, test, b = body[0][1:]
+        if test not in TEST_OPERATORS:
+            return None
+        if b == 'F' and a != 'F':
+            a, b, test = b, a, SWAPPED[test]
+        if a != 'F':
+            return None
+        compare_to = 'X' if b == 'X' else _literal(b)
+        exit_pc = labels.get(body[1][1])
+        if compare_to is None or exit_pc is None:
+            return None
+        return SearchLoop(start, length, test, compare_to,
+                          body[1][0] == 'TJMP', exit_pc,
+                          loop[1][0] - start + 1, end + 1)
+
+    effect = _body_effect(body)
+    if effect is None:
+        return None
+    return ScanLoop(start, length, effect, end + 1, 0)
+
+
+def find_loops(program, labels):
+    loops = {}
+    for label, start in labels.items():
+        if start in loops or start >= len(program):
+            continue
+        loop = _match(program, labels, label, start)
+        if loop is not None:
+            loops[start] = loop
+    return loops
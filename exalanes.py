@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+
+# Run one EXA program over many inputs at once with NumPy.
+#
+# Each lane is an independent copy of the machine with its own X, T,
+# program counter, open file and file contents. Registers and cursors
+# are held in arrays indexed by lane, and every cycle executes one
+# statement for all of the lanes that are waiting at it. The lanes
+# with the lowest program counter go first, so lanes that branch
+# differently are masked off until they come back together. A lane
+# retires when it runs off the end of the program or fails, with the
+# same results it would get from exaf.run_program(). A lane that fails
+# has the exception exaf.run_program() would have raised in its error
+# result.
+#
+# Values are stored as 64-bit integers, so a program whose registers
+# grow past that range will not match the pure Python interpreters.
+
+import argparse
+import os.path
+
+import numpy as np
+
+import exaf
+
+
+MATH_FUNCS = {
+    'ADDI': np.add,
+    'SUBI': np.subtract,
+    'MULI': np.multiply,
+    'DIVI': np.floor_divide,
+    'MODI': np.mod,
+}
+
+TEST_FUNCS = {
+    '>': np.greater,
+    '<': np.less,
+    '=': np.equal,
+}
+
+
+class Lanes:
+
+    def __init__(self, program, labels, num_lanes, X=None, T=None,
+                 files=None):
+        self._program = program
+        self._labels = labels
+        self.num_lanes = num_lanes
+        self.X = self._lane_array(X)
+        self.T = self._lane_array(T)
+        self.pc = np.zeros(num_lanes, dtype=np.int64)
+        self.cycles = np.zeros(num_lanes, dtype=np.int64)
+        self.failed = np.zeros(num_lanes, dtype=bool)
+        self.errors = [None] * num_lanes
+
+        # Index of the open file in each lane, or -1.
+        self._current = np.full(num_lanes, -1, dtype=np.int64)
+
+        # Files are numbered in the order they are first seen. For
+        # each one we keep a (lanes x capacity) array of contents, and
+        # per-lane arrays of the length, cursor, and whether the file
+        # exists in that lane.
+        self._file_ids = []
+        self._file_index = {}
+        self._data = []
+        self._length = []
+        self._cursor = []
+        self._exists = []
+
+        for file_id, content in sorted((files or {}).items()):
+            self._add_file(file_id, content)
+
+    def _lane_array(self, values):
+        arr = np.zeros(self.num_lanes, dtype=np.int64)
+        if values is not None:
+            arr[:] = values
+        return arr
+
+    def _add_file(self, file_id, content):
+        # content is either one list of values shared by every lane,
+        # or a list of num_lanes lists.
+        if content and isinstance(content[0], (list, tuple)):
+            if len(content) != self.num_lanes:
+                raise RuntimeError('Expected {} lanes of content for file {}, got {}'.format(
+                    self.num_lanes, file_id, len(content)))
+            per_lane = content
+        else:
+            per_lane = [content] * self.num_lanes
+        capacity = max([len(c) for c in per_lane] + [1])
+        data = np.zeros((self.num_lanes, capacity), dtype=np.int64)
+        length = np.zeros(self.num_lanes, dtype=np.int64)
+        for lane, values in enumerate(per_lane):
+            data[lane, :len(values)] = values
+            length[lane] = len(values)
+        index = self._get_file(file_id)
+        self._data[index] = data
+        self._length[index] = length
+        self._exists[index][:] = True
+
+    def _get_file(self, file_id):
+        if file_id not in self._file_index:
+            self._file_index[file_id] = len(self._file_ids)
+            self._file_ids.append(file_id)
+            self._data.append(np.zeros((self.num_lanes, 1), dtype=np.int64))
+            self._length.append(np.zeros(self.num_lanes, dtype=np.int64))
+            self._cursor.append(np.zeros(self.num_lanes, dtype=np.int64))
+            self._exists.append(np.zeros(self.num_lanes, dtype=bool))
+        return self._file_index[file_id]
+
+    def _fail(self, lanes, error, message):
+        # message may be a function that builds the message for a lane.
+        for lane in lanes:
+            if callable(message):
+                self.errors[lane] = error(message(lane))
+            else:
+                self.errors[lane] = error(message)
+        self.failed[lanes] = True
+
+    def _split_by_file(self, lanes):
+        # Yield (positions, index) for each open file among lanes,
+        # where positions index into lanes.
+        current = self._current[lanes]
+        for index in np.unique(current):
+            yield np.nonzero(current == index)[0], index
+
+    def _require_file(self, lanes, message):
+        no_file = self._current[lanes] < 0
+        if no_file.any():
+            self._fail(lanes[no_file], RuntimeError, message)
+        return ~no_file
+
+    def _read(self, lanes):
+        keep = self._require_file(lanes, 'No open file')
+        values = np.zeros(len(lanes), dtype=np.int64)
+        current = self._current[lanes]
+        for index in np.unique(current[keep]):
+            positions = np.nonzero(keep & (current == index))[0]
+            file_lanes = lanes[positions]
+            cursor = self._cursor[index]
+            past_end = cursor[file_lanes] >= self._length[index][file_lanes]
+            if past_end.any():
+                file_id = self._file_ids[index]
+                self._fail(
+                    file_lanes[past_end],
+                    RuntimeError,
+                    lambda lane: 'Read past the end of file {} at position {}'.format(
+                        file_id, cursor[lane]))
+                keep[positions[past_end]] = False
+                positions = positions[~past_end]
+                file_lanes = file_lanes[~past_end]
+            values[positions] = self._data[index][file_lanes, cursor[file_lanes]]
+            cursor[file_lanes] += 1
+        return keep, values
+
+    def _write(self, lanes, values):
+        for positions, index in self._split_by_file(lanes):
+            file_lanes = lanes[positions]
+            cursor = self._cursor[index]
+            dest = cursor[file_lanes]
+            data = self._data[index]
+            if dest.max() >= data.shape[1]:
+                grown = np.zeros(
+                    (self.num_lanes, max(data.shape[1] * 2, dest.max() + 1)),
+                    dtype=np.int64)
+                grown[:, :data.shape[1]] = data
+                self._data[index] = data = grown
+            data[file_lanes, dest] = values[positions]
+            cursor[file_lanes] = dest + 1
+            length = self._length[index]
+            length[file_lanes] = np.maximum(length[file_lanes], dest + 1)
+
+    def _value(self, tok, lanes):
+        # Return a mask of the lanes that could read the operand, and
+        # the values.
+        if tok == 'X':
+            return np.ones(len(lanes), dtype=bool), self.X[lanes]
+        if tok == 'T':
+            return np.ones(len(lanes), dtype=bool), self.T[lanes]
+        if tok == 'F':
+            return self._read(lanes)
+        return (np.ones(len(lanes), dtype=bool),
+                np.full(len(lanes), int(tok), dtype=np.int64))
+
+    def _store(self, tok, lanes, values, line_num):
+        if tok == 'X':
+            self.X[lanes] = values
+        elif tok == 'T':
+            self.T[lanes] = values
+        else:
+            keep = self._require_file(
+                lanes,
+                'Writing to file before opening on line {}'.format(line_num))
+            self._write(lanes[keep], values[keep])
+            return keep
+        return np.ones(len(lanes), dtype=bool)
+
+    def _jump(self, lanes, label):
+        if label not in self._labels:
+            self._fail(lanes, KeyError, label)
+            return
+        self.pc[lanes] = self._labels[label]
+
+    def active(self):
+        return (~self.failed) & (self.pc < len(self._program))
+
+    def step(self):
+        # Execute one statement for the lanes waiting at the lowest
+        # program counter. Returns False when every lane has retired.
+        active = self.active()
+        if not active.any():
+            return False
+        pc = self.pc[active].min()
+        lanes = np.nonzero(active & (self.pc == pc))[0]
+        line_num, statement = self._program[pc]
+        cmd = statement[0]
+        self.cycles[lanes] += 1
+
+        if cmd == 'COPY':
+            ok, values = self._value(statement[1], lanes)
+            lanes, values = lanes[ok], values[ok]
+            ok = self._store(statement[2], lanes, values, line_num)
+            self.pc[lanes[ok]] += 1
+
+        elif cmd in exaf.MATH_CMDS:
+            ok, a = self._value(statement[1], lanes)
+            lanes, a = lanes[ok], a[ok]
+            ok, b = self._value(statement[2], lanes)
+            lanes, a, b = lanes[ok], a[ok], b[ok]
+            if cmd in ('DIVI', 'MODI'):
+                zero = b == 0
+                if zero.any():
+                    self._fail(lanes[zero], ZeroDivisionError,
+                               'integer division or modulo by zero')
+                    lanes, a, b = lanes[~zero], a[~zero], b[~zero]
+            values = MATH_FUNCS[cmd](a, b)
+            ok = self._store(statement[3], lanes, values, line_num)
+            self.pc[lanes[ok]] += 1
+
+        elif cmd == 'TEST':
+            if statement[1] == 'EOF':
+                ok = self._require_file(
+                    lanes,
+                    'Testing EOF without an open file on line {}'.format(line_num))
+                lanes = lanes[ok]
+                for positions, index in self._split_by_file(lanes):
+                    file_lanes = lanes[positions]
+                    at_eof = (self._cursor[index][file_lanes]
+                              >= self._length[index][file_lanes])
+                    self.T[file_lanes] = at_eof
+            else:
+                ok, a = self._value(statement[1], lanes)
+                lanes, a = lanes[ok], a[ok]
+                ok, b = self._value(statement[3], lanes)
+                lanes, a, b = lanes[ok], a[ok], b[ok]
+                self.T[lanes] = TEST_FUNCS[statement[2]](a, b)
+            self.pc[lanes] += 1
+
+        elif cmd == 'JUMP':
+            self._jump(lanes, statement[1])
+
+        elif cmd in ('TJMP', 'FJMP'):
+            taken = self.T[lanes] != 0
+            if cmd == 'FJMP':
+                taken = ~taken
+            self.pc[lanes[~taken]] += 1
+            if taken.any():
+                self._jump(lanes[taken], statement[1])
+
+        elif cmd == 'MARK':
+            self.pc[lanes] += 1
+
+        elif cmd == 'GRAB':
+            ok, file_ids = self._value(statement[1], lanes)
+            lanes, file_ids = lanes[ok], file_ids[ok]
+            for file_id in np.unique(file_ids):
+                grabbing = lanes[file_ids == file_id]
+                index = self._get_file(int(file_id))
+                self._exists[index][grabbing] = True
+                self._current[grabbing] = index
+            self.pc[lanes] += 1
+
+        elif cmd == 'DROP':
+            self._current[lanes] = -1
+            self.pc[lanes] += 1
+
+        elif cmd == 'SEEK':
+            ok = self._require_file(lanes, 'No open file')
+            lanes = lanes[ok]
+            ok, offsets = self._value(statement[1], lanes)
+            lanes, offsets = lanes[ok], offsets[ok]
+            for positions, index in self._split_by_file(lanes):
+                file_lanes = lanes[positions]
+                cursor = self._cursor[index]
+                cursor[file_lanes] = np.clip(
+                    cursor[file_lanes] + offsets[positions],
+                    0, self._length[index][file_lanes])
+            self.pc[lanes] += 1
+
+        elif cmd == 'FILE':
+            ok = self._require_file(
+                lanes, 'No open file on line {}'.format(line_num))
+            lanes = lanes[ok]
+            file_ids = np.array(self._file_ids, dtype=np.int64)
+            ok = self._store(statement[1], lanes,
+                             file_ids[self._current[lanes]], line_num)
+            self.pc[lanes[ok]] += 1
+
+        else:
+            self._fail(lanes, NotImplementedError, cmd)
+
+        return True
+
+    def run(self, max_cycles=None):
+        while self.step():
+            if max_cycles is not None:
+                over = self.active() & (self.cycles >= max_cycles)
+                if over.any():
+                    self._fail(np.nonzero(over)[0], RuntimeError,
+                               'Reached cycle limit {}'.format(max_cycles))
+        return self
+
+    def lane_result(self, lane):
+        files = {}
+        for index, file_id in enumerate(self._file_ids):
+            if self._exists[index][lane]:
+                length = self._length[index][lane]
+                files[file_id] = self._data[index][lane, :length].tolist()
+        return {
+            'X': int(self.X[lane]),
+            'T': int(self.T[lane]),
+            'cycles': int(self.cycles[lane]),
+            'files': files,
+            'error': self.errors[lane],
+        }
+
+    def results(self):
+        return [self.lane_result(lane) for lane in range(self.num_lanes)]
+
+
+def run_lanes(program, labels, num_lanes, X=None, T=None, files=None,
+              max_cycles=None):
+    # program and labels are the values returned by
+    # exaf.parse_program(). X and T are the initial register values,
+    # either a single number or one per lane. files maps file ids to
+    # contents shared by every lane, or to a list of contents, one for
+    # each lane. Returns a list of per-lane results.
+    lanes = Lanes(program, labels, num_lanes, X, T, files)
+    return lanes.run(max_cycles).results()
+
+
+def _parse_range(text):
+    parts = [int(p) for p in text.split(':')]
+    return np.arange(*parts)
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('program')
+    p.add_argument('-f', dest='files', action='append', default=[])
+    p.add_argument('--x-values', metavar='START:STOP[:STEP]', default=None,
+                   help='run one lane per initial X value in the range')
+    p.add_argument('--t-values', metavar='START:STOP[:STEP]', default=None,
+                   help='run one lane per initial T value in the range')
+    p.add_argument('--max-cycles', type=int, default=None)
+    args = p.parse_args()
+
+    with open(args.program, 'r') as f:
+        statements = f.readlines()
+
+    files = {}
+    for filename in args.files:
+        with open(filename, 'r') as f:
+            file_id = int(os.path.basename(filename))
+            files[file_id] = exaf.load_data_file(file_id, f).get_content()
+
+    X = _parse_range(args.x_values) if args.x_values else np.zeros(1, dtype=np.int64)
+    T = _parse_range(args.t_values) if args.t_values else np.zeros(1, dtype=np.int64)
+    X, T = np.broadcast_arrays(X, T)
+
+    program, labels = exaf.parse_program(statements)
+    results = run_lanes(program, labels, len(X), X, T, files,
+                        max_cycles=args.max_cycles)
+    for x, t, result in zip(X, T, results):
+        print('X0={:5} T0={:5} -> X={:5} T={:5} cycles={:6} {}'.format(
+            x, t, result['X'], result['T'], result['cycles'],
+            repr(result['error']) if result['error'] else ''))
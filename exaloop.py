@@ -0,0 +1,121 @@
+# Stopping programs that loop forever.
+#
+# A LoopDetector is passed to Interpreter.run() or exaf.run_program(),
+# which then run the program in segments of `every` cycles and give the
+# detector the state of the machine between them: the next statement,
+# X, T, the open file, and the cursor and version of every file. The
+# machine is deterministic, so once the state at the end of a segment
+# is one it has been in before, the program can only repeat itself.
+#
+# Brent's algorithm finds the repeat while keeping a single earlier
+# state, so memory use does not grow with the length of the run. When
+# it finds one, the interpreter runs the loop once more, a cycle at a
+# time, to find its length and the lines in it, and raises
+# InfiniteLoop.
+#
+# The versions stand in for the content of the files, since a file's
+# version only changes when it is written. A loop that writes to a file
+# is never in the same state twice, so it is not caught.
+
+# Cycles between looks at the state.
+DEFAULT_EVERY = 10000
+
+
+class InfiniteLoop(RuntimeError):
+
+    def __init__(self, cycle, period, lines):
+        super().__init__(
+            'Infinite loop: the state at cycle {} repeats every {} cycles, '
+            'running lines {}'.format(cycle, period, format_lines(lines)))
+        self.cycle = cycle
+        self.period = period
+        self.lines = sorted(lines)
+
+
+def format_lines(lines):
+    # "3-6, 9" for lines 3, 4, 5, 6 and 9.
+    ranges = []
+    for line in sorted(lines):
+        if ranges and ranges[-1][1] == line - 1:
+            ranges[-1][1] = line
+        else:
+            ranges.append([line, line])
+    return ', '.join(
+        str(first) if first == last else '{}-{}'.format(first, last)
+        for first, last in ranges
+    )
+
+
+def machine_state(next_statement, X, T, file_id, files):
+    # Everything that decides what the program does next.
+    if not isinstance(files, dict):
+        # A FileStore would have to load every file in its directory.
+        raise RuntimeError('Loops can only be detected with in-memory files')
+    return (
+        next_statement, X, T, file_id,
+        tuple(sorted(
+            (fid, data_file.tell(), data_file.version)
+            for fid, data_file in files.items()
+        )),
+    )
+
+
+class LoopDetector:
+
+    def __init__(self, every=DEFAULT_EVERY):
+        self.every = every
+        # The state Brent's algorithm compares against, and its cycle.
+        self._saved = None
+        self._saved_cycle = None
+        self._power = 1
+        self._steps = 1
+
+    def segments(self, start, stop=None):
+        # Yield ranges of cycles to run between looks at the state.
+        while stop is None or start < stop:
+            end = start + self.every
+            if stop is not None:
+                end = min(end, stop)
+            yield range(start, end)
+            start = end
+
+    def check(self, cycle, state):
+        # Return the cycle the machine was last in state, if it is the
+        # saved one, or None.
+        if state == self._saved:
+            return self._saved_cycle
+        if self._steps == self._power:
+            self._saved = state
+            self._saved_cycle = cycle
+            self._power *= 2
+            self._steps = 0
+        self._steps += 1
+        return None
+
+    def find_loop(self, cycle, step, get_state, limit):
+        # The machine is in the state it was in at cycle, limit cycles
+        # before. Call step(), which runs one cycle and returns the line
+        # it ran, until the state comes around again, and raise
+        # InfiniteLoop.
+        start = get_state()
+        lines = set()
+        for period in range(1, limit + 1):
+            lines.add(step())
+            if get_state() == start:
+                raise InfiniteLoop(cycle, period, lines)
+        raise RuntimeError('State at cycle {} did not repeat'.format(cycle))
+
+
+def add_arguments(parser):
+    parser.add_argument('--detect-loops', action='store_true', default=False,
+                        help='stop the program if it is caught repeating '
+                        'itself forever')
+    parser.add_argument('--loop-check-every', type=int, default=DEFAULT_EVERY,
+                        help='cycles between looks at the state for '
+                        '--detect-loops (default: {})'.format(DEFAULT_EVERY))
+
+
+def from_args(args):
+    if args.detect_loops:
+        return LoopDetector(args.loop_check_every)
+    return None
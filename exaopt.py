@@ -0,0 +1,310 @@
+# Static optimizer for parsed EXA programs.
+#
+# optimize() takes a program as a list of (line_num, tokens) pairs and
+# a dict mapping labels to statement indexes, the form produced by
+# exaf.parse_program() and used inside Interpreter.parse(), and returns
+# a new program and labels that leave the same final registers and file
+# contents. It repeats these passes until none of them changes
+# anything:
+#
+# * MARK statements are removed, and their labels point at the
+#   statement that followed them.
+# * Known values of X and T are tracked through each basic block, math
+#   and TEST statements with known operands become COPYs, and TJMP and
+#   FJMP with a known T become JUMPs or disappear.
+# * Jumps to a JUMP are sent straight to its target, and jumps to the
+#   next statement are removed.
+# * Statements no path from the start can reach are removed.
+# * Stores to X or T that are overwritten in the same block before they
+#   are read are removed.
+#
+# The optimized program runs fewer cycles than the original.
+
+import operator
+
+
+MATH_OPERATORS = {
+    'ADDI': operator.add,
+    'SUBI': operator.sub,
+    'MULI': operator.mul,
+    'DIVI': operator.floordiv,
+    'MODI': operator.mod,
+}
+
+TEST_OPERATORS = {
+    '>': operator.gt,
+    '<': operator.lt,
+    '=': operator.eq,
+}
+
+JUMP_CMDS = set(['JUMP', 'TJMP', 'FJMP'])
+
+REGISTERS = ('X', 'T')
+
+# Stop after this many rounds even if something is still changing.
+MAX_ROUNDS = 20
+
+
+def _literal(tok):
+    # Return the value of an integer literal that the interpreters
+    # accept, or None.
+    try:
+        val = int(tok)
+    except ValueError:
+        return None
+    if -9999 <= val <= 9999:
+        return val
+    return None
+
+
+def _describe(line_num, tokens):
+    return 'line {}: {}'.format(line_num, ' '.join(tokens))
+
+
+class _Optimizer:
+
+    def __init__(self, program, labels, report):
+        self._program = [(ln, list(tokens)) for ln, tokens in program]
+        self._labels = dict(labels)
+        self._report = report or (lambda msg: None)
+
+    def _remove(self, doomed):
+        # Drop the statements at the indexes in doomed, and move labels
+        # that pointed at them to the statement that follows.
+        if not doomed:
+            return False
+        new_index = []
+        kept = []
+        for i, stmt in enumerate(self._program):
+            new_index.append(len(kept))
+            if i not in doomed:
+                kept.append(stmt)
+        new_index.append(len(kept))
+        self._labels = {
+            label: new_index[i] for label, i in self._labels.items()
+        }
+        self._program = kept
+        return True
+
+    def _targets(self):
+        return set(self._labels.values())
+
+    def remove_marks(self):
+        doomed = set()
+        for i, (ln, tokens) in enumerate(self._program):
+            if tokens[0] == 'MARK':
+                self._report('removed {}'.format(_describe(ln, tokens)))
+                doomed.add(i)
+        return self._remove(doomed)
+
+    def _value(self, tok, known):
+        if tok in REGISTERS:
+            return known.get(tok)
+        if tok == 'F':
+            return None
+        return _literal(tok)
+
+    def _replace(self, i, tokens):
+        ln, old = self._program[i]
+        self._report('replaced {} with {}'.format(
+            _describe(ln, old), ' '.join(tokens)))
+        self._program[i] = (ln, tokens)
+
+    def fold_constants(self):
+        changed = False
+        targets = self._targets()
+        doomed = set()
+        # Registers start at 0.
+        known = {'X': 0, 'T': 0}
+
+        for i, (ln, tokens) in enumerate(self._program):
+            if i in targets:
+                known = {}
+            cmd = tokens[0]
+
+            if cmd == 'COPY':
+                val = self._value(tokens[1], known)
+                dest = tokens[2]
+                if dest in REGISTERS:
+                    if val is None:
+                        known.pop(dest, None)
+                    else:
+                        known[dest] = val
+                        if (tokens[1] != str(val) and
+                                _literal(str(val)) is not None):
+                            self._replace(i, ['COPY', str(val), dest])
+                            changed = True
+
+            elif cmd in MATH_OPERATORS:
+                a = self._value(tokens[1], known)
+                b = self._value(tokens[2], known)
+                dest = tokens[3]
+                if dest not in REGISTERS:
+                    continue
+                if (a is None or b is None or
+                        (cmd in ('DIVI', 'MODI') and b == 0)):
+                    known.pop(dest, None)
+                    continue
+                val = MATH_OPERATORS[cmd](a, b)
+                known[dest] = val
+                if _literal(str(val)) is not None:
+                    self._replace(i, ['COPY', str(val), dest])
+                    changed = True
+
+            elif cmd == 'TEST':
+                if tokens[1] == 'EOF' or tokens[2] not in TEST_OPERATORS:
+                    known.pop('T', None)
+                    continue
+                a = self._value(tokens[1], known)
+                b = self._value(tokens[3], known)
+                if a is None or b is None:
+                    known.pop('T', None)
+                    continue
+                val = 1 if TEST_OPERATORS[tokens[2]](a, b) else 0
+                known['T'] = val
+                self._replace(i, ['COPY', str(val), 'T'])
+                changed = True
+
+            elif cmd in ('TJMP', 'FJMP') and 'T' in known:
+                taken = bool(known['T']) == (cmd == 'TJMP')
+                if taken:
+                    self._replace(i, ['JUMP', tokens[1]])
+                else:
+                    self._report('removed {}, never taken'.format(
+                        _describe(ln, tokens)))
+                    doomed.add(i)
+                changed = True
+
+            elif cmd == 'FILE':
+                known.pop(tokens[1], None)
+
+        return self._remove(doomed) or changed
+
+    def thread_jumps(self):
+        changed = False
+        doomed = set()
+        for i, (ln, tokens) in enumerate(self._program):
+            if tokens[0] not in JUMP_CMDS or tokens[1] not in self._labels:
+                continue
+            label = tokens[1]
+            seen = set([i])
+            target = self._labels[label]
+            # Follow chains of unconditional jumps, stopping at loops.
+            while target < len(self._program) and target not in seen:
+                next_ln, next_tokens = self._program[target]
+                if (next_tokens[0] != 'JUMP' or
+                        next_tokens[1] not in self._labels):
+                    break
+                seen.add(target)
+                label = next_tokens[1]
+                target = self._labels[label]
+            if target == i + 1:
+                self._report('removed {}, jumps to the next statement'.format(
+                    _describe(ln, tokens)))
+                doomed.add(i)
+                changed = True
+            elif label != tokens[1]:
+                self._replace(i, [tokens[0], label])
+                changed = True
+        return self._remove(doomed) or changed
+
+    def remove_unreachable(self):
+        reachable = set()
+        todo = [0]
+        while todo:
+            i = todo.pop()
+            if i in reachable or i >= len(self._program):
+                continue
+            reachable.add(i)
+            tokens = self._program[i][1]
+            if tokens[0] in JUMP_CMDS and tokens[1] in self._labels:
+                todo.append(self._labels[tokens[1]])
+            if tokens[0] != 'JUMP':
+                todo.append(i + 1)
+        doomed = set(range(len(self._program))) - reachable
+        for i in sorted(doomed):
+            self._report('removed unreachable {}'.format(
+                _describe(*self._program[i])))
+        return self._remove(doomed)
+
+    def _reads(self, tokens):
+        cmd = tokens[0]
+        if cmd == 'COPY':
+            return tokens[1:2]
+        if cmd in MATH_OPERATORS:
+            return tokens[1:3]
+        if cmd == 'TEST':
+            return [tokens[1], tokens[3]] if tokens[1] != 'EOF' else []
+        if cmd in ('TJMP', 'FJMP'):
+            return ['T']
+        if cmd in ('GRAB', 'SEEK'):
+            return tokens[1:2]
+        return []
+
+    def _writes(self, tokens):
+        # Return the register a statement only writes to, if removing
+        # it would have no other effect.
+        cmd = tokens[0]
+        if cmd == 'COPY':
+            operands = tokens[1:2]
+        elif cmd in MATH_OPERATORS:
+            operands = tokens[1:3]
+            if cmd in ('DIVI', 'MODI') and not _literal(tokens[2]):
+                return None
+        elif cmd == 'TEST' and tokens[1] != 'EOF':
+            if tokens[2] not in TEST_OPERATORS:
+                return None
+            return 'T' if self._simple(tokens[1::2]) else None
+        else:
+            return None
+        if not self._simple(operands):
+            return None
+        dest = tokens[-1]
+        return dest if dest in REGISTERS else None
+
+    def _simple(self, operands):
+        # Operands that can be read without side effects or errors.
+        return all(
+            tok in REGISTERS or _literal(tok) is not None
+            for tok in operands
+        )
+
+    def remove_dead_stores(self):
+        targets = self._targets()
+        doomed = set()
+        live = set(REGISTERS)
+        for i in range(len(self._program) - 1, -1, -1):
+            ln, tokens = self._program[i]
+            if tokens[0] in JUMP_CMDS:
+                # Anything may be read after leaving the block.
+                live = set(REGISTERS)
+            dest = self._writes(tokens)
+            if dest is not None and dest not in live:
+                self._report('removed dead store {}'.format(
+                    _describe(ln, tokens)))
+                doomed.add(i)
+            else:
+                if dest is not None:
+                    live.discard(dest)
+                live.update(tok for tok in self._reads(tokens)
+                            if tok in REGISTERS)
+            if i in targets:
+                live = set(REGISTERS)
+        return self._remove(doomed)
+
+    def run(self):
+        self.remove_marks()
+        for _ in range(MAX_ROUNDS):
+            changed = self.fold_constants()
+            changed = self.thread_jumps() or changed
+            changed = self.remove_unreachable() or changed
+            changed = self.remove_dead_stores() or changed
+            if not changed:
+                break
+        return self._program, self._labels
+
+
+def optimize(program, labels, report=None):
+    # report, if given, is called with a message describing each
+    # change.
+    return _Optimizer(program, labels, report).run()
@@ -0,0 +1,125 @@
+# Writing the results of a run.
+#
+# By default the interpreters print the final registers and then every
+# value of every file. These options add other ways to get the results:
+#
+#   --write-dir DIR   write each file into DIR as a numbered data file,
+#                     as text or, with --write-binary, in the binary
+#                     format of exabin.py
+#   --summary FILE    write the registers and the content of the files
+#                     as JSON or CSV, picked by --summary-format or the
+#                     extension of FILE; "-" writes JSON to stdout
+#
+# When either is used the values are not printed unless --dump is
+# given. Every file, and the dump, is written with a single write.
+
+import csv
+import io
+import json
+import os
+import sys
+
+import exabin
+
+
+FORMATS = ['json', 'csv']
+
+
+def add_arguments(parser):
+    parser.add_argument('--write-dir', default=None,
+                        help='write the final files to this directory')
+    parser.add_argument('--write-binary', action='store_true', default=False,
+                        help='write the files in --write-dir as binary '
+                        'data files')
+    parser.add_argument('--summary', default=None,
+                        help='write the registers and files to this file, '
+                        'or - for stdout')
+    parser.add_argument('--summary-format', choices=FORMATS, default=None,
+                        help='format of --summary (default: from the '
+                        'extension, or json)')
+    parser.add_argument('--dump', action='store_true', default=None,
+                        help='print every value of every file (the default '
+                        'without --write-dir or --summary)')
+    parser.add_argument('--no-dump', dest='dump', action='store_false',
+                        help='do not print the values of the files')
+
+
+def _atomic_write(filename, data, mode):
+    # The file may be one of the inputs, and a binary input may still
+    # be mapped, so the new content goes into a new file.
+    tmp = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(tmp, mode) as f:
+        f.write(data)
+    os.replace(tmp, filename)
+
+
+def write_files(directory, files, binary=False):
+    # files is a list of (file_id, content) pairs.
+    os.makedirs(directory, exist_ok=True)
+    for file_id, content in files:
+        filename = os.path.join(directory, str(file_id))
+        if binary:
+            tmp = '{}.{}.tmp'.format(filename, os.getpid())
+            exabin.write_values(tmp, content)
+            os.replace(tmp, filename)
+        else:
+            _atomic_write(filename, ''.join('{}\n'.format(val)
+                                            for val in content), 'w')
+
+
+def format_json(registers, files):
+    summary = dict(registers)
+    summary['files'] = {str(file_id): content for file_id, content in files}
+    return json.dumps(summary) + '\n'
+
+
+def format_csv(registers, files):
+    # One row per register and one per value: kind, id, position, value.
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator='\n')
+    writer.writerow(['kind', 'id', 'position', 'value'])
+    for name, val in registers.items():
+        writer.writerow(['register', name, '', val])
+    for file_id, content in files:
+        writer.writerows(
+            ('file', file_id, pos, val) for pos, val in enumerate(content))
+    return out.getvalue()
+
+
+def write_summary(filename, registers, files, summary_format=None):
+    if summary_format is None:
+        ext = os.path.splitext(filename)[1].lstrip('.').lower()
+        summary_format = ext if ext in FORMATS else 'json'
+    text = (format_csv if summary_format == 'csv' else format_json)(
+        registers, files)
+    if filename == '-':
+        sys.stdout.write(text)
+    else:
+        _atomic_write(filename, text, 'w')
+
+
+def dump(files, out=None):
+    # Print the values the way the interpreters always have, but build
+    # the text first instead of calling print() for every value.
+    out = out or sys.stdout
+    out.write(''.join(
+        '\nFile: {}\n{}'.format(
+            file_id, ''.join('  {}\n'.format(val) for val in content))
+        for file_id, content in files
+    ))
+
+
+def report(args, registers, files):
+    # registers is a dict of the final register values, files a sorted
+    # list of (file_id, data file) pairs.
+    files = [(file_id, list(data_file.get_content()))
+             for file_id, data_file in files]
+    if args.write_dir:
+        write_files(args.write_dir, files, args.write_binary)
+    if args.summary:
+        write_summary(args.summary, registers, files, args.summary_format)
+    show = args.dump
+    if show is None:
+        show = not (args.write_dir or args.summary)
+    if show:
+        dump(files)
@@ -0,0 +1,167 @@
+# Parsing programs in one pass.
+#
+# parse() reads the lines of a program from any iterable of strings,
+# such as an open file, and returns its statements as a list of
+# (line_num, tokens) pairs and a dict mapping labels to the index of
+# their MARK, the form the rest of the interpreters work with. Each
+# statement is checked as it is read, and the labels of the jumps once
+# every MARK has been seen. When some are wrong, ParseError lists every
+# one of them with its line number, instead of only the first.
+#
+# Generated programs repeat the same lines many times, so each distinct
+# line is split and checked once, and the statements that repeat it
+# share its list of tokens. The tokens are interned, so a label or
+# register name is stored once however often it is used. The lists of
+# tokens must not be changed.
+#
+# With check_operands false only the command and the number of
+# operands are checked, as exa.py does, because it checks operands
+# when their statement runs.
+
+import contextlib
+import gc
+import sys
+
+
+# The operands of each command: a register, a register or a number, a
+# TEST operator, or a label.
+SYNTAX = {
+    'COPY': ('R/N', 'R'),
+    'ADDI': ('R/N', 'R/N', 'R'),
+    'SUBI': ('R/N', 'R/N', 'R'),
+    'MULI': ('R/N', 'R/N', 'R'),
+    'DIVI': ('R/N', 'R/N', 'R'),
+    'MODI': ('R/N', 'R/N', 'R'),
+    'TEST': ('R/N', 'OP', 'R/N'),
+    'MARK': ('L',),
+    'JUMP': ('L',),
+    'TJMP': ('L',),
+    'FJMP': ('L',),
+    'GRAB': ('R/N',),
+    'FILE': ('R',),
+    'SEEK': ('R/N',),
+    'DROP': (),
+}
+
+JUMP_COMMANDS = frozenset(['JUMP', 'TJMP', 'FJMP'])
+
+REGISTER_NAMES = frozenset(['F', 'T', 'X'])
+TEST_OPERATORS = frozenset(['>', '<', '='])
+
+
+class ParseError(RuntimeError):
+
+    def __init__(self, errors):
+        # errors is a list of (line_num, message) pairs.
+        if len(errors) == 1:
+            message = errors[0][1]
+        else:
+            message = '{} errors in the program:\n{}'.format(
+                len(errors), '\n'.join(msg for _, msg in errors))
+        super().__init__(message)
+        self.errors = errors
+
+
+def _is_number(tok):
+    if tok.isdecimal() or (tok[:1] == '-' and tok[1:].isdecimal()):
+        return True
+    try:
+        int(tok)
+    except ValueError:
+        return False
+    return True
+
+
+def check(tokens, line_num, check_operands=True):
+    # Return a description of what is wrong with the statement, or None.
+    cmd = tokens[0]
+    syntax = SYNTAX.get(cmd)
+    if syntax is None:
+        return 'Unrecognized command {} on line {}'.format(cmd, line_num)
+    if cmd == 'TEST' and len(tokens) == 2:
+        if tokens[1] == 'EOF':
+            return None
+        return 'Unrecognized test {} on line {}'.format(tokens[1], line_num)
+    if len(tokens) - 1 != len(syntax):
+        return 'Expected {} arguments to {} on line {}: {}'.format(
+            len(syntax), cmd, line_num, ' '.join(tokens))
+    if not check_operands:
+        return None
+    for pos, (kind, tok) in enumerate(zip(syntax, tokens[1:])):
+        if kind == 'R':
+            if tok not in REGISTER_NAMES:
+                return ('Expected register name, found {} at position {} '
+                        'on line {}'.format(tok, pos, line_num))
+        elif kind == 'R/N':
+            if tok not in REGISTER_NAMES and not _is_number(tok):
+                return ('Expected register name or integer, found {} at '
+                        'position {} on line {}'.format(tok, pos, line_num))
+        elif kind == 'OP':
+            if tok not in TEST_OPERATORS:
+                return ('Unrecognized operator {} at position {} on line {}, '
+                        'must be one of {}'.format(
+                            tok, pos, line_num, sorted(TEST_OPERATORS)))
+    return None
+
+
+@contextlib.contextmanager
+def no_gc():
+    # Building the many small objects of a large program triggers the
+    # cycle collector over and over, and none of them are garbage.
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def parse(lines, check_operands=True):
+    with no_gc():
+        return _parse(lines, check_operands)
+
+
+def _parse(lines, check_operands):
+    program = []
+    labels = {}
+    errors = []
+    # Distinct statements seen so far, as their text and tokens.
+    seen = {}
+    # The line and label of each jump, checked at the end.
+    jumps = []
+    intern = sys.intern
+    for line_num, line in enumerate(lines):
+        text = line.strip()
+        if not text or text[0] == '#':
+            continue
+        tokens = seen.get(text)
+        if tokens is None:
+            tokens = [intern(tok) for tok in text.split()]
+            error = check(tokens, line_num, check_operands)
+            if error is not None:
+                errors.append((line_num, error))
+                continue
+            if tokens[0] != 'MARK':
+                # Each label can only be marked once, so there is no
+                # point keeping its MARK.
+                seen[text] = tokens
+        cmd = tokens[0]
+        if cmd == 'MARK':
+            label = tokens[1]
+            if label in labels:
+                errors.append((line_num, 'Duplicate label {} on line {}'.format(
+                    label, line_num)))
+                continue
+            labels[label] = len(program)
+        elif cmd in JUMP_COMMANDS:
+            jumps.append((line_num, tokens[1]))
+        program.append((line_num, tokens))
+    for line_num, label in jumps:
+        if label not in labels:
+            errors.append((line_num, 'Invalid label {} in jump on line {}'.format(
+                label, line_num)))
+    if errors:
+        errors.sort(key=lambda error: error[0])
+        raise ParseError(errors)
+    return program, labels
@@ -0,0 +1,200 @@
+# Profiling a program run.
+#
+# A Profile is passed to Interpreter.run() or exaf.run_program(), which
+# then use a run loop that counts how many times each statement ran and
+# how many times it sent control somewhere other than the next
+# statement. Everything else is worked out from those two counts after
+# the run:
+#
+# * cycles per source line,
+# * taken and not taken counts for TJMP and FJMP,
+# * loop iterations for each label, the number of times a jump back to
+#   it was taken.
+#
+# The files are wrapped to count reads, writes and seeks per file id.
+# Without a Profile the interpreters run their usual loops.
+
+import collections.abc
+import json
+
+
+class _CountingFile:
+
+    def __init__(self, data_file, stats):
+        self._file = data_file
+        self._stats = stats
+
+    def read(self, *args):
+        self._stats['reads'] += 1
+        return self._file.read(*args)
+
+    def write(self, *args):
+        self._stats['writes'] += 1
+        return self._file.write(*args)
+
+    def seek(self, *args):
+        self._stats['seeks'] += 1
+        return self._file.seek(*args)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+class _CountingFiles(collections.abc.MutableMapping):
+    # The files mapping seen by the interpreter while profiling.
+
+    def __init__(self, files, stats):
+        self._files = files
+        self._stats = stats
+        self._wrapped = {}
+
+    def __contains__(self, file_id):
+        return file_id in self._files
+
+    def __len__(self):
+        return len(self._files)
+
+    def __iter__(self):
+        return iter(self._files)
+
+    def __getitem__(self, file_id):
+        data_file = self._files[file_id]
+        wrapped = self._wrapped.get(file_id)
+        if wrapped is None or wrapped._file is not data_file:
+            stats = self._stats.setdefault(
+                file_id, {'reads': 0, 'writes': 0, 'seeks': 0})
+            wrapped = self._wrapped[file_id] = _CountingFile(data_file, stats)
+        return wrapped
+
+    def __setitem__(self, file_id, data_file):
+        self._files[file_id] = data_file
+
+    def __delitem__(self, file_id):
+        del self._files[file_id]
+        self._wrapped.pop(file_id, None)
+
+    def loaded_items(self):
+        if hasattr(self._files, 'loaded_items'):
+            return self._files.loaded_items()
+        return sorted(self._files.items())
+
+
+class Profile:
+
+    def __init__(self):
+        self.program = []
+        self.labels = {}
+        # Per statement index: times run, and times the next statement
+        # was not the one that follows.
+        self.counts = []
+        self.jumps = []
+        self.files = {}
+
+    def start(self, program, labels, files):
+        # program is a list of (line_num, tokens) pairs. Returns the
+        # files mapping the interpreter should use.
+        self.program = program
+        self.labels = labels
+        self.counts = [0] * len(program)
+        self.jumps = [0] * len(program)
+        return _CountingFiles(files, self.files)
+
+    def results(self):
+        total = sum(self.counts)
+        lines = {}
+        jumps = []
+        loops = {}
+        for i, (ln, tokens) in enumerate(self.program):
+            lines[ln] = lines.get(ln, 0) + self.counts[i]
+            cmd = tokens[0]
+            if cmd in ('TJMP', 'FJMP'):
+                jumps.append({
+                    'line': ln,
+                    'statement': ' '.join(tokens),
+                    'taken': self.jumps[i],
+                    'not_taken': self.counts[i] - self.jumps[i],
+                })
+            if cmd in ('JUMP', 'TJMP', 'FJMP'):
+                target = self.labels.get(tokens[1])
+                if target is not None and target <= i:
+                    loops[tokens[1]] = loops.get(tokens[1], 0) + self.jumps[i]
+
+        label_lines = {}
+        for label, target in self.labels.items():
+            if target < len(self.program):
+                label_lines[label] = self.program[target][0]
+        return {
+            'cycles': total,
+            'lines': [
+                {'line': ln, 'cycles': cycles}
+                for ln, cycles in sorted(lines.items())
+            ],
+            'jumps': jumps,
+            'loops': [
+                {'label': label, 'line': label_lines.get(label),
+                 'iterations': iterations}
+                for label, iterations in sorted(
+                    loops.items(), key=lambda item: -item[1])
+            ],
+            'files': [
+                dict(file=file_id, **stats)
+                for file_id, stats in sorted(self.files.items())
+            ],
+        }
+
+    def to_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.results(), f, indent=2)
+
+    def listing(self, statements):
+        # Return the source annotated with the cycles spent on each
+        # line, followed by the loop and file summaries.
+        results = self.results()
+        total = results['cycles'] or 1
+        cycles = {entry['line']: entry['cycles'] for entry in results['lines']}
+        taken = {entry['line']: entry for entry in results['jumps']}
+
+        out = ['{:>10} {:>6} {:>15}  {:>4}  {}'.format(
+            'cycles', '%', 'taken/not', 'line', 'source')]
+        for ln, line in enumerate(statements):
+            if ln in cycles:
+                count = '{:10} {:6.1%}'.format(cycles[ln], cycles[ln] / total)
+            else:
+                count = ' ' * 17
+            jump = ''
+            if ln in taken:
+                jump = '{}/{}'.format(taken[ln]['taken'], taken[ln]['not_taken'])
+            out.append('{} {:>15}  {:4}  {}'.format(
+                count, jump, ln, line.rstrip()))
+        out.append('')
+        out.append('Total cycles: {}'.format(results['cycles']))
+        for loop in results['loops']:
+            out.append('Loop {} at line {}: {} iterations'.format(
+                loop['label'], loop['line'], loop['iterations']))
+        for stats in results['files']:
+            out.append('File {}: {} reads, {} writes, {} seeks'.format(
+                stats['file'], stats['reads'], stats['writes'],
+                stats['seeks']))
+        return '\n'.join(out)
+
+
+def add_arguments(parser):
+    parser.add_argument('--profile', action='store_true', default=False,
+                        help='print the source annotated with cycle counts')
+    parser.add_argument('--profile-json', default=None,
+                        help='write the profile to this file as JSON')
+
+
+def from_args(args):
+    if args.profile or args.profile_json:
+        return Profile()
+    return None
+
+
+def report(profile, args, statements):
+    if profile is None:
+        return
+    if args.profile:
+        print(profile.listing(statements))
+    if args.profile_json:
+        profile.to_json(args.profile_json)
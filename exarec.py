@@ -0,0 +1,464 @@
+#!/usr/bin/env python3
+
+# Compact binary recordings of a run, and a tool to replay them.
+#
+# A Recorder is passed to Interpreter.run() or exaf.run_program(), which
+# then run the program in blocks of BLOCK_CYCLES cycles and save what
+# the program itself cannot tell us: the new value of X or T after the
+# statements that change one, the id of each file grabbed, the cursor
+# after each SEEK and each value written to a file. The files are
+# wrapped to save the last two. The statement run on each cycle follows
+# from the program and the value of T, and reads and writes always move
+# the cursor by one, so none of that is saved.
+#
+# The recording is a header with the program, then the blocks, then a
+# footer with the final state and the error that stopped the program,
+# if any. Each block starts with a keyframe, the next statement, the
+# registers, the open file and every cursor before its first cycle, so
+# the state at any cycle can be found by decoding a single block. Every
+# record is marshaled, compressed, and prefixed with its length.
+#
+# Run this module with a recording to look at it: it can go to any
+# cycle and step forward and backward, showing X, T, the open file and
+# its cursor, without running the program again.
+
+import argparse
+import collections.abc
+import marshal
+import os
+import struct
+import sys
+import zlib
+
+
+MAGIC = b'EXAREC\x01\n'
+
+FORMAT = 1
+
+BLOCK_CYCLES = 65536
+
+# What is saved for a statement after it runs: the new value of the
+# named register, or the id of the file grabbed.
+GRAB = 'GRAB'
+
+MATH_CMDS = ('ADDI', 'SUBI', 'MULI', 'DIVI', 'MODI')
+
+_LENGTH = struct.Struct('<I')
+
+
+def statement_kinds(program):
+    # program is a list of (line_num, tokens) pairs.
+    kinds = []
+    for ln, tokens in program:
+        cmd = tokens[0]
+        kind = None
+        if cmd == 'TEST':
+            kind = 'T'
+        elif cmd == 'GRAB':
+            kind = GRAB
+        elif cmd in ('COPY', 'FILE') + MATH_CMDS:
+            if tokens[-1] in ('X', 'T'):
+                kind = tokens[-1]
+        kinds.append(kind)
+    return kinds
+
+
+def _reads(tokens):
+    # The number of values a statement reads from the open file.
+    cmd = tokens[0]
+    if cmd == 'COPY':
+        return tokens[1:2].count('F')
+    if cmd in MATH_CMDS:
+        return tokens[1:3].count('F')
+    if cmd in ('TEST', 'GRAB', 'SEEK'):
+        return tokens[1:].count('F')
+    return 0
+
+
+def _writes(tokens):
+    return tokens[0] in ('COPY', 'FILE') + MATH_CMDS and tokens[-1] == 'F'
+
+
+class _RecordingFile:
+
+    def __init__(self, data_file, values):
+        self._file = data_file
+        # Reads need no record, so they go straight to the file. The
+        # methods used on every write are bound once here.
+        self.read = data_file.read
+        self.tell = data_file.tell
+        self.at_eof = data_file.at_eof
+        self._write = data_file.write
+        self._seek = data_file.seek
+        self._save = values.append
+
+    def write(self, val, *args):
+        result = self._write(val, *args)
+        self._save(val)
+        return result
+
+    def seek(self, *args):
+        result = self._seek(*args)
+        self._save(self.tell())
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+class _RecordingFiles(collections.abc.MutableMapping):
+    # The files mapping seen by the interpreter while recording.
+
+    def __init__(self, files, recorder):
+        self._files = files
+        self._recorder = recorder
+        self._wrapped = {}
+
+    def __contains__(self, file_id):
+        return file_id in self._files
+
+    def __len__(self):
+        return len(self._files)
+
+    def __iter__(self):
+        return iter(self._files)
+
+    def __getitem__(self, file_id):
+        data_file = self._files[file_id]
+        wrapped = self._wrapped.get(file_id)
+        if wrapped is None or wrapped._file is not data_file:
+            wrapped = self._wrapped[file_id] = _RecordingFile(
+                data_file, self._recorder.values)
+            self._recorder._files[file_id] = data_file
+        return wrapped
+
+    def get(self, file_id, default=None):
+        # exaf looks up the open file for every operand, so the file
+        # wrapped before is returned without going through __getitem__.
+        wrapped = self._wrapped.get(file_id)
+        if wrapped is not None and wrapped._file is self._files.get(file_id):
+            return wrapped
+        if file_id not in self._files:
+            return default
+        return self[file_id]
+
+    def __setitem__(self, file_id, data_file):
+        self._files[file_id] = data_file
+
+    def __delitem__(self, file_id):
+        del self._files[file_id]
+        self._wrapped.pop(file_id, None)
+
+    def loaded_items(self):
+        if hasattr(self._files, 'loaded_items'):
+            return self._files.loaded_items()
+        return sorted(self._files.items())
+
+
+def _write_record(f, record):
+    data = zlib.compress(marshal.dumps(record), 1)
+    f.write(_LENGTH.pack(len(data)))
+    f.write(data)
+
+
+class Recorder:
+
+    def __init__(self, filename, block_cycles=BLOCK_CYCLES):
+        self._filename = filename
+        self._block_cycles = block_cycles
+        self._f = None
+        self.kinds = []
+        # The values saved since the start of the block, in the order
+        # the statements produced them. Filled in by the run loop and
+        # the file wrappers.
+        self.values = []
+        # The files the program has used, to find their cursors.
+        self._files = {}
+        self._block_start = 0
+        self._keyframe = None
+
+    def start(self, program, labels, files, start_cycle=0):
+        # program is a list of (line_num, tokens) pairs. Returns the
+        # files mapping the interpreter should use.
+        self.kinds = statement_kinds(program)
+        if hasattr(files, 'loaded_items'):
+            self._files = dict(files.loaded_items())
+        else:
+            self._files = dict(files.items())
+        self._block_start = start_cycle
+        self._keyframe = (0, 0, 0, None, self._cursors())
+        self._f = open(self._filename, 'wb')
+        self._f.write(MAGIC)
+        _write_record(self._f, ('header', {
+            'format': FORMAT,
+            'program': [(ln, list(tokens)) for ln, tokens in program],
+            'labels': dict(labels),
+            'block_cycles': self._block_cycles,
+            'start_cycle': start_cycle,
+        }))
+        return _RecordingFiles(files, self)
+
+    def _cursors(self):
+        return sorted((file_id, data_file.tell())
+                      for file_id, data_file in self._files.items())
+
+    def segments(self, start, stop=None):
+        # Yield ranges of cycles to run between blocks.
+        while stop is None or start < stop:
+            end = start + self._block_cycles
+            if stop is not None:
+                end = min(end, stop)
+            yield range(start, end)
+            start = end
+
+    def seal(self, cycle, next_statement, X, T, file_id):
+        # Write the cycles run since the last block, and start a new
+        # block from the given state.
+        count = cycle - self._block_start
+        if count:
+            _write_record(self._f, ('block',) + self._keyframe + (
+                count, self.values))
+        self._block_start = cycle
+        self._keyframe = (next_statement, X, T, file_id, self._cursors())
+        # Cleared in place, the run loops hold on to its append method.
+        del self.values[:]
+
+    def finish(self, cycle, next_statement, X, T, file_id, error=None):
+        if self._f is None:
+            return
+        self.seal(cycle, next_statement, X, T, file_id)
+        _write_record(self._f, ('end', {
+            'cycles': cycle,
+            'next_statement': next_statement,
+            'X': X,
+            'T': T,
+            'file': file_id,
+            'error': None if error is None else '{}: {}'.format(
+                error.__class__.__name__, error),
+        }))
+        self._f.close()
+        self._f = None
+
+
+class Recording:
+
+    def __init__(self, filename):
+        self._f = open(filename, 'rb')
+        if self._f.read(len(MAGIC)) != MAGIC:
+            raise RuntimeError('{} is not a recording'.format(filename))
+        # Find the records without decompressing the blocks.
+        offsets = []
+        while True:
+            length = self._f.read(_LENGTH.size)
+            if len(length) < _LENGTH.size:
+                break
+            offsets.append(self._f.tell())
+            self._f.seek(_LENGTH.unpack(length)[0], os.SEEK_CUR)
+        if not offsets:
+            raise RuntimeError('{} has no header'.format(filename))
+        tag, self.header = self._read(offsets[0])
+        self.program = self.header['program']
+        self.labels = self.header['labels']
+        self.start_cycle = self.header['start_cycle']
+        self._block_cycles = self.header['block_cycles']
+        self.end = None
+        if len(offsets) > 1:
+            tag, end = self._read(offsets[-1])
+            if tag == 'end':
+                self.end = end
+                offsets.pop()
+        self._blocks = offsets[1:]
+        self.cycles = 0
+        if self._blocks:
+            last = self._read(self._blocks[-1])
+            self.cycles = ((len(self._blocks) - 1) * self._block_cycles +
+                           last[6])
+        self._steps = [self._step(pc, tokens)
+                       for pc, (ln, tokens) in enumerate(self.program)]
+        self._cached = (None, None)
+
+    def _step(self, pc, tokens):
+        # What replaying the statement at pc involves: the values it
+        # reads, whether it seeks or writes, the value it saved, and
+        # where it sends control.
+        cmd = tokens[0]
+        jump = None
+        if cmd in ('JUMP', 'TJMP', 'FJMP'):
+            jump = self.labels.get(tokens[1])
+        return (_reads(tokens), cmd == 'SEEK', _writes(tokens),
+                statement_kinds([(None, tokens)])[0], cmd == 'DROP', cmd,
+                jump, pc + 1)
+
+    def _read(self, offset):
+        self._f.seek(offset - _LENGTH.size)
+        length = _LENGTH.unpack(self._f.read(_LENGTH.size))[0]
+        return marshal.loads(zlib.decompress(self._f.read(length)))
+
+    def _decode(self, num):
+        # Return the state after each cycle of block num.
+        if self._cached[0] == num:
+            return self._cached[1]
+        (tag, pc, X, T, file_id, cursors, count,
+         values) = self._read(self._blocks[num])
+        cursors = dict(cursors)
+        steps = self._steps
+        next_value = iter(values).__next__
+        states = []
+        for _ in range(count):
+            (reads, seeks, writes, kind, drops, cmd, jump,
+             next_pc) = steps[pc]
+            if reads:
+                cursors[file_id] = cursors.get(file_id, 0) + reads
+            wrote = None
+            if seeks:
+                cursors[file_id] = next_value()
+            elif writes:
+                pos = cursors.get(file_id, 0)
+                wrote = (file_id, pos, next_value())
+                cursors[file_id] = pos + 1
+            if kind == 'X':
+                X = next_value()
+            elif kind == 'T':
+                T = next_value()
+            elif kind == GRAB:
+                file_id = next_value()
+            elif drops:
+                file_id = None
+            states.append((pc, X, T, file_id, cursors.get(file_id, 0),
+                           wrote))
+            if jump is not None and (cmd == 'JUMP' or
+                                     (cmd == 'TJMP') == bool(T)):
+                pc = jump
+            else:
+                pc = next_pc
+        self._cached = (num, states)
+        return states
+
+    def state(self, cycle):
+        # Return a dict describing the state after cycle cycles of the
+        # recording have run.
+        if not 0 <= cycle <= self.cycles:
+            raise RuntimeError('Cycle {} is outside the recording (0-{})'.format(
+                cycle, self.cycles))
+        result = {
+            'cycle': self.start_cycle + cycle,
+            'line': None,
+            'statement': None,
+            'wrote': None,
+        }
+        if cycle == 0:
+            if not self._blocks:
+                return dict(result, X=0, T=0, file=None, cursor=None)
+            X, T, file_id, cursors = self._read(self._blocks[0])[2:6]
+            cursor = dict(cursors).get(file_id, 0)
+        else:
+            num, offset = divmod(cycle - 1, self._block_cycles)
+            pc, X, T, file_id, cursor, wrote = self._decode(num)[offset]
+            ln, tokens = self.program[pc]
+            result['line'] = ln
+            result['statement'] = ' '.join(tokens)
+            result['wrote'] = wrote
+        result.update(X=X, T=T, file=file_id,
+                      cursor=None if file_id is None else cursor)
+        return result
+
+    def close(self):
+        self._f.close()
+
+
+def format_state(state):
+    if state['statement'] is None:
+        where = '{:>4}  {:30}'.format('', '(start)')
+    else:
+        where = '{:4}  {:30}'.format(state['line'], state['statement'])
+    text = 'cycle {:>10}  {} X={:4} T={:4}'.format(
+        state['cycle'], where, state['X'], state['T'])
+    if state['file'] is not None:
+        text += ' file={} cursor={}'.format(state['file'], state['cursor'])
+    if state['wrote'] is not None:
+        text += ' [wrote {2} to file {0} at {1}]'.format(*state['wrote'])
+    return text
+
+
+def add_arguments(parser):
+    parser.add_argument('--record', metavar='FILE', default=None,
+                        help='save a compact recording of the run to FILE, '
+                        'to look at with exarec.py')
+
+
+def from_args(args):
+    if args.record:
+        return Recorder(args.record)
+    return None
+
+
+HELP = '''\
+n [N]    step forward N cycles (default 1)
+p [N]    step back N cycles (default 1)
+g N      go to cycle N
+e        go to the end
+q        quit'''
+
+
+def replay(recording, cycle, lines=None, out=None):
+    # Read commands from lines and print the state they lead to.
+    out = out or sys.stdout
+    lines = lines or sys.stdin
+    print(format_state(recording.state(cycle)), file=out)
+    for line in lines:
+        words = line.split()
+        if not words:
+            continue
+        cmd, args = words[0], words[1:]
+        try:
+            count = int(args[0]) if args else None
+        except ValueError:
+            print('Not a number: {}'.format(args[0]), file=out)
+            continue
+        if cmd == 'q':
+            break
+        elif cmd == 'n':
+            cycle += 1 if count is None else count
+        elif cmd == 'p':
+            cycle -= 1 if count is None else count
+        elif cmd == 'g' and count is not None:
+            cycle = count - recording.start_cycle
+        elif cmd == 'e':
+            cycle = recording.cycles
+        else:
+            print(HELP, file=out)
+            continue
+        cycle = max(0, min(recording.cycles, cycle))
+        print(format_state(recording.state(cycle)), file=out)
+    return cycle
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('recording')
+    p.add_argument('-c', '--cycle', type=int, default=None,
+                   help='start at this cycle (default: the start)')
+    p.add_argument('-s', '--show', metavar='N', type=int, default=None,
+                   help='print N cycles from --cycle and exit')
+    args = p.parse_args()
+
+    recording = Recording(args.recording)
+    print('{} cycles from cycle {}'.format(recording.cycles,
+                                           recording.start_cycle))
+    if recording.end is None:
+        print('The recording is incomplete')
+    elif recording.end['error']:
+        print('Stopped by {}'.format(recording.end['error']))
+
+    cycle = 0
+    if args.cycle is not None:
+        cycle = max(0, min(recording.cycles,
+                           args.cycle - recording.start_cycle))
+    if args.show is not None:
+        for c in range(cycle, min(recording.cycles, cycle + args.show - 1) + 1):
+            print(format_state(recording.state(c)))
+    else:
+        if sys.stdin.isatty():
+            print(HELP)
+        replay(recording, cycle)
+    recording.close()
@@ -0,0 +1,522 @@
+#!/usr/bin/env python3
+
+# Run many EXAs at once, sharing one set of files.
+#
+# Every EXA runs the same program with its own X, T, program counter
+# and open file. Besides the statements the single-EXA interpreters
+# support, EXAs can use:
+#
+#   REPL L   start a copy of this EXA, with the same X and T and no
+#            file, at label L
+#   HALT     stop this EXA
+#   KILL     stop the EXA with the lowest id other than this one
+#   M        a register shared by all EXAs for passing messages
+#
+# Each cycle the scheduler runs one statement for every runnable EXA,
+# in order of their ids. EXAs created or woken up during a cycle start
+# running in the next one. Writing to M blocks until another EXA reads
+# the value, and reading from M blocks until another EXA writes one.
+# Only one EXA can hold a file at a time, so GRAB blocks while another
+# EXA holds the file. Blocked EXAs are parked on a wait queue for the
+# message or file they need. They are not visited again until a write
+# to M, a read from M, or the file being released wakes them. An EXA
+# that fails stops with its error, and the others keep running.
+
+import argparse
+import bisect
+import collections
+import operator
+import os.path
+
+import exaf
+
+
+MATH_OPERATORS = {
+    'ADDI': operator.add,
+    'SUBI': operator.sub,
+    'MULI': operator.mul,
+    'DIVI': operator.floordiv,
+    'MODI': operator.mod,
+}
+
+TEST_OPERATORS = {
+    '>': operator.gt,
+    '<': operator.lt,
+    '=': operator.eq,
+}
+
+REGISTER_NAMES = ('X', 'T', 'F', 'M')
+
+SYNTAX = {
+    'COPY': ('R/N', 'R'),
+    'ADDI': ('R/N', 'R/N', 'R'),
+    'SUBI': ('R/N', 'R/N', 'R'),
+    'MULI': ('R/N', 'R/N', 'R'),
+    'DIVI': ('R/N', 'R/N', 'R'),
+    'MODI': ('R/N', 'R/N', 'R'),
+    'TEST': ('R/N', 'OP', 'R/N'),
+    'MARK': ('L',),
+    'JUMP': ('L',),
+    'TJMP': ('L',),
+    'FJMP': ('L',),
+    'REPL': ('L',),
+    'GRAB': ('R/N',),
+    'FILE': ('R',),
+    'SEEK': ('R/N',),
+    'DROP': (),
+    'HALT': (),
+    'KILL': (),
+}
+
+# Operand kinds.
+NUM, REG, FILE, MSG = range(4)
+
+# EXA states.
+RUNNABLE = 'runnable'
+BLOCKED = 'blocked'
+HALTED = 'halted'
+FAILED = 'failed'
+
+
+Instruction = collections.namedtuple(
+    'Instruction',
+    ['cmd', 'line_num', 'a', 'b', 'dest', 'op', 'target', 'label',
+     'm_reads'],
+)
+
+
+def _operand(tok):
+    if tok in ('X', 'T'):
+        return (REG, tok)
+    if tok == 'F':
+        return (FILE, None)
+    if tok == 'M':
+        return (MSG, None)
+    return (NUM, int(tok))
+
+
+def parse_program(statements):
+    # Returns a list of Instructions with jump targets resolved to
+    # statement indexes.
+    tokenized = [
+        (ln, stmt.strip().split())
+        for ln, stmt in enumerate(line.strip() for line in statements)
+        if stmt and not stmt.startswith('#')
+    ]
+
+    labels = {}
+    for i, (ln, tokens) in enumerate(tokenized):
+        cmd = tokens[0]
+        if cmd == 'TEST' and tokens[1:] == ['EOF']:
+            continue
+        if cmd not in SYNTAX:
+            raise RuntimeError('Unrecognized command {} on line {}'.format(
+                cmd, ln))
+        syntax = SYNTAX[cmd]
+        if len(syntax) != len(tokens) - 1:
+            raise RuntimeError(
+                'Expected {} arguments to {} got {} on line {}'.format(
+                    len(syntax), cmd, len(tokens) - 1, ln))
+        for pos, (syn, tok) in enumerate(zip(syntax, tokens[1:])):
+            if syn == 'R' and tok not in REGISTER_NAMES:
+                raise RuntimeError(
+                    'Expected register name, found {} at position {} on line {}'.format(
+                        tok, pos, ln))
+            if syn == 'R/N' and tok not in REGISTER_NAMES:
+                try:
+                    int(tok)
+                except ValueError:
+                    raise RuntimeError(
+                        'Expected register name or integer, found {} at position {} on line {}'.format(
+                            tok, pos, ln))
+            if syn == 'OP' and tok not in TEST_OPERATORS:
+                raise RuntimeError(
+                    'Unrecognized operator {} at position {} on line {}'.format(
+                        tok, pos, ln))
+        if cmd == 'MARK':
+            if tokens[1] in labels:
+                raise RuntimeError('Duplicate label {} on line {}'.format(
+                    tokens[1], ln))
+            labels[tokens[1]] = i
+
+    program = []
+    for ln, tokens in tokenized:
+        cmd = tokens[0]
+        a = b = dest = op = target = label = None
+        if cmd == 'COPY':
+            a, dest = _operand(tokens[1]), _operand(tokens[2])
+        elif cmd in MATH_OPERATORS:
+            a, b = _operand(tokens[1]), _operand(tokens[2])
+            dest = _operand(tokens[3])
+            op = MATH_OPERATORS[cmd]
+        elif cmd == 'TEST' and tokens[1] != 'EOF':
+            a, b = _operand(tokens[1]), _operand(tokens[3])
+            op = TEST_OPERATORS[tokens[2]]
+        elif cmd in ('JUMP', 'TJMP', 'FJMP', 'REPL'):
+            label = tokens[1]
+            target = labels.get(label)
+        elif cmd in ('GRAB', 'SEEK'):
+            a = _operand(tokens[1])
+        elif cmd == 'FILE':
+            dest = _operand(tokens[1])
+        if cmd == 'TEST' and tokens[1] == 'EOF':
+            cmd = 'TEST EOF'
+        m_reads = sum(1 for operand in (a, b)
+                      if operand is not None and operand[0] == MSG)
+        program.append(Instruction(
+            cmd, ln, a, b, dest, op, target, label, m_reads))
+    return program
+
+
+class Exa:
+
+    def __init__(self, exa_id, pc, X=0, T=0, parent=None):
+        self.id = exa_id
+        self.pc = pc
+        self.registers = {'X': X, 'T': T}
+        self.parent = parent
+        self.state = RUNNABLE
+        self.error = None
+        self.file_id = None
+        self.file = None
+        # Messages received while blocked, and the value waiting to be
+        # sent while blocked on a write to M.
+        self.inbox = collections.deque()
+        self.outgoing = None
+        # A GRAB that is waiting for the file keeps the id it read.
+        self.grabbing = None
+        self.cycles = 0
+        self.blocked_cycles = 0
+        self.blocked_since = None
+        self.blocked_on = None
+
+    @property
+    def X(self):
+        return self.registers['X']
+
+    @property
+    def T(self):
+        return self.registers['T']
+
+    def __str__(self):
+        return 'EXA {:4} X={:4} T={:4} cycles={:6} blocked={:6} {}'.format(
+            self.id, self.X, self.T, self.cycles, self.blocked_cycles,
+            self.state)
+
+
+class _Blocked(Exception):
+    # Raised to stop executing a statement that has to wait.
+    pass
+
+
+class Scheduler:
+
+    def __init__(self, program, files=None, new_file=None):
+        self._program = program
+        self.files = files if files is not None else {}
+        self._new_file = new_file or exaf.File
+        self.exas = []
+        self.cycle = 0
+        self._next_id = 0
+        # Runnable EXAs in id order, and those that will join them at
+        # the start of the next cycle.
+        self._runnable = []
+        self._woken = []
+        # Wait queues.
+        self._m_readers = collections.deque()
+        self._m_writers = collections.deque()
+        self._file_waiters = collections.defaultdict(collections.deque)
+        self._holders = {}
+
+    def spawn(self, pc=0, X=0, T=0, parent=None):
+        exa = Exa(self._next_id, pc, X, T, parent)
+        self._next_id += 1
+        self.exas.append(exa)
+        # Ids only increase, so appending keeps the order.
+        self._woken.append(exa)
+        return exa
+
+    def _park(self, exa, queue, reason):
+        exa.state = BLOCKED
+        exa.blocked_since = self.cycle
+        exa.blocked_on = reason
+        queue.append(exa)
+        raise _Blocked()
+
+    def _unblock(self, exa):
+        exa.blocked_cycles += self.cycle - exa.blocked_since
+        exa.blocked_since = None
+        exa.blocked_on = None
+
+    def _wake(self, exa):
+        self._unblock(exa)
+        exa.state = RUNNABLE
+        bisect.insort(self._woken, exa, key=lambda e: e.id)
+
+    def _receive(self, exa):
+        if exa.inbox:
+            return exa.inbox.popleft()
+        writer = self._m_writers.popleft()
+        value = writer.outgoing
+        writer.outgoing = None
+        writer.pc += 1
+        if writer.pc >= len(self._program):
+            # The write was its last statement.
+            self._unblock(writer)
+            self._stop(writer, HALTED)
+        else:
+            self._wake(writer)
+        return value
+
+    def _send(self, exa, value):
+        # Returns True when the value was handed to a reader, or parks
+        # the writer until one arrives.
+        if self._m_readers:
+            reader = self._m_readers[0]
+            reader.inbox.append(value)
+            needed = self._program[reader.pc].m_reads
+            if len(reader.inbox) + len(self._m_writers) >= needed:
+                self._m_readers.popleft()
+                self._wake(reader)
+            return True
+        exa.outgoing = value
+        self._park(exa, self._m_writers, 'M')
+
+    def _value(self, exa, operand, line_num):
+        kind, val = operand
+        if kind == NUM:
+            return val
+        if kind == REG:
+            return exa.registers[val]
+        if kind == FILE:
+            if exa.file is None:
+                raise RuntimeError('No open file on line {}'.format(line_num))
+            return exa.file.read()
+        return self._receive(exa)
+
+    def _store(self, exa, operand, value, line_num):
+        kind, val = operand
+        if kind == REG:
+            exa.registers[val] = value
+        elif kind == FILE:
+            if exa.file is None:
+                raise RuntimeError('Writing to file before opening on line {}'.format(
+                    line_num))
+            exa.file.write(value)
+        elif kind == MSG:
+            self._send(exa, value)
+        else:
+            raise RuntimeError('Invalid storage address on line {}'.format(
+                line_num))
+
+    def _release(self, exa):
+        if exa.file_id is None:
+            return
+        file_id = exa.file_id
+        exa.file_id = exa.file = None
+        del self._holders[file_id]
+        waiters = self._file_waiters.get(file_id)
+        if waiters:
+            self._wake(waiters.popleft())
+            if not waiters:
+                del self._file_waiters[file_id]
+
+    def _stop(self, exa, state, error=None):
+        self._release(exa)
+        exa.state = state
+        exa.error = error
+
+    def _kill(self, victim):
+        if victim.state == BLOCKED:
+            for queue in [self._m_readers, self._m_writers] + list(self._file_waiters.values()):
+                if victim in queue:
+                    queue.remove(victim)
+            victim.blocked_cycles += self.cycle - victim.blocked_since
+        elif victim in self._woken:
+            self._woken.remove(victim)
+        victim.inbox.clear()
+        self._stop(victim, HALTED, 'Killed by another EXA')
+
+    def _target(self, ins):
+        if ins.target is None:
+            raise RuntimeError('Invalid label {} in jump on line {}'.format(
+                ins.label, ins.line_num))
+        return ins.target
+
+    def _execute(self, exa):
+        # Run one statement. Raises _Blocked if the EXA has to wait.
+        ins = self._program[exa.pc]
+        cmd = ins.cmd
+        line_num = ins.line_num
+
+        if ins.m_reads and len(exa.inbox) + len(self._m_writers) < ins.m_reads:
+            self._park(exa, self._m_readers, 'M')
+
+        if cmd == 'GRAB':
+            if exa.grabbing is None:
+                exa.grabbing = self._value(exa, ins.a, line_num)
+            file_id = exa.grabbing
+            holder = self._holders.get(file_id)
+            if holder is not None and holder is not exa:
+                self._park(exa, self._file_waiters[file_id],
+                           'file {}'.format(file_id))
+            exa.grabbing = None
+            self._release(exa)
+            if file_id not in self.files:
+                self.files[file_id] = self._new_file(file_id)
+            exa.file_id = file_id
+            exa.file = self.files[file_id]
+            self._holders[file_id] = exa
+
+        elif cmd == 'COPY':
+            value = self._value(exa, ins.a, line_num)
+            self._store(exa, ins.dest, value, line_num)
+
+        elif cmd in MATH_OPERATORS:
+            a = self._value(exa, ins.a, line_num)
+            b = self._value(exa, ins.b, line_num)
+            self._store(exa, ins.dest, ins.op(a, b), line_num)
+
+        elif cmd == 'TEST':
+            a = self._value(exa, ins.a, line_num)
+            b = self._value(exa, ins.b, line_num)
+            exa.registers['T'] = 1 if ins.op(a, b) else 0
+
+        elif cmd == 'TEST EOF':
+            if exa.file is None:
+                raise RuntimeError('Testing EOF without an open file on line {}'.format(
+                    line_num))
+            exa.registers['T'] = 1 if exa.file.at_eof() else 0
+
+        elif cmd == 'JUMP':
+            exa.pc = self._target(ins)
+            return
+
+        elif cmd == 'TJMP' or cmd == 'FJMP':
+            if bool(exa.registers['T']) == (cmd == 'TJMP'):
+                exa.pc = self._target(ins)
+                return
+
+        elif cmd == 'REPL':
+            self.spawn(self._target(ins), exa.X, exa.T, exa.id)
+
+        elif cmd == 'HALT':
+            self._stop(exa, HALTED)
+            return
+
+        elif cmd == 'KILL':
+            for victim in self.exas:
+                if victim is not exa and victim.state in (RUNNABLE, BLOCKED):
+                    self._kill(victim)
+                    break
+
+        elif cmd == 'DROP':
+            if exa.file is None:
+                raise RuntimeError('Dropped when no file was open on line {}'.format(
+                    line_num))
+            self._release(exa)
+
+        elif cmd == 'SEEK':
+            if exa.file is None:
+                raise RuntimeError('Seeked when no file was open on line {}'.format(
+                    line_num))
+            exa.file.seek(self._value(exa, ins.a, line_num))
+
+        elif cmd == 'FILE':
+            if exa.file is None:
+                raise RuntimeError('No open file on line {}'.format(line_num))
+            self._store(exa, ins.dest, exa.file_id, line_num)
+
+        exa.pc += 1
+
+    def step(self):
+        # Run one cycle. Returns False when no EXA can run.
+        if self._woken:
+            self._runnable = list(_merge_by_id(self._runnable, self._woken))
+            self._woken = []
+        if not self._runnable:
+            return False
+
+        end = len(self._program)
+        still_runnable = []
+        for exa in self._runnable:
+            if exa.state != RUNNABLE:
+                # Killed earlier in this cycle.
+                continue
+            exa.cycles += 1
+            try:
+                self._execute(exa)
+            except _Blocked:
+                continue
+            except Exception as err:
+                self._stop(exa, FAILED, err)
+                continue
+            if exa.state != RUNNABLE:
+                continue
+            if exa.pc >= end:
+                self._stop(exa, HALTED)
+                continue
+            still_runnable.append(exa)
+        self._runnable = still_runnable
+        self.cycle += 1
+        return True
+
+    def run(self, max_cycles=None):
+        while max_cycles is None or self.cycle < max_cycles:
+            if not self.step():
+                break
+        return self
+
+    def blocked(self):
+        return [exa for exa in self.exas if exa.state == BLOCKED]
+
+
+def _merge_by_id(a, b):
+    i = j = 0
+    while i < len(a) and j < len(b):
+        if a[i].id <= b[j].id:
+            yield a[i]
+            i += 1
+        else:
+            yield b[j]
+            j += 1
+    yield from a[i:]
+    yield from b[j:]
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('program')
+    p.add_argument('-f', dest='files', action='append', default=[])
+    p.add_argument('-n', '--exas', type=int, default=1,
+                   help='number of EXAs to start with')
+    p.add_argument('--max-cycles', type=int, default=None)
+    args = p.parse_args()
+
+    with open(args.program, 'r') as f:
+        statements = f.readlines()
+
+    files = {}
+    for filename in args.files:
+        file_id = int(os.path.basename(filename))
+        with open(filename, 'r') as f:
+            files[file_id] = exaf.load_data_file(file_id, f)
+
+    scheduler = Scheduler(parse_program(statements), files)
+    for _ in range(args.exas):
+        scheduler.spawn()
+    scheduler.run(args.max_cycles)
+
+    print('Cycles: {}'.format(scheduler.cycle))
+    for exa in scheduler.exas:
+        line = str(exa)
+        if exa.error is not None:
+            line += ' ({})'.format(exa.error)
+        elif exa.blocked_on is not None:
+            line += ' (on {})'.format(exa.blocked_on)
+        print(line)
+
+    for file_id, file_content in sorted(scheduler.files.items()):
+        print('\nFile: {}'.format(file_id))
+        for i in file_content.get_content():
+            print('  {}'.format(i))
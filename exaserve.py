@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+
+# Run programs sent over a socket by a pool of worker processes.
+#
+# The server listens on a Unix socket or a localhost port. Clients send
+# one JSON request per line and get one JSON response per line back, so
+# a connection can be used for any number of requests. A request looks
+# like:
+#
+#   {
+#     "id": 1,
+#     "program": "GRAB 100\nCOPY F X\n",
+#     "files": {"100": [1, 2, 3]},
+#     "max_cycles": 10000,
+#     "compiled": true,
+#     "optimize": false,
+#     "detect_loops": false
+#   }
+#
+# and the response has the same id, "status" ("ok" or "error"), the
+# final "X", "T" and "cycles", the content of every file, and "error".
+# A request of {"op": "stats"} returns the server's counters instead.
+# With "detect_loops", a program caught repeating itself forever is
+# stopped with an InfiniteLoop error, without waiting for the limit.
+#
+# The workers import the interpreter once and keep the programs they
+# have parsed, so a request only pays for running its program. Cycle
+# limits are capped by --max-cycles, and each worker's address space is
+# capped by --memory-limit, so a request that uses too much memory fails
+# with an error instead of taking the server down.
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import json
+import os
+import resource
+import statistics
+import time
+
+import exa
+import exacache
+import exaloop
+import exatrace
+
+
+# Latencies kept for the percentiles in the stats.
+LATENCY_WINDOW = 1000
+
+# Largest request line accepted, in bytes.
+MAX_REQUEST_SIZE = 64 * 1024 * 1024
+
+
+class MemoryProgramCache(exacache.ProgramCache):
+    # A ProgramCache that keeps the most recently used programs in
+    # memory instead of on disk.
+
+    def __init__(self, max_programs):
+        super().__init__()
+        self._max_programs = max_programs
+        self._programs = collections.OrderedDict()
+
+    def get(self, key):
+        entry = self._programs.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._programs.move_to_end(key)
+        self.hits += 1
+        program, labels = entry
+        return [(ln, list(tokens)) for ln, tokens in program], dict(labels)
+
+    def put(self, key, program, labels):
+        self._programs[key] = (
+            tuple((ln, tuple(tokens)) for ln, tokens in program),
+            dict(labels),
+        )
+        while len(self._programs) > self._max_programs:
+            self._programs.popitem(last=False)
+
+
+# Set in each worker by _init_worker().
+_parse_cache = None
+
+
+def _init_worker(memory_limit, max_programs):
+    global _parse_cache
+    _parse_cache = MemoryProgramCache(max_programs)
+    if memory_limit:
+        limit = memory_limit * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def run_request(request, max_cycles=None):
+    # Run one request in a worker and return the response.
+    response = {
+        'id': request.get('id'),
+        'status': 'ok',
+        'X': None,
+        'T': None,
+        'cycles': None,
+        'files': {},
+        'error': None,
+    }
+    limit = request.get('max_cycles')
+    if max_cycles is not None:
+        limit = max_cycles if limit is None else min(limit, max_cycles)
+    try:
+        interp = exa.Interpreter(lambda msg: None, exatrace.NullSink(),
+                                 cache=_parse_cache)
+        for file_id, content in request.get('files', {}).items():
+            interp.add_data_file(int(file_id), list(content))
+        state = interp.run(
+            request['program'].splitlines(True),
+            compiled=request.get('compiled', True),
+            max_cycles=limit,
+            optimize=request.get('optimize', False),
+            loops=(exaloop.LoopDetector() if request.get('detect_loops')
+                   else None),
+        )
+        response['X'] = state.X
+        response['T'] = state.T
+        response['cycles'] = state.cycles
+        response['files'] = {
+            str(file_id): list(data_file.get_content())
+            for file_id, data_file in sorted(state.get_files().items())
+        }
+    except MemoryError:
+        response['status'] = 'error'
+        response['error'] = 'MemoryError: memory limit exceeded'
+    except Exception as err:
+        response['status'] = 'error'
+        response['error'] = '{}: {}'.format(err.__class__.__name__, err)
+    return response
+
+
+class Server:
+
+    def __init__(self, workers=None, max_cycles=None, memory_limit=None,
+                 max_programs=128):
+        self._workers = workers or os.cpu_count() or 1
+        self._max_cycles = max_cycles
+        self._memory_limit = memory_limit
+        self._max_programs = max_programs
+        self._pool = None
+        self._started = time.monotonic()
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.connections = 0
+        self.cycles = 0
+        self._latencies = collections.deque(maxlen=LATENCY_WINDOW)
+
+    def _new_pool(self):
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=self._workers,
+            initializer=_init_worker,
+            initargs=(self._memory_limit, self._max_programs),
+        )
+
+    def _prewarm(self, pool):
+        # Start the workers now, so the first requests do not wait.
+        return [pool.submit(os.getpid) for _ in range(self._workers)]
+
+    def start_pool(self):
+        self._pool = self._new_pool()
+        concurrent.futures.wait(self._prewarm(self._pool))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+
+    def stats(self):
+        uptime = time.monotonic() - self._started
+        latencies = sorted(self._latencies)
+        stats = {
+            'uptime': uptime,
+            'requests': self.requests,
+            'errors': self.errors,
+            'in_flight': self.in_flight,
+            'connections': self.connections,
+            'cycles': self.cycles,
+            'requests_per_sec': self.requests / uptime if uptime else 0,
+            'latency_mean': statistics.fmean(latencies) if latencies else None,
+            'latency_p50': None,
+            'latency_p99': None,
+            'latency_max': latencies[-1] if latencies else None,
+        }
+        if latencies:
+            stats['latency_p50'] = latencies[len(latencies) // 2]
+            stats['latency_p99'] = latencies[min(len(latencies) - 1,
+                                                 len(latencies) * 99 // 100)]
+        return stats
+
+    async def handle_request(self, request):
+        if request.get('op') == 'stats':
+            return dict(self.stats(), id=request.get('id'))
+        if not isinstance(request.get('program'), str):
+            self.errors += 1
+            return {'id': request.get('id'), 'status': 'error',
+                    'error': 'Request has no program'}
+
+        start = time.monotonic()
+        self.in_flight += 1
+        loop = asyncio.get_running_loop()
+        pool = self._pool
+        try:
+            response = await loop.run_in_executor(
+                pool, run_request, request, self._max_cycles)
+        except concurrent.futures.process.BrokenProcessPool:
+            # A worker died, most likely killed for its memory use. Every
+            # request in flight on the pool fails, and the first to get
+            # here replaces it.
+            if self._pool is pool:
+                pool.shutdown(wait=False)
+                self._pool = self._new_pool()
+                self._prewarm(self._pool)
+            response = {'id': request.get('id'), 'status': 'error',
+                        'error': 'Worker process died'}
+        finally:
+            self.in_flight -= 1
+        elapsed = time.monotonic() - start
+        response['elapsed'] = elapsed
+        self._latencies.append(elapsed)
+        self.requests += 1
+        if response['status'] != 'ok':
+            self.errors += 1
+        if response.get('cycles'):
+            self.cycles += response['cycles']
+        return response
+
+    async def handle_connection(self, reader, writer):
+        self.connections += 1
+        pending = set()
+        lock = asyncio.Lock()
+
+        async def answer(request, earlier):
+            if earlier:
+                await asyncio.wait(earlier)
+            response = await self.handle_request(request)
+            async with lock:
+                writer.write(json.dumps(response).encode('utf-8') + b'\n')
+                await writer.drain()
+
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # Longer than the stream limit.
+                    break
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError('Request must be a JSON object')
+                except ValueError as err:
+                    async with lock:
+                        writer.write(json.dumps({
+                            'status': 'error',
+                            'error': 'Invalid request: {}'.format(err),
+                        }).encode('utf-8') + b'\n')
+                        await writer.drain()
+                    continue
+                # Requests on one connection run concurrently, and each
+                # response carries the id of its request. A stats request
+                # waits for the requests sent before it, so its counters
+                # include every reply written ahead of it.
+                earlier = None
+                if request.get('op') == 'stats':
+                    earlier = set(pending)
+                task = asyncio.create_task(answer(request, earlier))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+        except ConnectionError:
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def serve(self, socket_path=None, port=None):
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+            server = await asyncio.start_unix_server(
+                self.handle_connection, socket_path, limit=MAX_REQUEST_SIZE)
+        else:
+            server = await asyncio.start_server(
+                self.handle_connection, '127.0.0.1', port,
+                limit=MAX_REQUEST_SIZE)
+        async with server:
+            await server.serve_forever()
+
+
+def send_requests(requests, socket_path=None, port=None):
+    # A simple client: send the requests on one connection and return
+    # the responses in the same order.
+    async def exchange():
+        if socket_path is not None:
+            reader, writer = await asyncio.open_unix_connection(
+                socket_path, limit=MAX_REQUEST_SIZE)
+        else:
+            reader, writer = await asyncio.open_connection(
+                '127.0.0.1', port, limit=MAX_REQUEST_SIZE)
+        for num, request in enumerate(requests):
+            request = dict(request, id=num)
+            writer.write(json.dumps(request).encode('utf-8') + b'\n')
+        await writer.drain()
+        responses = [None] * len(requests)
+        for _ in requests:
+            response = json.loads(await reader.readline())
+            responses[response['id']] = response
+        writer.close()
+        await writer.wait_closed()
+        return responses
+    return asyncio.run(exchange())
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(prog='exa serve')
+    where = p.add_mutually_exclusive_group(required=True)
+    where.add_argument('--socket', default=None,
+                       help='listen on this Unix socket')
+    where.add_argument('--port', type=int, default=None,
+                       help='listen on this port on localhost')
+    p.add_argument('-j', '--workers', type=int, default=None,
+                   help='number of worker processes (default: one per CPU)')
+    p.add_argument('--max-cycles', type=int, default=1000000,
+                   help='most cycles a request may run (default: 1000000)')
+    p.add_argument('--memory-limit', type=int, default=512,
+                   help='address space limit of each worker in MiB '
+                   '(default: 512, 0 for none)')
+    p.add_argument('--parse-cache', type=int, default=128,
+                   help='parsed programs kept by each worker')
+    args = p.parse_args(argv)
+
+    server = Server(args.workers, args.max_cycles, args.memory_limit,
+                    args.parse_cache)
+    server.start_pool()
+    try:
+        asyncio.run(server.serve(args.socket, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if args.socket is not None and os.path.exists(args.socket):
+            os.unlink(args.socket)
+
+
+if __name__ == '__main__':
+    main()
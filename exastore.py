@@ -0,0 +1,185 @@
+# A directory of data files that are loaded when a program grabs them.
+#
+# FileStore indexes the numbered files in a directory once and then
+# acts as the dict of files the interpreters expect, loading a file the
+# first time it is looked up. When the values held in memory go over a
+# limit, the least recently grabbed files that have not been written
+# are evicted. An evicted file that the interpreter still holds is
+# found again instead of being reloaded, and the cursor of one that is
+# reloaded is restored. Data files given on their own with add_input()
+# are kept in memory. write_back() saves the files that were written or
+# created in the same format they were read.
+
+import collections
+import collections.abc
+import os
+import weakref
+
+import exabin
+
+
+def read_text_file(filename):
+    with open(filename, 'r') as f:
+        content = []
+        for num, line in enumerate(f):
+            try:
+                content.append(int(line.strip()))
+            except ValueError:
+                raise RuntimeError('Invalid integer {} on line {} of {}'.format(
+                    line.strip(), num, filename))
+    return content
+
+
+def write_text_file(filename, content):
+    with open(filename, 'w') as f:
+        f.write(''.join('{}\n'.format(val) for val in content))
+
+
+class FileStore(collections.abc.MutableMapping):
+
+    def __init__(self, directory, file_factory, max_values=None):
+        # file_factory(file_id, content) builds the File object for a
+        # text data file. Binary data files are memory-mapped, and do
+        # not count against max_values.
+        self._directory = directory
+        self._file_factory = file_factory
+        self._max_values = max_values
+        self._paths = {}
+        for name in os.listdir(directory):
+            try:
+                file_id = int(name)
+            except ValueError:
+                continue
+            path = os.path.join(directory, name)
+            if os.path.isfile(path):
+                self._paths[file_id] = path
+
+        # Loaded files in least recently used order, with the number of
+        # values each one holds and its version when it was loaded.
+        self._resident = collections.OrderedDict()
+        self._sizes = {}
+        self._versions = {}
+        self._resident_values = 0
+        # Evicted files the interpreter may still be holding, and the
+        # cursors of the ones that have been evicted.
+        self._evicted = weakref.WeakValueDictionary()
+        self._cursors = {}
+        self._created = set()
+        # Files from add_input(), which cannot be loaded again.
+        self._inputs = set()
+        self.loads = 0
+        self.evictions = 0
+
+    def __contains__(self, file_id):
+        return file_id in self._paths or file_id in self._resident
+
+    def __len__(self):
+        return len(set(self._paths) | set(self._resident))
+
+    def __iter__(self):
+        return iter(sorted(set(self._paths) | set(self._resident)))
+
+    def __getitem__(self, file_id):
+        if file_id in self._resident:
+            self._resident.move_to_end(file_id)
+            return self._resident[file_id]
+        if file_id in self._evicted:
+            data_file = self._evicted.pop(file_id)
+            self._cursors.pop(file_id, None)
+            self._add(file_id, data_file, self._sizes.get(file_id, 0))
+            return data_file
+        if file_id not in self._paths:
+            raise KeyError(file_id)
+        return self._load(file_id)
+
+    def __setitem__(self, file_id, data_file):
+        # Files created by GRAB are always written back.
+        self._created.add(file_id)
+        self._versions[file_id] = data_file.version
+        self._add(file_id, data_file, 0)
+
+    def __delitem__(self, file_id):
+        self._remove(file_id)
+        self._paths.pop(file_id, None)
+        self._created.discard(file_id)
+        self._inputs.discard(file_id)
+
+    def add_input(self, file_id, data_file):
+        # A data file from outside the directory, such as one given with
+        # -f. Like a loaded file, it is only written back when the
+        # program changes it.
+        self._inputs.add(file_id)
+        self._versions[file_id] = data_file.version
+        self._add(file_id, data_file, 0)
+
+    def _load(self, file_id):
+        path = self._paths[file_id]
+        if exabin.is_binary(path):
+            data_file = exabin.MappedFile(file_id, path)
+            size = 0
+        else:
+            content = read_text_file(path)
+            data_file = self._file_factory(file_id, content)
+            size = len(content)
+        # Put the cursor back where it was when the file was evicted.
+        data_file.seek(self._cursors.pop(file_id, 0))
+        self._versions[file_id] = data_file.version
+        self.loads += 1
+        self._add(file_id, data_file, size)
+        return data_file
+
+    def _add(self, file_id, data_file, size):
+        self._resident[file_id] = data_file
+        self._sizes[file_id] = size
+        self._resident_values += size
+        self._evict()
+
+    def _remove(self, file_id):
+        data_file = self._resident.pop(file_id, None)
+        if data_file is not None:
+            self._resident_values -= self._sizes[file_id]
+        return data_file
+
+    def is_modified(self, file_id, data_file):
+        return (file_id in self._created or
+                data_file.version != self._versions.get(file_id))
+
+    def _evict(self):
+        if self._max_values is None:
+            return
+        # Never evict the most recent file, which was just grabbed.
+        for file_id in list(self._resident)[:-1]:
+            if self._resident_values <= self._max_values:
+                break
+            data_file = self._resident[file_id]
+            if file_id in self._inputs or self.is_modified(file_id, data_file):
+                continue
+            self._remove(file_id)
+            self._evicted[file_id] = data_file
+            self._cursors[file_id] = data_file.tell()
+            self.evictions += 1
+
+    def loaded_items(self):
+        # The files that have been loaded or created, without loading
+        # the rest of the directory.
+        files = dict(self._evicted.items())
+        files.update(self._resident)
+        return sorted(files.items())
+
+    def write_back(self):
+        written = []
+        for file_id, data_file in self.loaded_items():
+            if not self.is_modified(file_id, data_file):
+                continue
+            if isinstance(data_file, exabin.MappedFile):
+                data_file.flush()
+            else:
+                path = self._paths.get(file_id)
+                if path is None:
+                    path = os.path.join(self._directory, str(file_id))
+                    self._paths[file_id] = path
+                write_text_file(path, data_file.get_content())
+            self._created.discard(file_id)
+            self._versions[file_id] = data_file.version
+            written.append(file_id)
+        return written
@@ -0,0 +1,205 @@
+# Data files read from and written to streams.
+#
+# A StreamFile reads its values from a text stream, one per line, as
+# the program reads them, so the input can come from a pipe and be
+# larger than memory:
+#
+#   producer | exa.py prog.exa --stream 300=-
+#
+# Only the last `window` values are kept. SEEK can go back within them,
+# and going back further is an error. TEST EOF reads at most one value
+# ahead to answer. A StreamFile with a sink writes each value to it as
+# the value leaves the window, and the rest when it is closed, so an
+# output file is never held in memory either:
+#
+#   exa.py prog.exa --stream 300=- --stream-out 400=out.txt
+#
+# The content of a stream is not kept, so stream files are left out of
+# the dump and summaries of the results, and cannot be checkpointed.
+
+import collections
+import sys
+
+
+DEFAULT_WINDOW = 10000
+
+
+class StreamFile:
+
+    def __init__(self, file_id, source=None, sink=None,
+                 window=DEFAULT_WINDOW):
+        # source and sink are text files, or None for a file that
+        # starts empty or whose values are dropped.
+        self._id = file_id
+        self._source = source
+        self._lines = iter(source) if source is not None else iter(())
+        self._sink = sink
+        self._window = window
+        # The values from position _base on.
+        self._values = collections.deque()
+        self._base = 0
+        self._exhausted = source is None
+        self._cursor = 0
+        self._line_num = 0
+        # Counts writes, so callers can tell whether the file changed.
+        self.version = 0
+
+    def _append(self, val):
+        if len(self._values) == self._window:
+            dropped = self._values.popleft()
+            self._base += 1
+            if self._sink is not None:
+                self._sink.write('{}\n'.format(dropped))
+        self._values.append(val)
+
+    def _read_next(self):
+        # Read one more value from the source, returning False at its
+        # end.
+        if self._exhausted:
+            return False
+        for line in self._lines:
+            self._line_num += 1
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                val = int(line)
+            except ValueError:
+                raise RuntimeError(
+                    'Invalid integer {} on line {} of stream file {}'.format(
+                        line, self._line_num, self._id))
+            self._append(val)
+            return True
+        self._exhausted = True
+        return False
+
+    def _known(self):
+        # The number of values read so far, or written past them.
+        return self._base + len(self._values)
+
+    def _check_window(self, pos):
+        if pos < self._base:
+            raise RuntimeError(
+                'Position {} of stream file {} is before the last {} values, '
+                'which are all that are kept'.format(
+                    pos, self._id, self._window))
+
+    def at_eof(self):
+        if self._cursor < self._known():
+            return False
+        return not self._read_next()
+
+    def seek(self, offset):
+        dest = self._cursor + offset
+        if dest < 0:
+            dest = 0
+        self._check_window(dest)
+        while dest > self._known() and self._read_next():
+            pass
+        self._cursor = min(dest, self._known())
+
+    def read(self, line_num=None):
+        pos = self._cursor
+        if pos >= self._known() and not self._read_next():
+            message = 'Read past the end of file {} at position {}'.format(
+                self._id, pos)
+            if line_num is not None:
+                message += ' on line {}'.format(line_num)
+            raise RuntimeError(message)
+        # The window may have moved on while reading ahead to pos.
+        self._check_window(pos)
+        self._cursor = pos + 1
+        return self._values[pos - self._base]
+
+    def write(self, val, line_num=None):
+        pos = self._cursor
+        self._check_window(pos)
+        self.version += 1
+        if pos < self._known() or self._read_next():
+            self._values[pos - self._base] = val
+        else:
+            self._append(val)
+        self._cursor = pos + 1
+
+    def tell(self):
+        return self._cursor
+
+    def get_content(self):
+        raise RuntimeError(
+            'The content of stream file {} is not kept'.format(self._id))
+
+    def close(self):
+        # Copy what is left of the source to the sink, then write out
+        # the window.
+        if self._sink is not None:
+            while self._read_next():
+                pass
+            self._sink.write(''.join('{}\n'.format(val)
+                                     for val in self._values))
+            self._values.clear()
+            if self._sink is not sys.stdout:
+                self._sink.close()
+        if self._source is not None and self._source is not sys.stdin:
+            self._source.close()
+
+
+def _parse_spec(spec, option):
+    file_id, _, path = spec.partition('=')
+    if not file_id.lstrip('-').isdigit() or not path:
+        raise RuntimeError('{} needs ID=PATH, not {}'.format(option, spec))
+    return int(file_id), path
+
+
+def add_arguments(parser):
+    parser.add_argument('--stream', metavar='ID=PATH', action='append',
+                        default=[],
+                        help='read file ID from PATH as it is used, '
+                        '- for stdin')
+    parser.add_argument('--stream-out', metavar='ID=PATH', action='append',
+                        default=[],
+                        help='write file ID to PATH as it is written, '
+                        '- for stdout')
+    parser.add_argument('--stream-window', type=int, default=DEFAULT_WINDOW,
+                        help='values of each stream file kept for SEEK '
+                        '(default: {})'.format(DEFAULT_WINDOW))
+
+
+def from_args(args):
+    # Return a dict of the stream files, by id.
+    sources = dict(_parse_spec(spec, '--stream') for spec in args.stream)
+    sinks = dict(_parse_spec(spec, '--stream-out')
+                 for spec in args.stream_out)
+    if args.stream_window < 1:
+        raise RuntimeError('--stream-window must be at least 1')
+    if sources or sinks:
+        # These need the content of every file.
+        for option, name in [('data_dir', '--data-dir'),
+                             ('checkpoint_dir', '--checkpoint-dir')]:
+            if getattr(args, option, None):
+                raise RuntimeError(
+                    'Stream files cannot be used with {}'.format(name))
+    streams = {}
+    for file_id in sorted(set(sources) | set(sinks)):
+        source = sink = None
+        if file_id in sources:
+            path = sources[file_id]
+            source = sys.stdin if path == '-' else open(path, 'r')
+        if file_id in sinks:
+            path = sinks[file_id]
+            sink = sys.stdout if path == '-' else open(path, 'w')
+        streams[file_id] = StreamFile(file_id, source, sink,
+                                      args.stream_window)
+    return streams
+
+
+def close(streams):
+    for data_file in streams.values():
+        data_file.close()
+
+
+def without_streams(files, streams):
+    # files is a list of (file_id, data file) pairs. The profiler and
+    # the recorder wrap the files they see, so the stream files are
+    # told apart by their ids.
+    return [(file_id, data_file) for file_id, data_file in files
+            if file_id not in streams]
@@ -0,0 +1,119 @@
+# Trace sinks for the interpreters.
+#
+# The interpreters call record(fmt, *args) once per cycle with a
+# formatting function and the raw values it needs, and leave the
+# formatting to the sink. Interpreters check the enabled attribute
+# before entering their run loop, so with a NullSink they take a loop
+# that does not touch the sink at all.
+
+import collections
+import queue
+import sys
+import threading
+
+
+class NullSink:
+
+    enabled = False
+
+    def record(self, fmt, *args):
+        pass
+
+    def error(self, exc):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class StreamSink(NullSink):
+
+    enabled = True
+
+    def __init__(self, output=print):
+        self._output = output
+
+    def record(self, fmt, *args):
+        self._output(fmt(*args))
+
+
+class RingBufferSink(NullSink):
+
+    enabled = True
+
+    def __init__(self, size, output=None):
+        self._steps = collections.deque(maxlen=size)
+        self._output = output or (lambda msg: print(msg, file=sys.stderr))
+
+    def record(self, fmt, *args):
+        self._steps.append((fmt, args))
+
+    def lines(self):
+        return [fmt(*args) for fmt, args in self._steps]
+
+    def error(self, exc):
+        self._output('Last {} steps before {}: {}'.format(
+            len(self._steps), exc.__class__.__name__, exc))
+        for line in self.lines():
+            self._output(line)
+
+
+class BackgroundWriterSink(NullSink):
+
+    enabled = True
+
+    # Steps are handed to the writer thread in batches of this size.
+    batch_size = 4096
+
+    def __init__(self, filename, max_batches=64):
+        self._batch = []
+        self._queue = queue.Queue(maxsize=max_batches)
+        self._fd = open(filename, 'w', buffering=1024 * 1024)
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    def _write(self):
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                break
+            self._fd.write(''.join(
+                fmt(*args) + '\n' for fmt, args in batch))
+        self._fd.close()
+
+    def record(self, fmt, *args):
+        self._batch.append((fmt, args))
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._batch:
+            self._queue.put(self._batch)
+            self._batch = []
+
+    def close(self):
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+
+
+def add_arguments(parser):
+    parser.add_argument('--trace-ring', metavar='N', type=int, default=None,
+                        help='keep only the last N steps, printed if the '
+                        'program fails')
+    parser.add_argument('--trace-file', metavar='FILE', default=None,
+                        help='write every step to FILE from a background '
+                        'thread')
+
+
+def from_args(args, output, verbose=True):
+    if args.trace_file:
+        return BackgroundWriterSink(args.trace_file)
+    if args.trace_ring:
+        return RingBufferSink(args.trace_ring)
+    if verbose:
+        return StreamSink(output)
+    return NullSink()
@@ -11,3 +11,10 @@ python3 ./exa.py challenge3_example1.exa
 python3 ./exa.py -f 100 challenge4_example1.exa
 
 python3 ./exa.py challenge4.exa
+
+python3 ./exabatch.py empty_file.json
+
+bin_dir=$(mktemp -d)
+python3 ./exabin.py to-binary 300 "$bin_dir/300"
+python3 ./exa.py -q -f "$bin_dir/300" empty_file.exa
+rm -r "$bin_dir"